@@ -22,18 +22,121 @@ __all__ = [
     "handlers",
     "proxies",
     "jsonlib",
-    "exceptions"
+    "exceptions",
+    "poller",
+    "workers",
+    "packlib",
 ]
 
 bjsonrpc_options = {
-    'threaded' : False
+    'threaded' : False,
+    'write_cork' : 0,
+    'worker_threads' : 16,
+    'worker_queue_size' : 1000,
+    'process_pool_size' : None,
+    'process_timeout' : 300,
+    'parallel_batches' : False,
+    'autobatch_window' : 0,
+    'autobatch_size' : 100,
+    'framing' : 'line',
+    'codec' : 'json',
+    'compression' : None,
+    'compress_threshold' : 16384,
+    'compress_level' : 6,
+    'stream_chunk_size' : 100,
+    'reader_thread' : False,
+    'write_high_water' : 1 << 24,
+    'write_low_water' : 1 << 22,
+    'write_high_messages' : None,
+    'write_low_messages' : None,
+    'write_policy' : 'block',
 }
 """
 Dictionary with global options for the library. 
 
 **threaded**
-    (Default: False) When is set to True, threads will be created for handling 
-    each incoming item.
+    (Default: False) When is set to True, incoming items are handled by the
+    threads of a worker pool (see *bjsonrpc.workers*).
+
+**write_cork**
+    (Default: 0) Time in microseconds the writing thread of a connection waits
+    before sending, so that messages queued meanwhile go in the same syscall.
+
+**worker_threads**
+    (Default: 16) Maximum number of threads of the worker pool shared by the
+    connections in threaded mode.
+
+**worker_queue_size**
+    (Default: 1000) Maximum number of items waiting for a thread of the shared
+    worker pool. When it is full, the calls that connections read are
+    answered with an error instead.
+
+**process_pool_size**
+    (Default: None) Number of processes of the pool that runs the handler
+    methods marked with *bjsonrpc.handlers.process_method*. None means one
+    per CPU.
+
+**process_timeout**
+    (Default: 300) Seconds after which a call running in the process pool 
+    is answered with an error if it didn't finish, for example because its
+    process was killed. None means no limit.
+
+**parallel_batches**
+    (Default: False) When is set to True, the calls received together in a
+    batch run at the same time in threads of the worker pool. Their responses
+    are still sent in one message, in order.
+
+**autobatch_window**
+    (Default: 0) Time in microseconds that the calls made through the proxies
+    of a connection wait to be sent together in one batch message. 0 sends
+    each call at once.
+
+**autobatch_size**
+    (Default: 100) Maximum number of calls in an automatic batch: when so 
+    many are waiting, they are sent without waiting for the window to end.
+
+**framing**
+    (Default: 'line') Framing that *bjsonrpc.connect* asks the server for:
+    'line' (newline-delimited messages) or 'length' (length-prefixed). See
+    *Connection.negotiate*.
+
+**codec**
+    (Default: 'json') Codec that *bjsonrpc.connect* asks the server for:
+    'json' or 'msgpack' (see :ref:`bjsonrpc.packlib`).
+
+**compression**
+    (Default: None) Compression that *bjsonrpc.connect* asks the server for:
+    None or 'zlib'. See *Connection.negotiate*.
+
+**compress_threshold**
+    (Default: 16384) Size in bytes from which messages are compressed, when
+    compression was negotiated. Smaller messages are sent as they are.
+
+**compress_level**
+    (Default: 6) zlib compression level, from 1 (fastest) to 9 (smallest).
+
+**stream_chunk_size**
+    (Default: 100) Number of items of a streamed result sent in each message
+    (see *Connection.stream*).
+
+**reader_thread**
+    (Default: False) When is set to True, *bjsonrpc.connect* starts a thread
+    that reads the messages of the connection, so threads waiting for a 
+    response don't read the socket themselves (see *Connection.start_reader*).
+
+**write_high_water**, **write_low_water**
+    (Default: 16 MiB, 4 MiB) Bytes written to a connection and not sent yet
+    from which the *write_policy* applies, and below which it stops.
+
+**write_high_messages**, **write_low_messages**
+    (Default: None) Same, in number of messages. None means no limit.
+
+**write_policy**
+    (Default: 'block') What writers do above the high watermark: 'block' 
+    (wait for the queue to drain), 'error' (raise 
+    *bjsonrpc.exceptions.QueueFullError*) or 'shed' (drop notifications, 
+    block for the rest). Servers stop reading from the connection instead of
+    blocking. See *Connection.write_policy*.
 
 """
 
@@ -46,4 +149,8 @@ import bjsonrpc.handlers
 import bjsonrpc.proxies
 import bjsonrpc.jsonlib
 import bjsonrpc.exceptions
+import bjsonrpc.poller
+import bjsonrpc.workers
+import bjsonrpc.timers
+import bjsonrpc.packlib
 
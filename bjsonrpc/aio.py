@@ -0,0 +1,525 @@
+"""
+    bjson/aio.py
+    
+    Asynchronous Bidirectional JSON-RPC protocol implementation over an
+    asyncio event loop.
+    
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions
+    are met:
+    1. Redistributions of source code must retain the above copyright
+       notice, this list of conditions and the following disclaimer.
+    2. Redistributions in binary form must reproduce the above copyright
+       notice, this list of conditions and the following disclaimer in the
+       documentation and/or other materials provided with the distribution.
+    3. Neither the name of copyright holders nor the names of its
+       contributors may be used to endorse or promote products derived
+       from this software without specific prior written permission.
+
+    THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+    ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+    TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+    PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+    BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+    CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+"""
+import traceback
+from collections import deque
+
+import trollius as asyncio
+from trollius import From, Return
+
+from bjsonrpc.connection import Connection
+from bjsonrpc.request import map_result
+from bjsonrpc.exceptions import EofError, ServerError
+import bjsonrpc.handlers
+import bjsonrpc.jsonlib as json
+
+__all__ = [
+    "AsyncConnection",
+    "AsyncStream",
+    "AsyncServer",
+    "createserver",
+    "connect",
+]
+
+def _isawaitable(value):
+    """ True if *value* is a coroutine or a future """
+    return asyncio.iscoroutine(value) or isinstance(value, asyncio.Future)
+
+
+class AsyncConnection(Connection):
+    """
+        *Connection* running on an asyncio (trollius) event loop. It speaks
+        the same newline-delimited protocol, so it can talk to any other
+        bjsonrpc peer, but nothing in it blocks or uses threads: every
+        message is read, dispatched and written by the event loop.
+
+        Usually created by *connect* or by *AsyncServer*.
+
+        **reader**, **writer**
+            *StreamReader* and *StreamWriter* of the connected socket.
+
+        **address**
+            Address of the other peer in (host,port) form.
+
+        **handler_factory**
+            Class type inherited from BaseHandler which holds the public
+            methods. Handler methods may be coroutines: the response is sent
+            when they finish, and the loop keeps serving meanwhile.
+
+        **loop** = None
+            Event loop to use. By default, the current one.
+
+        **Members:**
+
+        **call**, **method**, **map**
+            Proxies that return a future with the value of the call. Use
+            them from coroutines as ``value = yield From(conn.call.foo(1))``.
+            If the other end sends an error, the future raises
+            *exceptions.ServerError*.
+
+        **notify**
+            Notification Proxy. The message is written at once and returns
+            *None*. Use *drain* to wait until the write buffer is flushed.
+
+        **stream**
+            Stream Proxy. Returns an *AsyncStream* to read the items of the
+            result in chunks as they arrive.
+
+        The connection is used from the event loop thread only.
+    """
+    max_line = 1 << 26
+    # Maximum length of a received message, in bytes.
+    framings = ['line']
+    # The StreamReader reads lines: other framings are refused.
+
+    def __init__(self, reader, writer, address = None,
+            handler_factory = bjsonrpc.handlers.NullHandler, loop = None):
+        self._reader = reader
+        self._writer = writer
+        self._loop = loop or asyncio.get_event_loop()
+        self._read_task = None
+        self._dispatch_waiters = [] # futures of read_and_dispatch
+        Connection.__init__(self, writer.get_extra_info('socket'),
+            address = address, handler_factory = handler_factory)
+
+    def start(self):
+        """
+            Starts reading and dispatching messages in a task of the loop.
+            Returns the task, which finishes when the connection is closed.
+        """
+        if self._read_task is None:
+            self._read_task = asyncio.ensure_future(self._read_loop(),
+                loop = self._loop)
+        return self._read_task
+
+    @asyncio.coroutine
+    def _read_loop(self):
+        """
+            Task that reads and dispatches messages until the other end
+            closes the connection.
+        """
+        try:
+            while True:
+                line = yield From(self._reader.readline())
+                if not line.endswith('\n'):
+                    break # EOF
+                if self._debug_socket:
+                    print ">:%d:" % len(line), line[:130]
+                self._dispatch_line(line[:-1])
+        except (EofError, IOError):
+            pass
+        finally:
+            self.close()
+
+    def _dispatch_line(self, data):
+        """
+            Decodes and dispatches one message.
+        """
+        item = None
+        try:
+            item = json.loads(data, self)
+            self._received(item)
+            if type(item) is list: # batch call
+                self.dispatch_batch(item, thread=False)
+            elif type(item) is dict: # std call
+                self.dispatch_item_single(item)
+            else: # Unknown format :-(
+                print "Received message with unknown format type:" , type(item)
+        except Exception:
+            print traceback.format_exc()
+            self._forget_calls(item) # they won't be answered.
+        self._wake_waiters(True)
+
+    def _wake_waiters(self, dispatched):
+        """
+            Wakes up the *read_and_dispatch* calls waiting for a message:
+            *dispatched* is what they return.
+        """
+        waiters, self._dispatch_waiters = self._dispatch_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(dispatched)
+
+    def proxy(self, sync_type, name, args, kwargs, deadline = None):
+        """
+            Calls method *name* of the other end. Returns a future for calls
+            (*sync_type* 0, 1 or 3), an *AsyncStream* for streams (4) and 
+            *None* for notifications (2).
+            
+            The *deadline* is sent to the other end, which drops the call if
+            it can't start it in time; wrap the future in *asyncio.wait_for*
+            to stop waiting for it.
+        """
+        data = self._build_request(sync_type, name, args, kwargs, deadline)
+        if sync_type == 2:
+            self.write(json.dumps(data, self))
+            return None
+        if sync_type == 4:
+            # The reading task doesn't wait for the stream to be read.
+            data['window'] = self.stream_window
+            future = AsyncStream(self, data['id'])
+        else:
+            future = asyncio.Future(loop = self._loop)
+        self._requests[data['id']] = future
+        future.add_done_callback(
+            lambda future: self._forget_request(data['id'], future))
+        self.write(json.dumps(data, self))
+        return future
+
+    def _forget_request(self, req_id, future):
+        """
+            Done callback of the futures returned by *proxy*: if they were
+            cancelled (also by *asyncio.wait_for*), the other end is told to
+            drop the call.
+        """
+        if future.cancelled() and self._requests.pop(req_id, None):
+            self._send_cancel(req_id)
+
+    def load_object(self, obj):
+        """
+            *Connection.load_object*, except for uploads: iterating them 
+            would block the loop.
+        """
+        if '__streamreference__' in obj:
+            raise ValueError("AsyncConnection can't receive uploads")
+        return Connection.load_object(self, obj)
+
+    def _dispatch_chunk(self, item):
+        """
+            Delivers a chunk of a streamed result to its *AsyncStream*. 
+            Chunks whose id isn't a stream call are ignored.
+        """
+        future = self._requests.get(item['id'], None)
+        if isinstance(future, AsyncStream) and not future.done():
+            future.addchunk(item['chunk'])
+
+    def _dispatch_response(self, item):
+        """
+            Resolves the future waiting for the response *item*.
+        """
+        future = self._requests.pop(item['id'], None)
+        if future is None or future.done():
+            return
+        if item.get('error', None) is not None:
+            future.set_exception(ServerError(item['error']))
+        else:
+            future.set_result(map_result(item))
+
+    def _deferred_result(self, request, call, result):
+        """
+            Runs coroutines returned by handler methods in a new task, which
+            sends the response when they finish.
+        """
+        if not _isawaitable(result):
+            return False
+        request['_task'] = asyncio.ensure_future(
+            self._finish_call(request, call, result), loop = self._loop)
+        return True
+
+    def _dispatch_cancel(self, ids):
+        """
+            *Connection._dispatch_cancel*, which also cancels the tasks of 
+            the handler coroutines running those calls.
+        """
+        Connection._dispatch_cancel(self, ids)
+        for req_id in ids:
+            task = self._calls.get(req_id, {}).get('_task', None)
+            if task is not None:
+                task.cancel()
+
+    @asyncio.coroutine
+    def _finish_call(self, request, call, awaitable):
+        """
+            Waits for the result of a handler coroutine and sends it.
+        """
+        req_id = request.get("id", None)
+        try:
+            result = yield From(awaitable)
+            response = {'result': result, 'error': None, 'id': req_id}
+        except asyncio.CancelledError:
+            self._calls.pop(req_id, None)
+            return
+        except ServerError, exc:
+            response = {'result': None, 'error': '%s' % (exc), 'id': req_id}
+        except Exception:
+            error = self._method_error(call)
+            response = {'result': None, 'error': error, 'id': req_id}
+        if req_id is not None and self.connection_status == "open":
+            self._send_response(response)
+
+    def write(self, data, timeout = None):
+        """
+            Writes the line *data* to the transport. It never blocks: see
+            *drain* for flow control. The *write_policy* doesn't apply.
+        """
+        self._write(data)
+
+    def _write(self, data):
+        """
+            Writes the line *data* to the transport: the messages that the
+            connection writes by itself go the same way as the others.
+        """
+        assert('\n' not in data)
+        if self._debug_socket:
+            print "<:%d:" % len(data), data[:130]
+        data = str(data)
+        self._writer.write(data + '\n')
+        self._stats['messages_sent'] += 1
+        self._stats['bytes_sent'] += len(data) + 1
+
+    @asyncio.coroutine
+    def drain(self):
+        """
+            Coroutine that waits until the write buffer of the transport is
+            below its limit.
+        """
+        yield From(self._writer.drain())
+
+    def dispatch_until_empty(self):
+        """
+            The reading task dispatches every message as soon as the loop
+            gets it, so none is left to dispatch: it returns 0, like 
+            *Connection.dispatch_until_empty* with a reading thread. It 
+            starts the task if it wasn't.
+        """
+        if self.connection_status == "open":
+            self.start()
+        return 0
+
+    @asyncio.coroutine
+    def read_and_dispatch(self, timeout=None, thread=True, condition=None):
+        """
+            Coroutine that waits until the reading task (started if needed)
+            dispatches the next message, for *timeout* seconds at most if it
+            is given. Returns True once it did, and False if the time ran 
+            out or the connection was closed. 
+            
+            As *Connection.read_and_dispatch*, it returns False at once if 
+            *condition* is given and returns False. *thread* is ignored: 
+            everything runs on the loop.
+        """
+        if condition is not None and not condition():
+            raise Return(False)
+        if self.connection_status != "open":
+            raise Return(False)
+        self.start()
+        waiter = asyncio.Future(loop = self._loop)
+        self._dispatch_waiters.append(waiter)
+        try:
+            dispatched = yield From(asyncio.wait_for(waiter, timeout, 
+                loop = self._loop))
+        except asyncio.TimeoutError:
+            dispatched = False
+        raise Return(dispatched)
+
+    def close(self):
+        """
+            Closes the connection. Calls waiting for a response fail with
+            *exceptions.EofError*.
+        """
+        if self.connection_status == "closed": return
+        self.connection_status = "closed"
+        try:
+            self.handler._shutdown()
+        except Exception:
+            print "Error when shutting down the handler:"
+            print traceback.format_exc()
+        requests, self._requests = self._requests, {}
+        for future in requests.values():
+            if not future.done():
+                future.set_exception(EofError("Connection closed"))
+        self._wake_waiters(False)
+        self._writer.close()
+
+
+class AsyncStream(asyncio.Future):
+    """
+        Returned by the *stream* proxy of an *AsyncConnection*: a future 
+        that is done when the whole result has arrived, whose items are 
+        read in chunks as they arrive::
+
+            stream = conn.stream.export_rows(2010)
+            while True:
+                rows = yield From(stream.read())
+                if not rows:
+                    break
+                process(rows)
+
+        The other end sends no more than *Connection.stream_window* chunks
+        ahead of the ones read. Results that don't come streamed (because 
+        the method doesn't return a generator, or the peer can't stream) 
+        are read as a single chunk. Cancelling the future cancels the call.
+
+        **request_id**
+            Id of the call.
+    """
+    def __init__(self, conn, request_id):
+        asyncio.Future.__init__(self, loop = conn._loop)
+        self.request_id = request_id
+        self._conn = conn
+        self._chunks = deque()
+        self._consumed = 0
+        self._result_read = False
+        self._arrived = asyncio.Event(loop = conn._loop)
+        self.add_done_callback(lambda future: self._arrived.set())
+
+    def addchunk(self, items):
+        """
+            Method used by the connection to deliver a chunk of the result,
+            before the response that ends it.
+        """
+        self._chunks.append(items)
+        self._arrived.set()
+
+    @asyncio.coroutine
+    def read(self):
+        """
+            Coroutine that returns the next chunk of items (a list), waiting
+            for it, or an empty list once everything was read. Raises 
+            *exceptions.ServerError* if the call failed, after the chunks 
+            sent before the error.
+        """
+        while not self._chunks and not self.done():
+            self._arrived.clear()
+            yield From(self._arrived.wait())
+        if self._chunks:
+            chunk = self._chunks.popleft()
+            self._consumed += 1
+            if not self.done():
+                self._conn._ack_stream(self.request_id, self._consumed)
+            raise Return(chunk)
+        result = self.result() # raises the error, if any.
+        if self._result_read or result is None: # None: it was streamed.
+            raise Return([])
+        self._result_read = True
+        raise Return(list(result))
+
+
+class AsyncServer(object):
+    """
+        Accepts connections on an asyncio event loop, creating an
+        *AsyncConnection* for each one. Usually created by *createserver*.
+
+        **handler_factory**
+            Class (object type) to instantiate to publish methods for incoming
+            connections. Should be an inherited class of
+            *bjsonrpc.handlers.BaseHandler*
+
+        **loop** = None
+            Event loop to use. By default, the current one.
+    """
+    def __init__(self, handler_factory, loop = None):
+        self._handler = handler_factory
+        self._loop = loop or asyncio.get_event_loop()
+        self._server = None
+        self._debug_socket = False
+        self.connections = set()
+
+    @asyncio.coroutine
+    def start(self, host = "127.0.0.1", port = 10123, **kwargs):
+        """
+            Coroutine that starts listening on *host* and *port*. Extra
+            arguments go to *loop.create_server*.
+        """
+        self._server = yield From(asyncio.start_server(
+            self._client_connected, host, port, loop = self._loop,
+            limit = AsyncConnection.max_line, **kwargs))
+
+    @property
+    def sockets(self):
+        """ Listening sockets of the server """
+        return self._server.sockets
+
+    def _client_connected(self, reader, writer):
+        """
+            Creates the connection for a new client and starts serving it.
+        """
+        conn = AsyncConnection(reader, writer,
+                address = writer.get_extra_info('peername'),
+                handler_factory = self._handler, loop = self._loop)
+        conn._debug_socket = self._debug_socket
+        self.connections.add(conn)
+        task = conn.start()
+        task.add_done_callback(lambda task: self.connections.discard(conn))
+
+    def close(self):
+        """
+            Stops listening and closes every connection.
+        """
+        if self._server is not None:
+            self._server.close()
+        for conn in list(self.connections):
+            conn.close()
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        """
+            Coroutine that waits until the server is closed.
+        """
+        if self._server is not None:
+            yield From(self._server.wait_closed())
+
+
+@asyncio.coroutine
+def createserver(host="127.0.0.1", port=10123,
+    handler_factory=bjsonrpc.handlers.NullHandler, loop=None):
+    """
+        Coroutine that creates an *AsyncServer* listening on *host* and
+        *port*. It is the asyncio version of *bjsonrpc.createserver*::
+
+            server = yield From(bjsonrpc.aio.createserver(
+                handler_factory=MyHandler))
+    """
+    server = AsyncServer(handler_factory, loop = loop)
+    yield From(server.start(host, port))
+    raise Return(server)
+
+
+@asyncio.coroutine
+def connect(host="127.0.0.1", port=10123,
+    handler_factory=bjsonrpc.handlers.NullHandler, loop=None):
+    """
+        Coroutine that connects to *host* and *port* and returns a started
+        *AsyncConnection*. It is the asyncio version of
+        *bjsonrpc.connect*::
+
+            conn = yield From(bjsonrpc.aio.connect("rpc.host.net"))
+            print (yield From(conn.call.some_method_in_server_side()))
+    """
+    reader, writer = yield From(asyncio.open_connection(host, port,
+        loop = loop, limit = AsyncConnection.max_line))
+    conn = AsyncConnection(reader, writer, address = (host, port),
+        handler_factory = handler_factory, loop = loop)
+    conn.start()
+    raise Return(conn)
@@ -32,16 +32,25 @@
 
 """
 
-import socket, traceback, sys, threading
-from types import MethodType, FunctionType
+import socket, traceback, sys, threading, itertools, time, errno, struct
+import zlib
+from collections import deque
+from Queue import Full
+from types import MethodType, FunctionType, GeneratorType
 
 from bjsonrpc.proxies import Proxy
-from bjsonrpc.request import Request
-from bjsonrpc.exceptions import EofError, ServerError
+from bjsonrpc.request import Request, Stream, Batch
+from bjsonrpc.exceptions import EofError, ServerError, QueueFullError
 from bjsonrpc import bjsonrpc_options
 
 import bjsonrpc.jsonlib as json
-import select
+import bjsonrpc.packlib as packlib
+from bjsonrpc.poller import wait_fileno, EVENT_READ, EVENT_WRITE
+from bjsonrpc.workers import get_default_pool, run_in_process
+from bjsonrpc.timers import get_default_wheel
+
+_frame_header = struct.Struct("!BI") # flags, length of the payload.
+_FLAG_ZLIB = 1 # the payload is compressed with zlib.
 
 class RemoteObject(object):
     """
@@ -85,6 +94,13 @@ class RemoteObject(object):
             tells the server to not response even if there's any error in the call.
             Returns *None*.
         
+        **map**
+            Map Proxy. Calls a method once for each item of a list of 
+            arguments, in a single message (see *Connection.map*).
+        
+        **stream**
+            Stream Proxy. Returns a *request.Stream* to iterate over the 
+            result as it arrives (see *Connection.stream*).
         
     """
     
@@ -92,6 +108,8 @@ class RemoteObject(object):
     call = None 
     method = None 
     notify = None 
+    map = None 
+    stream = None 
     
     @property
     def connection(self): 
@@ -107,6 +125,8 @@ class RemoteObject(object):
         self.call = Proxy(self._conn, obj=self.name, sync_type=0)
         self.method = Proxy(self._conn, obj=self.name, sync_type=1)
         self.notify = Proxy(self._conn, obj=self.name, sync_type=2)
+        self.map = Proxy(self._conn, obj=self.name, sync_type=3)
+        self.stream = Proxy(self._conn, obj=self.name, sync_type=4)
     
     def __del__(self):
         self._close()
@@ -129,6 +149,86 @@ class RemoteObject(object):
         return self._close()
         
         
+class Upload(object):
+    """
+        Iterator over an argument that the other end streams: handler 
+        methods get it in place of the generators passed to the proxies::
+        
+            # client side
+            conn.call.ingest(row for row in open("data.csv"))
+            
+            # server side
+            def ingest(self, rows):
+                for row in rows:
+                    store(row)
+        
+        It yields the items as they arrive, waiting for them. Only a few 
+        chunks are sent ahead of the ones consumed (see 
+        *Connection.upload_window*), so neither end holds the whole 
+        argument in memory.
+        
+        If the iterator fails on the other end, the iteration raises 
+        *exceptions.ServerError* after the items sent before the failure. 
+        It can only be iterated during the call: once the method returns,
+        the other end is told to stop sending the rest of the items.
+        
+        **name**
+            Identifier of the upload, chosen by the other end.
+    """
+    def __init__(self, conn, name):
+        self._conn = conn
+        self.name = name
+        self.chunks = deque()
+        self.consumed = 0
+        self.finished = False
+        self.error = None
+        self._cond = threading.Condition(threading.Lock())
+
+    def addchunk(self, items):
+        """
+            Method used by Connection instance to deliver a chunk of items.
+        """
+        self._cond.acquire()
+        try:
+            self.chunks.append(items)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def finish(self, error = None):
+        """
+            Method used by Connection instance when the other end has sent 
+            every item, or failed with *error*.
+        """
+        self._cond.acquire()
+        try:
+            self.finished = True
+            self.error = error
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def __iter__(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while not self.chunks and not self.finished:
+                    if self._conn.connection_status != "open":
+                        raise EofError("Connection closed during an upload")
+                    self._cond.wait(1)
+                if not self.chunks:
+                    break
+                chunk = self.chunks.popleft()
+                self.consumed += 1
+            finally:
+                self._cond.release()
+            self._conn._ack_upload(self.name, self.consumed)
+            for item in chunk:
+                yield item
+        
+        if self.error is not None:
+            raise ServerError(self.error)
+        
 
 class Connection(object): # TODO: Split this class in simple ones
     """ 
@@ -147,6 +247,14 @@ class Connection(object): # TODO: Split this class in simple ones
             It defaults to *NullHandler* meaning no public methods will be 
             avaliable to the other end.
 
+        **server** = None
+            *bjsonrpc.server.Server* whose event loop drives this connection.
+            The socket is then used in non-blocking mode, and outgoing data
+            is buffered and sent by the server loop when the socket is 
+            writable, instead of by a writing thread. Client connections
+            leave it as None: they start their writing thread on the first
+            write.
+
         **Members:**
 
         **call** 
@@ -162,14 +270,124 @@ class Connection(object): # TODO: Split this class in simple ones
             tells the server to not response even if there's any error in the call.
             Returns *None*.
         
+        **map**
+            Map Proxy. It calls a method once for each item of a list of 
+            arguments, sending the method name and the whole list in one 
+            message, and returns the list of results::
+            
+                conn.map.add2([(1, 2), (3, 4), {'num1': 5, 'num2': 6}])
+            
+            Each item is a list (or tuple) of positional arguments or a 
+            dictionary of keyword arguments. The results of the calls that 
+            failed are *exceptions.ServerError* instances instead of values.
+        
+        **stream**
+            Stream Proxy. It returns a *request.Stream*, which yields the 
+            items of the result as they arrive::
+            
+                for row in conn.stream.export_rows(2010):
+                    process(row)
+            
+            Handler methods stream their result by returning a generator:
+            its items are sent in chunks of *stream_chunk_size* items, from a
+            thread of the worker pool, which waits while more than 
+            *max_stream_pending* bytes of the stream are waiting to be sent.
+            Called through the other proxies, generators are sent as lists.
+        
+        **stream_window**
+            Connections with a reading thread (see *start_reader*) don't 
+            wait for streams to be iterated to read the next message, so 
+            their stream calls ask the other end to send no more than 
+            *stream_window* chunks ahead of the ones iterated: the 
+            *request.Stream* acknowledges them as it goes.
+        
+        **upload_window**
+            Generators passed as arguments to the proxies are sent in chunks
+            of *stream_chunk_size* items, by a thread of the worker pool, 
+            while the method runs; it gets an *Upload* to iterate over them.
+            No more than *upload_window* chunks are sent ahead of the ones 
+            the method has consumed, and the rest isn't sent once the method
+            returns. Other iterators are not uploaded: wrap them in a 
+            generator expression.
+        
+        **max_uploads**
+            Uploads received that can be open at once. Calls that would 
+            open more are answered with an error. Uploads in messages that
+            aren't calls are refused.
+        
+        **framings**, **codecs**
+            Framings and codecs this end accepts when the other end negotiates
+            them (see *negotiate*), in order of preference. 'msgpack' is only
+            in *codecs* when the *msgpack* library is installed: the 
+            implementation in pure Python of *bjsonrpc.packlib* is slower 
+            than the JSON codecs. Add it to accept it anyway.
+        
+        **autobatch_window**, **autobatch_size**
+            When *autobatch_window* is not zero, the calls made through the
+            proxies within that many microseconds (from any thread) are sent
+            together in one batch message, or as soon as *autobatch_size* of 
+            them are waiting. Synchronous calls send the pending ones at once,
+            along with themselves. The defaults come from *bjsonrpc_options*.
+        
+        **process_timeout**
+            Seconds that the handler methods marked with 
+            *handlers.process_method* have to finish before their calls are
+            answered with an error (see *workers.run_in_process*), or None 
+            for no limit. Calls with a deadline have until it passes at 
+            most. The default comes from *bjsonrpc_options*.
+        
+        **reader_thread**
+            Thread that reads the messages received, if *start_reader* was
+            called. None otherwise: then the threads waiting for a response
+            read the socket themselves, one at a time.
+        
+        **write_high_water**, **write_low_water**
+        **write_high_messages**, **write_low_messages**
+            Watermarks of the messages written and not sent yet, in bytes 
+            and in number of messages (None: no limit). Once either high 
+            watermark is reached, *write* applies the *write_policy* until
+            the queue is back below the low ones.
+        
+        **write_policy**
+            What *write* does above the high watermark: 'block' waits for the
+            queue to drain (for *timeout* seconds at most, then it raises
+            *exceptions.QueueFullError*), 'error' raises QueueFullError at 
+            once, and 'shed' drops the notifications (see **notify**) and 
+            blocks for everything else. It only applies to the calls and 
+            notifications of this end: responses, and the other messages
+            the connection sends by itself, are always queued. The threads
+            that read this connection and the writers of the connections of
+            a server never block: the server loop stops reading from the 
+            connection instead, until the queue drains (see 
+            *_wait_write_room*). The defaults come from *bjsonrpc_options*.
+        
     """
     _maxtimeout = {
         'read' : 60,    # default maximum read timeout.
         'write' : 60,   # default maximum write timeout.
     }
-    call = None 
+    _min_readsize = 4096        # initial (and minimum) size of each recv.
+    _max_readsize = 1 << 20     # recv size never grows beyond this.
+    _coalesce_size = 1 << 16    # join chunks smaller than this to send them.
+    _max_iovecs = 1024          # max chunks per sendmsg call (IOV_MAX).
+    max_frame_size = 1 << 30    # biggest message accepted in length framing.
+    max_stream_pending = 1 << 20 # bytes of a streamed result left unsent.
+    upload_window = 8           # chunks of an upload sent ahead of the reader.
+    max_uploads = 64            # uploads received open at once.
+    stream_window = 8           # same for streams, with a reading thread.
+    framings = ['length', 'line'] # framings accepted, in order of preference.
+    codecs = (packlib.backend == "msgpack" and ['msgpack', 'json'] 
+        or ['json'])              # codecs accepted, in order of preference.
+    compressions = ['zlib']       # compressions accepted, by preference.
+    _codec_modules = {
+        'json': json,
+        'msgpack': packlib,
+    }
+    call = None
     method = None 
     notify = None 
+    map = None 
+    stream = None 
     
     @classmethod
     def setmaxtimeout(cls, operation, value):
@@ -211,36 +429,140 @@ class Connection(object): # TODO: Split this class in simple ones
         return cls._maxtimeout[operation]
     
     
-    def __init__(self, sck, address = None, handler_factory = None):
+    def __init__(self, sck, address = None, handler_factory = None, 
+            server = None):
         self._debug_socket = False
         self._debug_dispatch = False
-        self._buffer = ''
+        self._rbuffer = bytearray() # allocated on the first read
+        self._rstart = 0    # first byte not yet returned by _readn
+        self._rend = 0      # end of the received data in _rbuffer
+        self._rscan = 0     # where the next newline search starts
+        self._readsize = self._min_readsize
+        self._rframing = 'line' # framing of the messages we receive
+        self._wframing = 'line' # framing of the messages we send
+        self._rcodec = json     # codec of the messages we receive
+        self._wcodec = json     # codec of the messages we send
+        self._wcompress = False # compress the big messages we send
         self._sck = sck
+        self._server = server
+        if server is not None:
+            sck.setblocking(0)
+        self._sck_timeout = sck.gettimeout()
+        self._io_timeout = None # timeout wanted by the event-driven mode
         self._address = address
         self._handler = handler_factory 
         self.connection_status = "open"
+        self._closing = False    # set by the first call to close()
+        self._close_lock = threading.Lock()
         if self._handler: 
             self.handler = self._handler(self)
             
         self._id = 0
         self._requests = {}
         self._objects = {}
+        self._uploads = {}       # Upload objects of the calls received
+        self._new_uploads = []   # the ones created by the message being read
+        self._upload_acks = {}   # chunks consumed of each upload we send
+        self._stream_acks = {}   # same for the windowed streams we send
+        self._upload_cond = threading.Condition(threading.Lock()) # both
+        self._calls = {}         # calls received and not answered yet, by id
+        self._local = threading.local() # .call: the one run by each thread
 
         self.scklock = threading.Lock()
         self.call = Proxy(self, sync_type=0)
         self.method = Proxy(self, sync_type=1)
         self.notify = Proxy(self, sync_type=2)
-        self._wbuffer = []
+        self.map = Proxy(self, sync_type=3)
+        self.stream = Proxy(self, sync_type=4)
+        self._wbuffer = deque()  # chunks (strings) waiting to be sent
+        self._woffset = 0        # bytes of _wbuffer[0] already sent
+        self._wpending = 0       # total bytes waiting in _wbuffer
+        self._wsizes = deque()   # size of each message in _wbuffer
+        self._wsent = 0          # bytes of the first one already sent
+        self._wqueued = 0        # bytes waiting in write_thread_queue
+        self._wpaused = False    # above the high watermark (see write)
+        self._wroom = threading.Condition(threading.RLock()) # for _wpaused
         self.write_lock = threading.RLock()
+        self._wdrained = threading.Condition(self.write_lock)
         self.read_lock = threading.RLock()
         self.getid_lock = threading.Lock()
         self.reading_event = threading.Event()
         self.threaded = bjsonrpc_options['threaded']
-        self.write_thread_queue = []
+        self.worker_pool = None # None: the one from get_default_pool()
+        self.parallel_batches = bjsonrpc_options['parallel_batches']
+        self.process_timeout = bjsonrpc_options['process_timeout']
+        self.write_cork = bjsonrpc_options['write_cork']
+        self.stream_chunk_size = bjsonrpc_options['stream_chunk_size']
+        self.compress_threshold = bjsonrpc_options['compress_threshold']
+        self.compress_level = bjsonrpc_options['compress_level']
+        self.write_high_water = bjsonrpc_options['write_high_water']
+        self.write_low_water = bjsonrpc_options['write_low_water']
+        self.write_high_messages = bjsonrpc_options['write_high_messages']
+        self.write_low_messages = bjsonrpc_options['write_low_messages']
+        self.write_policy = bjsonrpc_options['write_policy']
+        self._stats = {
+            'messages_sent': 0,
+            'send_calls': 0,
+            'bytes_sent': 0,
+            'messages_compressed': 0,
+            'bytes_uncompressed': 0,
+            'bytes_compressed': 0,
+            'notifications_shed': 0,
+            'calls_rejected': 0,
+        }
+        self.write_thread_queue = deque()
         self.write_thread_semaphore = threading.Semaphore(0)
-        self.write_thread = threading.Thread(target=self.write_thread)
-        self.write_thread.daemon = True
-        self.write_thread.start()
+        self.write_thread = None # started by the first write()
+        self.reader_thread = None # started by start_reader()
+        self.autobatch_window = bjsonrpc_options['autobatch_window']
+        self.autobatch_size = bjsonrpc_options['autobatch_size']
+        self._autobatch_items = [] # serialized calls waiting to be sent
+        self._autobatch_cond = threading.Condition(threading.Lock())
+        self._autobatch_thread = None # started by the first batched call
+
+    def getstats(self):
+        """
+            Returns a dictionary with the I/O counters of this connection:
+            
+            **messages_sent**
+                Number of messages (lines) written.
+            
+            **send_calls**
+                Number of send syscalls used to write them.
+            
+            **bytes_sent**
+                Total bytes sent through the socket.
+            
+            **messages_per_send**
+                Average number of messages sent on each syscall.
+            
+            **messages_compressed**
+                Number of messages compressed (see *negotiate*).
+            
+            **bytes_uncompressed**, **bytes_compressed**
+                Size of those messages before and after compression.
+            
+            **notifications_shed**
+                Number of notifications dropped above the high watermark 
+                (see *write_policy*).
+            
+            **calls_rejected**
+                Number of calls received and answered with an error because
+                the queue of the worker pool was full (see *_submit*).
+            
+            **write_queue_bytes**, **write_queue_messages**
+                Size of the messages written and not sent yet.
+        """
+        self.write_lock.acquire()
+        try:
+            stats = dict(self._stats)
+            (stats['write_queue_bytes'], 
+                stats['write_queue_messages']) = self._write_queue_size()
+        finally:
+            self.write_lock.release()
+        stats['messages_per_send'] = (
+            float(stats['messages_sent']) / max(stats['send_calls'], 1))
+        return stats
 
     @property
     def socket(self): 
@@ -296,15 +618,25 @@ class Connection(object): # TODO: Split this class in simple ones
             method = obj.get_method(methodname)
             return method
         
+        if '__streamreference__' in obj:
+            # Registered if the message is a call (see _open_uploads).
+            upload = Upload(self, obj['__streamreference__'])
+            self._new_uploads.append(upload)
+            return upload
+        
         return obj
         
     def addrequest(self, request):
         """
             Adds a request to the queue of requests waiting for response.
+            If it has a deadline, the timer wheel expires it then.
         """
         assert(isinstance(request, Request))
         assert(request.request_id not in self._requests)
         self._requests[request.request_id] = request
+        if request.deadline is not None:
+            request._timer = get_default_wheel().add(request.deadline, 
+                request.expire)
     
     def dump_object(self, obj):
         """
@@ -382,9 +714,16 @@ class Connection(object): # TODO: Split this class in simple ones
     def _dispatch_method(self, request):
         """
             Processes one request.
+            
+            Returns the response (a dictionary) or None if there's nothing to
+            send: for notifications, and for results which will be sent
+            later (see *_deferred_result*).
         """
         # TODO: Simplify this function or split it in small ones.
         req_id = request.get("id", None)
+        if request.get("_cancelled", False) or self._expired(request):
+            self._calls.pop(req_id, None)
+            return None # The caller has given up: don't run it.
         req_method = request.get("method")
         req_args = request.get("params", [])
         if type(req_args) is dict: 
@@ -396,6 +735,15 @@ class Connection(object): # TODO: Split this class in simple ones
         if req_kwargs: 
             req_kwargs = dict((str(k), v) for k, v in req_kwargs.iteritems())
             
+        if req_method == '__negotiate__':
+            return self._dispatch_negotiate(request, req_kwargs)
+            
+        if req_method == '__cancel__':
+            return self._dispatch_cancel(req_args)
+            
+        if req_method == '__ack__':
+            return self._dispatch_ack(*req_args)
+            
         if '.' in req_method: # local-object.
             objectname, req_method = req_method.split('.')[:2]
             if objectname not in self._objects: 
@@ -417,45 +765,436 @@ class Connection(object): # TODO: Split this class in simple ones
             req_object = self.handler
             
         if req_object:
+            previous = getattr(self._local, 'call', None)
+            self._local.call = request # see is_cancelled
+            try:
+                if 'mapparams' in request:
+                    return self._dispatch_map(request, req_object, req_method)
+                call = (req_object, req_method, req_args, req_kwargs)
+                try:
+                    req_function = req_object.get_method(req_method)
+                    if getattr(req_function, '_bjsonrpc_process', False):
+                        self._dispatch_to_process(request, req_object, 
+                            req_function.__name__, req_args, req_kwargs)
+                        return None
+                    result = req_function(*req_args, **req_kwargs)
+                except ServerError, exc:
+                    if req_id is not None: 
+                        return {'result': None, 'error': '%s' % (exc), 'id': req_id}
+                except Exception:
+                    error = self._method_error(call)
+                    if req_id is not None: 
+                        return {
+                            'result': None, 
+                            'error': error, 
+                            'id': req_id
+                            }
+                else:
+                    if self._deferred_result(request, call, result):
+                        return None
+            finally:
+                self._local.call = previous
+        
+        if req_id is None: 
+            return None
+        return {'result': result, 'error': None, 'id': req_id}
+
+    def _dispatch_cancel(self, ids):
+        """
+            Processes a cancellation sent by *request.Request.cancel*: the 
+            calls with those *ids* don't run if they haven't started yet, 
+            and *is_cancelled* tells the ones running to stop. Their 
+            responses aren't sent.
+        """
+        for req_id in ids:
+            request = self._calls.get(req_id, None)
+            if request is not None:
+                request['_cancelled'] = True
+        self._upload_cond.acquire()
+        try:
+            for req_id in ids:
+                self._stream_acks.pop(req_id, None)
+            self._upload_cond.notify_all()
+        finally:
+            self._upload_cond.release()
+        return None
+
+    def _dispatch_ack(self, req_id, consumed):
+        """
+            Processes an acknowledgement sent by a *request.Stream*: it has
+            iterated *consumed* chunks of the stream *req_id*, so more can 
+            be sent (see *stream_window*).
+        """
+        self._upload_cond.acquire()
+        try:
+            if req_id in self._stream_acks:
+                self._stream_acks[req_id] = consumed
+                self._upload_cond.notify_all()
+        finally:
+            self._upload_cond.release()
+        return None
+
+    def is_cancelled(self):
+        """
+            *New in bjsonrpc v0.2.2* 
+            
+            Returns True if the call being run by the current thread was
+            cancelled by the other end (see *request.Request.cancel*), or its
+            deadline has passed (see *proxies.Proxy.with_deadline*). Handler
+            methods that take long can check it now and then, and give up::
+            
+                def crunch(self, items):
+                    for item in items:
+                        if self._conn.is_cancelled():
+                            return None
+                        ...
+            
+            The responses of cancelled calls aren't sent, and streamed
+            generators are stopped between two chunks.
+        """
+        request = getattr(self._local, 'call', None)
+        if request is None:
+            return False
+        return request.get("_cancelled", False) or self._expired(request)
+
+    def _expired(self, request):
+        """
+            True if the deadline of the call *request* has passed.
+        """
+        expires = request.get("_expires", None)
+        return expires is not None and time.time() > expires
+
+    def _dispatch_negotiate(self, request, offered):
+        """
+            Answers the negotiation started by the other end with *negotiate*:
+            picks the first option it offers that we accept, sends the 
+            response, and switches to the chosen options. The messages after
+            the response use them.
+        """
+        chosen = self._choose_options(offered)
+        req_id = request.get("id", None)
+        if req_id is not None:
+            self._send_response({'result': chosen, 'error': None, 'id': req_id})
+        self._apply_options(chosen)
+        return None
+
+    def _choose_options(self, offered):
+        """
+            Given the options *offered* by the other end (a dictionary with a
+            list of preferences for each one), returns the ones chosen.
+        """
+        chosen = {'framing': 'line', 'codec': 'json', 'compression': None}
+        for framing in offered.get('framing', []):
+            if framing in self.framings:
+                chosen['framing'] = framing
+                break
+        if chosen['framing'] != 'line': 
+            # binary codecs and compression need length framing.
+            for codec in offered.get('codec', []):
+                if codec in self.codecs:
+                    chosen['codec'] = codec
+                    break
+            for compression in offered.get('compression', []):
+                if compression in self.compressions:
+                    chosen['compression'] = compression
+                    break
+        return chosen
+
+    def _apply_options(self, options):
+        """
+            Switches to the negotiated *options*. It must be called from the
+            reading thread, before reading the next message.
+        """
+        framing = options.get('framing', 'line')
+        codec = self._codec_modules[options.get('codec', 'json')]
+        compress = options.get('compression', None) == 'zlib'
+        self._rframing = framing
+        self._rcodec = self._wcodec = codec
+        self._set_write_framing(framing, compress)
+
+    def negotiate(self, framing = None, codec = None, compression = None):
+        """
+            *New in bjsonrpc v0.2.2* 
+            
+            Agrees with the other end on protocol options. For each option,
+            give the list of values wanted, by preference; the other end 
+            chooses. Both ends switch to the result, which is returned as a 
+            dictionary.
+            
+            **framing** = None
+                How messages are delimited: 'line' (newline-delimited JSON, 
+                the default) or 'length' (each message is preceded by its 
+                length, so the reader doesn't scan for newlines and messages
+                may contain any byte).
+            
+            **codec** = None
+                How messages are encoded: 'json' (the default) or 'msgpack' 
+                (MessagePack, see *bjsonrpc.packlib*), which is more compact
+                and faster for numeric data. Only negotiated along with 
+                'length' framing.
+            
+            **compression** = None
+                'zlib' to compress the messages of *compress_threshold* bytes
+                or more, with *compress_level*. Smaller messages are sent as
+                they are. Only negotiated along with 'length' framing.
+            
+            Peers without support for negotiation keep the defaults. Call it
+            right after connecting, before making other calls. 
+            *bjsonrpc.connect* does when asked to.
+        """
+        offered = {}
+        if framing is not None:
+            offered['framing'] = framing
+        if codec is not None:
+            offered['codec'] = codec
+        if compression is not None:
+            offered['compression'] = compression
+        data = self._build_request(1, '__negotiate__', (), offered)
+        req = Request(self, data, send = False)
+        chosen = {}
+        def switch(response):
+            # Runs in the reading thread, before reading anything else.
+            if response.get('error', None) is None:
+                chosen.update(response['result'])
+                self._apply_options(chosen)
+        req._on_response = switch
+        self.write(self.encode(data))
+        try:
+            req.value
+        except ServerError:
+            pass # The other end doesn't know how to negotiate.
+        return chosen
+
+    def _dispatch_map(self, request, req_object, req_method):
+        """
+            Processes a map request: calls the method once for each item of
+            its *mapparams* list, in order, and returns one response with the
+            list of results and the list of errors (None for the calls that
+            succeeded; left out if none failed).
+            
+            The calls run in this thread, even for methods marked with
+            *process_method*, and their results can't be deferred.
+        """
+        req_id = request.get("id", None)
+        try:
+            req_function = req_object.get_method(req_method)
+        except ServerError, exc:
+            if req_id is None: 
+                return None
+            return {'result': None, 'error': '%s' % (exc), 'id': req_id}
+        
+        results = []
+        errors = []
+        for params in request['mapparams']:
+            if self.is_cancelled():
+                break
+            if type(params) is dict:
+                req_args = []
+                req_kwargs = dict((str(k), v) for k, v in params.iteritems())
+            else:
+                req_args = params
+                req_kwargs = {}
             try:
-                req_function = req_object.get_method(req_method)
-                result = req_function(*req_args, **req_kwargs)
+                results.append(req_function(*req_args, **req_kwargs))
+                errors.append(None)
             except ServerError, exc:
-                if req_id is not None: 
-                    return {'result': None, 'error': '%s' % (exc), 'id': req_id}
+                results.append(None)
+                errors.append('%s' % (exc))
             except Exception:
-                etype, evalue, etb = sys.exc_info()
-                funargs = ", ".join(
-                    [repr(x) for x in req_args] +  
-                    ["%s=%s" % (k, repr(x)) for k, x in req_kwargs.iteritems()]
-                    )
-                if len(funargs) > 40: 
-                    funargs = funargs[:37] + "..."
-                
-                print "(%s) In Handler method %s.%s(%s) " % (
-                    req_object.__class__.__module__,
-                    req_object.__class__.__name__,
-                    req_method, 
-                    funargs
-                    )
-                print "\n".join([ "%s::%s:%d %s" % (
-                        filename, fnname, 
-                        lineno, srcline  ) 
-                    for filename, lineno, fnname, srcline 
-                    in traceback.extract_tb(etb)[1:] ])
-                print "Unhandled error: %s: %s" % (etype.__name__, evalue)
-                    
-                del etb
-                if req_id is not None: 
-                    return {
-                        'result': None, 
-                        'error': '%s: %s' % (etype.__name__, evalue), 
-                        'id': req_id
-                        }
+                call = (req_object, req_method, req_args, req_kwargs)
+                results.append(None)
+                errors.append(self._method_error(call))
         
         if req_id is None: 
             return None
-        return {'result': result, 'error': None, 'id': req_id}
+        response = {'result': results, 'error': None, 'id': req_id}
+        if errors.count(None) != len(errors):
+            response['errors'] = errors
+        return response
+
+    def _dispatch_to_process(self, request, req_object, name, args, kwargs):
+        """
+            Runs the handler method *name* in the process pool. The response
+            is sent when it finishes, or when *process_timeout* passes, from
+            a thread of the worker pool.
+        """
+        req_id = request.get("id", None)
+        timeout = self.process_timeout
+        expires = request.get("_expires", None)
+        if expires is not None:
+            left = max(expires - time.time(), 0)
+            timeout = left if timeout is None else min(timeout, left)
+        def done(ok, value):
+            if req_id is None or self.connection_status == "closed": 
+                return
+            if ok:
+                response = {'result': value, 'error': None, 'id': req_id}
+            else:
+                response = {'result': None, 'error': value, 'id': req_id}
+            # We are in the result thread of the process pool (or in the 
+            # one of the timers): it must not wait for the socket, nor for 
+            # the worker pool, as every other result would wait too.
+            pool = self.worker_pool or get_default_pool()
+            try:
+                pool.submit_nowait(self._send_response, response)
+            except Full:
+                self._send_response(response)
+        run_in_process(type(req_object), name, args, kwargs, done, timeout)
+
+    def _method_error(self, call):
+        """
+            Reports the exception being handled, raised by a handler method, 
+            and returns the error message to send to the other end.
+            
+            **call** is a (object, method name, args, kwargs) tuple.
+        """
+        req_object, req_method, req_args, req_kwargs = call
+        etype, evalue, etb = sys.exc_info()
+        funargs = ", ".join(
+            [repr(x) for x in req_args] +  
+            ["%s=%s" % (k, repr(x)) for k, x in req_kwargs.iteritems()]
+            )
+        if len(funargs) > 40: 
+            funargs = funargs[:37] + "..."
+        
+        print "(%s) In Handler method %s.%s(%s) " % (
+            req_object.__class__.__module__,
+            req_object.__class__.__name__,
+            req_method, 
+            funargs
+            )
+        print "\n".join([ "%s::%s:%d %s" % (
+                filename, fnname, 
+                lineno, srcline  ) 
+            for filename, lineno, fnname, srcline 
+            in traceback.extract_tb(etb)[1:] ])
+        print "Unhandled error: %s: %s" % (etype.__name__, evalue)
+            
+        del etb
+        return '%s: %s' % (etype.__name__, evalue)
+
+    def _deferred_result(self, request, call, result):
+        """
+            Hook called with the value returned by every handler method. 
+            Subclasses return True when *result* isn't the final value but
+            something that will produce it later: then they take care of
+            sending the response (see *_send_response*) when it's ready.
+            
+            **call** is a (object, method name, args, kwargs) tuple.
+            
+            Generators are sent by *_send_generator*: as a stream if the 
+            call asked for one, and as a list if not.
+        """
+        if type(result) is not GeneratorType or request.get("id") is None:
+            return False
+        if request.get("stream", False):
+            # It may wait for the socket: never in the reading thread.
+            if not self._submit(self._send_generator, request, call, result):
+                result.close()
+                self._reject(request)
+        else:
+            self._send_generator(request, call, result)
+        return True
+
+    def _send_generator(self, request, call, generator):
+        """
+            Sends the items of the *generator* returned by a handler method.
+            For stream calls, they are sent in chunk messages
+            ({"id": id, "chunk": [items]}) as they are produced, followed by
+            a response without result that tells how many were sent. An 
+            error ends the stream with an error response instead.
+            
+            If the call asks for a "window", no more than that many chunks
+            are sent ahead of the ones the other end acknowledged (see 
+            *stream_window*).
+        """
+        req_id = request["id"]
+        streaming = request.get("stream", False)
+        window = streaming and request.get("window", None)
+        items = []
+        count = 0
+        sent = 0
+        previous = None
+        caller = getattr(self._local, 'call', None)
+        self._local.call = request
+        if window:
+            self._upload_cond.acquire()
+            try:
+                self._stream_acks[req_id] = 0
+            finally:
+                self._upload_cond.release()
+        try:
+            for item in generator:
+                items.append(item)
+                if streaming and len(items) >= self.stream_chunk_size:
+                    if window:
+                        self._wait_window(self._stream_acks, req_id, sent, 
+                            window, self.is_cancelled)
+                    if (self.connection_status != "open" or 
+                            self.is_cancelled()):
+                        generator.close()
+                        self._calls.pop(req_id, None)
+                        return
+                    chunk = self.encode({'id': req_id, 'chunk': items})
+                    previous = self._write_stream(chunk, previous)
+                    count += len(items)
+                    sent += 1
+                    items = []
+            if streaming and items:
+                if window:
+                    self._wait_window(self._stream_acks, req_id, sent, 
+                        window, self.is_cancelled)
+                self._write(self.encode({'id': req_id, 'chunk': items}))
+                count += len(items)
+        except ServerError, exc:
+            response = {'result': None, 'error': '%s' % (exc), 'id': req_id}
+        except Exception:
+            error = self._method_error(call)
+            response = {'result': None, 'error': error, 'id': req_id}
+        else:
+            if streaming:
+                response = {'result': None, 'error': None, 'id': req_id,
+                    'streamed': count}
+            else:
+                response = {'result': items, 'error': None, 'id': req_id}
+        finally:
+            self._local.call = caller
+            if window:
+                self._upload_cond.acquire()
+                try:
+                    self._stream_acks.pop(req_id, None)
+                finally:
+                    self._upload_cond.release()
+        if self.connection_status == "open":
+            self._send_response(response)
+
+    def _write_stream(self, data, previous):
+        """
+            Writes a message of a stream and waits until the ones before it
+            are sent, so a generator faster than the socket doesn't fill the
+            memory. *previous* is what the last call returned (None the 
+            first time).
+        """
+        if self._server is not None:
+            self._write(data)
+            self.write_lock.acquire()
+            try:
+                while (self._wpending > self.max_stream_pending and 
+                        self.connection_status == "open"):
+                    self._wdrained.wait(1)
+            finally:
+                self.write_lock.release()
+            return None
+        
+        item = {
+            'write_data' : data,
+            'event' : threading.Event()
+        }
+        self._queue_write_item(item)
+        if previous is not None:
+            while not previous.wait(1) and self.connection_status == "open":
+                pass
+        return item['event']
 
     def dispatch_until_empty(self):
         """
@@ -466,22 +1205,32 @@ class Connection(object): # TODO: Split this class in simple ones
             
             This method will never block waiting. If there aren't 
             any more messages that can be processed, it returns.
+            
+            If the reading thread is running (see *start_reader*), it does
+            nothing: the messages are dispatched as soon as they arrive.
+            
+            Connections of a server also stop once their write queue reaches
+            its high watermark (see *write_policy*), so the loop can wait for
+            it to drain before reading more.
         """
-        ready_to_read = select.select( 
-                    [self._sck], # read
-                    [], [], # write, errors
-                    0 # timeout
-                    )[0]
+        if self._reader_running():
+            return 0
+        # Event-driven connections have non-blocking sockets: just try.
+        ready_to_read = (self._server is not None or 
+                    self._has_buffered_line() or 
+                    wait_fileno(self._sck.fileno(), EVENT_READ, 0))
                     
         if not ready_to_read: return 0
             
-        newline_idx = 0
         count = 0
-        while newline_idx != -1:
-            if not self.read_and_dispatch(timeout=0): 
+        while True:
+            if not self.read_and_dispatch(timeout=0):
                 break
             count += 1
-            newline_idx = self._buffer.find('\n')
+            if not self._has_buffered_line():
+                break
+            if self._server is not None and self._wpaused:
+                break
         return count
             
     def read_and_dispatch(self, timeout=None, thread=True, condition=None):
@@ -504,6 +1253,8 @@ class Connection(object): # TODO: Split this class in simple ones
         """
         self.read_lock.acquire()
         self.reading_event.set()
+        reading = getattr(self._local, 'reading', False)
+        self._local.reading = True # see _wait_write_room
         try:
             if condition:
                 if condition() == False:
@@ -516,13 +1267,35 @@ class Connection(object): # TODO: Split this class in simple ones
             data = self.read(timeout=timeout)
             if not data: 
                 return False 
+            item = None
             try:
-                item = json.loads(data, self)  
+                self._new_uploads = []
+                item = self.decode(data)
+                self._received(item)
+                uploads, self._new_uploads = self._new_uploads, []
+                if uploads and (type(item) is not dict or 
+                        'method' not in item):
+                    self._forget_uploads(uploads) # only calls take uploads.
+                    uploads = []
                 if type(item) is list: # batch call
-                    for i in item: 
-                        dispatch_item(i)
+                    self.dispatch_batch(item, thread)
                 elif type(item) is dict: # std call
-                    if 'result' in item:
+                    if uploads:
+                        # The method waits for messages we have to read.
+                        if not self._open_uploads(uploads):
+                            self._forget_uploads(uploads)
+                            self._reject(item, "TooManyUploads: more than "
+                                "%d uploads open" % self.max_uploads)
+                        elif not self._submit(self._dispatch_with_uploads, 
+                                item, uploads):
+                            self._forget_uploads(uploads)
+                            self._reject(item)
+                    elif ('result' in item or 'chunk' in item or 
+                            'upload' in item or item.get('method') in 
+                            ('__negotiate__', '__cancel__', '__ack__')):
+                        # negotiations change how we read the next message,
+                        # and cancellations and acknowledgements must not 
+                        # queue behind the calls.
                         self.dispatch_item_single(item)
                     else:
                         dispatch_item(item)
@@ -531,23 +1304,114 @@ class Connection(object): # TODO: Split this class in simple ones
                     return False
             except Exception:
                 print traceback.format_exc()
+                self._forget_calls(item) # they won't be answered.
                 return False
             return True
         finally:
+            self._local.reading = reading
             self.reading_event.clear()
             self.read_lock.release()
             
+    def _received(self, item):
+        """
+            Registers the calls of a message just received until they are
+            answered, so they can be cancelled (see *_dispatch_cancel*).
+            
+            Calls with a deadline carry the seconds the caller waits for them
+            (as "timeout"). This converts them to the time at which they 
+            expire, counting from now, when the message is received: calls
+            still waiting to start then aren't run (see *_dispatch_method*).
+        """
+        if type(item) is list:
+            for call in item:
+                self._received(call)
+            return
+        if type(item) is not dict or 'method' not in item:
+            return
+        if item.get('id', None) is not None:
+            self._calls[item['id']] = item
+        if 'timeout' in item:
+            try:
+                item['_expires'] = time.time() + float(item['timeout'])
+            except (TypeError, ValueError):
+                pass
+
+    def _forget_calls(self, item):
+        """
+            Undoes *_received* for the calls of *item*, a message which 
+            failed before they could be answered, so they don't stay in
+            *_calls* for the life of the connection.
+        """
+        if type(item) is list:
+            for call in item:
+                self._forget_calls(call)
+        elif type(item) is dict and item.get('id', None) is not None:
+            if self._calls.get(item['id'], None) is item:
+                self._calls.pop(item['id'], None)
+
     def dispatch_item_threaded(self, item):
         """
-            If threaded mode is activated, this function creates a new thread per
-            each item received and returns without blocking.
+            If threaded mode is activated, this function queues the item 
+            received to be processed by a thread of the worker pool, and
+            returns without blocking. If the queue of the pool is full, the
+            call is answered with an error instead (see *_submit*).
+            
+            The pool is *worker_pool*, or the one shared by every connection
+            (see *bjsonrpc.workers.get_default_pool*) if it is None.
+            
+            Connections with a reading thread (see *start_reader*) always use
+            the pool, so a slow method doesn't delay the responses.
         """
-        if self.threaded:
-            th1 = threading.Thread(target = self.dispatch_item_single, args = [ item ] )
-            th1.start()
+        if self.threaded or self.reader_thread is not None:
+            if not self._submit(self.dispatch_item_single, item):
+                self._reject(item)
             return True
         else:
             return self.dispatch_item_single(item)
+
+    def _submit(self, function, *args):
+        """
+            Queues *function(\*args)* to be run by a thread of the worker 
+            pool. Returns False if its queue is full and the caller is a 
+            thread that reads this connection, like the loop of a server:
+            those never wait for the pool, because its threads may be 
+            waiting for them to read a response.
+        """
+        pool = self.worker_pool or get_default_pool()
+        if not getattr(self._local, 'reading', False):
+            pool.submit(function, *args)
+            return True
+        try:
+            pool.submit_nowait(function, *args)
+        except Full:
+            self._stats['calls_rejected'] += 1
+            return False
+        return True
+
+    def _busy_response(self, item):
+        """
+            Returns the error response for a call received that couldn't be
+            queued to the worker pool (see *_submit*), or None if it is a 
+            notification.
+        """
+        if type(item) is not dict or item.get('id', None) is None:
+            return None
+        return {
+            'result': None, 
+            'error': "ServerBusy: the worker pool is full", 
+            'id': item['id']
+            }
+
+    def _reject(self, item, error = None):
+        """
+            Answers a call that couldn't be queued to the worker pool, or 
+            run for another reason given as *error*.
+        """
+        response = self._busy_response(item)
+        if response is not None:
+            if error is not None:
+                response['error'] = error
+            self._send_response(response)
         
     
     def dispatch_item_single(self, item):
@@ -555,6 +1419,20 @@ class Connection(object): # TODO: Split this class in simple ones
             Given a JSON item received from socket, determine its type and 
             process the message.
         """
+        try:
+            response = self._dispatch_item(item)
+        except Exception:
+            self._forget_calls(item)
+            raise
+        if response is not None:
+            self._send_response(response)
+        return True
+
+    def _dispatch_item(self, item):
+        """
+            Processes one item received. Returns the response to send, if
+            any.
+        """
         assert(type(item) is dict)
         response = None
         if 'id' not in item: 
@@ -563,102 +1441,648 @@ class Connection(object): # TODO: Split this class in simple ones
         if 'method' in item: 
             response = self._dispatch_method(item)
         elif 'result' in item: 
-            assert(item['id'] in self._requests)
-            request = self._requests[item['id']]
-            del self._requests[item['id']]
-            request.setresponse(item)
+            self._dispatch_response(item)
+        elif 'upload' in item:
+            self._dispatch_upload(item)
+        elif 'chunk' in item:
+            self._dispatch_chunk(item)
         else:
             response = {
                 'result': None, 
                 'error': "Unknown format", 
                 'id': item['id']
                 }
-            
-        if response is not None:
-            txtResponse = None
-            try:
-                txtResponse = json.dumps(response, self)
-            except Exception, e:
-                print "An unexpected error ocurred when trying to create the message:", repr(e)
-                response = {
-                    'result': None, 
-                    'error': "InternalServerError: " + repr(e), 
-                    'id': item['id']
-                    }
-                txtResponse = json.dumps(response, self)
-                
-            try:
-                self.write(txtResponse)
-            except TypeError:
-                print "response was:", repr(response)
-                raise
-        return True
-    
-    
-    def proxy(self, sync_type, name, args, kwargs):
-        """
-        Call method on server.
+        return response
 
-        sync_type :: 
-          = 0 .. call method, wait, get response.
-          = 1 .. call method, inmediate return of object.
-          = 2 .. call notification and exit.
-          
+    def dispatch_batch(self, items, thread=True):
         """
-       
-        data = {}
-        data['method'] = name
-
-        if sync_type in [0, 1]: 
-            data['id'] = self.get_id()
-            
-        if len(args) > 0: 
-            data['params'] = args
+            Processes a list of items received in one message. The responses
+            to the calls in it are sent back in a single message too, in the
+            same order as the calls. (Responses that handler methods produce
+            later, like those of *process_method* methods, are sent on 
+            their own when ready.)
             
-        if len(kwargs) > 0: 
-            if len(args) == 0: 
-                data['params'] = kwargs
-            else: 
-                data['kwparams'] = kwargs
-            
-        if sync_type == 2: # short-circuit for speed!
-            self.write(json.dumps(data, self))
-            return None
-                    
-        req = Request(self, data)
-        if sync_type == 2: 
-            return None
+            Responses from the other end in the list are delivered at once.
             
-        if sync_type == 1: 
-            return req
-        
-        return req.value
+            If *thread* is True and *parallel_batches* is set, each call runs
+            in a thread of the worker pool, so a slow call doesn't delay the
+            others; the message with the responses is sent when the last one
+            finishes. Otherwise, in threaded mode (or with a reading thread)
+            the whole batch runs in one thread of the pool, and in the 
+            reading thread if not. The calls that don't fit in the queue of
+            the pool are answered with an error (see *_submit*).
+        """
+        calls = []
+        for item in items:
+            if type(item) is dict and 'result' in item and 'method' not in item:
+                self.dispatch_item_single(item)
+            else:
+                calls.append(item)
+        if not calls:
+            return
+        if thread and self.parallel_batches:
+            responses = [None] * len(calls)
+            pending = [len(calls)]
+            lock = threading.Lock()
+            def finish(index, response):
+                responses[index] = response
+                lock.acquire()
+                pending[0] -= 1
+                last = not pending[0]
+                lock.release()
+                if last:
+                    self._send_batch(responses)
+            def run(index, item):
+                response = None
+                try:
+                    response = self._dispatch_batch_item(item)
+                finally:
+                    finish(index, response)
+            for index, item in enumerate(calls):
+                if not self._submit(run, index, item):
+                    finish(index, self._busy_response(item))
+        elif thread and (self.threaded or self.reader_thread is not None):
+            if not self._submit(self._run_batch, calls):
+                self._send_batch([ self._busy_response(item) 
+                                   for item in calls ])
+        else:
+            self._run_batch(calls)
 
-    def close(self):
+    def _run_batch(self, calls):
         """
-            Close the connection and the socket. 
+            Runs the calls of a batch one after the other and sends the
+            responses.
+        """
+        self._send_batch([ self._dispatch_batch_item(item) for item in calls ])
+
+    def _dispatch_batch_item(self, item):
+        """
+            Like *_dispatch_item*, but errors are reported in the response 
+            instead of raised, so they don't lose the rest of the batch.
         """
-        if self.connection_status == "closed": return
-        item = {
-            'abort' : True,
-            'event' : threading.Event()
-        }
-        self.write_thread_queue.append(item)
-        self.write_thread_semaphore.release() # notify new item.
-        item['event'].wait(1)
-        if not item['event'].isSet():
-            print "WARN: write thread doesn't process our abort command" 
         try:
-            self.handler._shutdown()
+            if type(item) is not dict:
+                raise ValueError("Unknown format")
+            return self._dispatch_item(item)
         except Exception:
-            print "Error when shutting down the handler:"
             print traceback.format_exc()
-        try:
+            self._forget_calls(item)
+            etype, evalue = sys.exc_info()[:2]
+            req_id = None
+            if type(item) is dict:
+                req_id = item.get('id', None)
+            return {
+                'result': None, 
+                'error': '%s: %s' % (etype.__name__, evalue), 
+                'id': req_id
+                }
+
+    def _send_batch(self, responses):
+        """
+            Sends the *responses* of a batch (None items are skipped) in a 
+            single message.
+        """
+        texts = [ self._encode_response(response) 
+                  for response in responses 
+                  if response is not None and self._answered(response) ]
+        if texts:
+            self._write(self._wcodec.join(texts))
+
+    def _dispatch_response(self, item):
+        """
+            Delivers a response received from the other end to the Request
+            waiting for it. Responses to cancelled requests are ignored.
+        """
+        request = self._requests.pop(item['id'], None)
+        if request is not None:
+            request.setresponse(item)
+
+    def _dispatch_chunk(self, item):
+        """
+            Delivers a chunk of a streamed result to the *request.Stream*
+            waiting for it. Chunks of cancelled or expired streams, and the
+            ones whose id isn't a stream call, are ignored.
+        """
+        request = self._requests.get(item['id'], None)
+        if not isinstance(request, Stream):
+            return
+        request.addchunk(item['chunk'])
+
+    def _dispatch_with_uploads(self, item, uploads):
+        """
+            Processes a call which has *Upload* arguments, in a thread of the
+            worker pool. The uploads are stopped when it finishes.
+        """
+        try:
+            self.dispatch_item_single(item)
+        finally:
+            self._forget_uploads(uploads)
+
+    def _open_uploads(self, uploads):
+        """
+            Registers the *uploads* of a call about to be dispatched, so 
+            their chunks are delivered. Returns False if that would leave 
+            more than *max_uploads* open.
+        """
+        if len(self._uploads) + len(uploads) > self.max_uploads:
+            return False
+        for upload in uploads:
+            self._uploads[upload.name] = upload
+        return True
+
+    def _forget_uploads(self, uploads):
+        """
+            Forgets *uploads*: the messages that arrive for them later are
+            ignored, and the other end is told to stop sending the ones not
+            finished ({"upload": name, "stop": true}).
+        """
+        for upload in uploads:
+            self._uploads.pop(upload.name, None)
+            if not upload.finished and self.connection_status == "open":
+                try:
+                    self._write(self.encode({'upload': upload.name, 
+                        'stop': True}))
+                except (EofError, IOError, socket.error):
+                    pass # the connection is being closed.
+
+    def _dispatch_upload(self, item):
+        """
+            Processes the messages of uploads: chunks and ends of the ones 
+            received, and acknowledgements and stops of the ones we send. 
+            Messages for uploads whose call already finished are ignored.
+        """
+        name = item['upload']
+        if item.get('stop', False):
+            self._stop_uploads([name])
+            return
+        if 'ack' in item:
+            self._upload_cond.acquire()
+            try:
+                if name in self._upload_acks:
+                    self._upload_acks[name] = item['ack']
+                    self._upload_cond.notify_all()
+            finally:
+                self._upload_cond.release()
+            return
+        upload = self._uploads.get(name, None)
+        if upload is None:
+            return
+        if 'chunk' in item:
+            upload.addchunk(item['chunk'])
+        if item.get('end', False):
+            upload.finish(item.get('error', None))
+
+    def _ack_upload(self, name, consumed):
+        """
+            Tells the other end that *consumed* chunks of upload *name* have
+            been consumed, so it can send more.
+        """
+        if self.connection_status == "open":
+            self._write(self.encode({'upload': name, 'ack': consumed}))
+
+    def _upload_references(self, args, kwargs):
+        """
+            Replaces the generators among *args* and *kwargs* with references
+            to uploads. Returns the new args and kwargs, and the list of
+            (name, iterator) to send with *_send_with_uploads*.
+        """
+        uploads = []
+        def reference(value):
+            if type(value) is GeneratorType:
+                name = self.get_id()
+                uploads.append((name, value))
+                return { '__streamreference__' : name }
+            return value
+        args = [ reference(value) for value in args ]
+        kwargs = dict((key, reference(value)) 
+            for key, value in kwargs.iteritems())
+        return args, kwargs, uploads
+
+    def _send_with_uploads(self, text, request, uploads):
+        """
+            Writes the call *text* and starts sending its *uploads* after it.
+            They stop when *request* is done (answered, cancelled, expired
+            or failed), or when the other end asks for it.
+        """
+        names = [ name for name, iterator in uploads ]
+        self._upload_cond.acquire()
+        try:
+            for name in names:
+                self._upload_acks[name] = 0
+        finally:
+            self._upload_cond.release()
+        if request is not None:
+            request.add_done_callback(lambda req: self._stop_uploads(names))
+        self.write(text)
+        pool = self.worker_pool or get_default_pool()
+        for name, iterator in uploads:
+            pool.submit(self._send_upload, name, iterator)
+
+    def _stop_uploads(self, names):
+        """
+            Stops sending uploads *names*: the other end doesn't want more.
+        """
+        self._upload_cond.acquire()
+        try:
+            for name in names:
+                self._upload_acks.pop(name, None)
+            self._upload_cond.notify_all()
+        finally:
+            self._upload_cond.release()
+
+    def _wait_window(self, acks, key, sent, window, cancelled = None):
+        """
+            Waits until the other end has consumed enough chunks of the 
+            upload or stream *key* to send one more, when *sent* were sent:
+            *acks* holds the number of chunks consumed, and no more than 
+            *window* go ahead of them (see *upload_window* and 
+            *stream_window*). Returns False if it was stopped (removed from
+            *acks*), the connection was closed or *cancelled()* is True.
+        """
+        self._upload_cond.acquire()
+        try:
+            while (key in acks and sent - acks[key] >= window and
+                    self.connection_status == "open"):
+                if cancelled is not None and cancelled():
+                    return False
+                self._upload_cond.wait(1)
+            return key in acks and self.connection_status == "open"
+        finally:
+            self._upload_cond.release()
+
+    def _send_upload(self, name, iterator):
+        """
+            Sends the items of *iterator* in upload messages: chunks 
+            ({"upload": name, "chunk": [items]}) followed by an end, which 
+            carries the error if the iterator fails. If the upload is 
+            stopped, the generator is closed and the end tells the method
+            still iterating, if any, that no more items come.
+        """
+        items = []
+        sent = 0
+        previous = None
+        end = {'upload': name, 'end': True}
+        stopped = "UploadStopped: the call is done"
+        try:
+            for item in iterator:
+                items.append(item)
+                if len(items) < self.stream_chunk_size:
+                    continue
+                if not self._wait_window(self._upload_acks, name, sent, 
+                        self.upload_window):
+                    iterator.close()
+                    end['error'] = stopped
+                    break
+                chunk = self.encode({'upload': name, 'chunk': items})
+                previous = self._write_stream(chunk, previous)
+                sent += 1
+                items = []
+            else:
+                if items and not self._wait_window(self._upload_acks, name,
+                        sent, self.upload_window):
+                    end['error'] = stopped
+                elif items:
+                    self._write(self.encode({'upload': name, 'chunk': items}))
+        except Exception:
+            etype, evalue = sys.exc_info()[:2]
+            print "Error in upload %s:" % name
+            print traceback.format_exc()
+            end['error'] = "%s: %s" % (etype.__name__, evalue)
+        if self.connection_status == "open":
+            self._write(self.encode(end))
+
+    def _answered(self, response):
+        """
+            Forgets the call which *response* answers. Returns False if the 
+            response must not be sent, because the call was cancelled.
+        """
+        request = self._calls.pop(response['id'], None)
+        return request is None or not request.get("_cancelled", False)
+
+    def _send_response(self, response):
+        """
+            Serializes and sends *response* (a dictionary) to the other end.
+            If it can't be serialized, an InternalServerError is sent instead.
+            Nothing is sent for cancelled calls.
+        """
+        if not self._answered(response):
+            return
+        txtResponse = self._encode_response(response)
+        try:
+            self._write(txtResponse)
+        except TypeError:
+            print "response was:", repr(response)
+            raise
+
+    def _encode_response(self, response):
+        """
+            Serializes *response*, or an InternalServerError for it if it 
+            can't be serialized.
+        """
+        txtResponse = None
+        try:
+            txtResponse = self.encode(response)
+        except Exception, e:
+            print "An unexpected error ocurred when trying to create the message:", repr(e)
+            response = {
+                'result': None, 
+                'error': "InternalServerError: " + repr(e), 
+                'id': response['id']
+                }
+            txtResponse = self.encode(response)
+        return txtResponse
+    
+    
+    def proxy(self, sync_type, name, args, kwargs, deadline = None):
+        """
+        Call method on server.
+
+        sync_type :: 
+          = 0 .. call method, wait, get response.
+          = 1 .. call method, inmediate return of object.
+          = 2 .. call notification and exit.
+          = 3 .. map call (see *map*), wait, get the list of results.
+          = 4 .. stream call (see *stream*), inmediate return of the stream.
+        
+        Generators in the arguments are sent as uploads (see *Upload*).
+        
+        *deadline* is the number of seconds the call has to finish (see 
+        *proxies.Proxy.with_deadline*), or None.
+        """
+        if sync_type == 2 and not self._notification_room():
+            return None
+        uploads = None
+        if sync_type != 3 and (args or kwargs):
+            args, kwargs, uploads = self._upload_references(args, kwargs)
+        data = self._build_request(sync_type, name, args, kwargs, deadline)
+        if uploads:
+            return self._upload_proxy(sync_type, data, uploads)
+        if self.autobatch_window:
+            return self._autobatch_proxy(sync_type, data)
+        if sync_type == 2: # short-circuit for speed!
+            self.write(self.encode(data))
+            return None
+        
+        if sync_type == 4:
+            return Stream(self, data)
+        
+        req = Request(self, data)
+        if sync_type == 2: 
+            return None
+            
+        if sync_type == 1: 
+            return req
+        
+        return req.value
+
+    def _send_cancel(self, req_id):
+        """
+            Tells the other end to drop the call *req_id*, which we don't
+            wait for anymore (see *request.Request.cancel*).
+        """
+        if self.connection_status != "open":
+            return
+        data = self._build_request(2, '__cancel__', [req_id], {})
+        try:
+            self._write(self.encode(data))
+        except (EofError, IOError, socket.error, QueueFullError):
+            pass # closed meanwhile: the call is dropped anyway.
+
+    def _ack_stream(self, req_id, consumed):
+        """
+            Tells the other end that *consumed* chunks of the stream *req_id*
+            have been iterated, so it can send more (see *stream_window*).
+        """
+        if self.connection_status != "open":
+            return
+        data = self._build_request(2, '__ack__', [req_id, consumed], {})
+        try:
+            self._write(self.encode(data))
+        except (EofError, IOError, socket.error, QueueFullError):
+            pass # closed meanwhile: nothing more will be sent.
+
+    def _upload_proxy(self, sync_type, data, uploads):
+        """
+            *proxy* for calls with uploads: they are sent right away (even in
+            auto-batching mode), and the uploads start after them.
+        """
+        text = self.encode(data)
+        req = None
+        if sync_type == 4:
+            req = Stream(self, data, send = False)
+        elif sync_type != 2:
+            req = Request(self, data, send = False)
+        self._send_with_uploads(text, req, uploads)
+        if sync_type == 0:
+            return req.value
+        return req
+
+    def _autobatch_proxy(self, sync_type, data):
+        """
+            *proxy* for the auto-batching mode: the call waits to be sent with
+            the next ones (see *autobatch_window*).
+        """
+        if self._wpaused or self._above_high_water():
+            self._wait_write_room()
+        req = None
+        if sync_type == 4:
+            req = Stream(self, data, send = False)
+        elif sync_type != 2:
+            req = Request(self, data, send = False)
+        try:
+            self._autobatch(self.encode(data), 
+                flush = (sync_type in [0, 3]))
+        except Exception:
+            if req is not None:
+                self._requests.pop(req.request_id, None)
+            raise
+        if sync_type in [0, 3]:
+            return req.value
+        return req
+
+    def _autobatch(self, text, flush = False):
+        """
+            Adds the serialized call *text* to the pending batch. It is sent
+            now if *flush* is True or the batch is full; otherwise the 
+            batching thread sends it when the window ends.
+        """
+        cond = self._autobatch_cond
+        cond.acquire()
+        try:
+            self._autobatch_items.append(text)
+            if flush or len(self._autobatch_items) >= self.autobatch_size:
+                self._autobatch_flush()
+            elif len(self._autobatch_items) == 1:
+                if self._autobatch_thread is None:
+                    thread = threading.Thread(target=self._autobatch_loop)
+                    thread.daemon = True
+                    thread.start()
+                    self._autobatch_thread = thread
+                cond.notify()
+        finally:
+            cond.release()
+
+    def _autobatch_flush(self):
+        """
+            Sends the pending calls: alone if there's one, as a batch message
+            if there are more. The caller must hold *_autobatch_cond*.
+        """
+        items, self._autobatch_items = self._autobatch_items, []
+        if len(items) == 1:
+            self._write(items[0])
+        elif items:
+            self._write(self._wcodec.join(items))
+
+    def _autobatch_loop(self):
+        """
+            Body of the batching thread: once a call is waiting, it waits
+            until the window ends and sends whatever is pending then.
+        """
+        cond = self._autobatch_cond
+        cond.acquire()
+        try:
+            while self.connection_status != "closed":
+                if not self._autobatch_items:
+                    cond.wait()
+                    continue
+                cond.release()
+                try:
+                    time.sleep(self.autobatch_window / 1000000.0)
+                finally:
+                    cond.acquire()
+                self._autobatch_flush()
+        finally:
+            cond.release()
+
+    def encode(self, obj):
+        """
+            Serializes *obj* with the codec negotiated for the messages we 
+            send (JSON by default).
+        """
+        return self._wcodec.dumps(obj, self)
+
+    def decode(self, data):
+        """
+            Deserializes a received message with the codec negotiated for 
+            them (JSON by default).
+        """
+        return self._rcodec.loads(data, self)
+
+    def batch(self):
+        """
+            Returns a *request.Batch* to send several calls to the other end
+            in a single message::
+            
+                with conn.batch() as batch:
+                    requests = [ batch.method.lookup(key) for key in keys ]
+                values = [ req.value for req in requests ]
+        """
+        return Batch(self)
+
+    def _build_request(self, sync_type, name, args, kwargs, deadline = None):
+        """
+            Builds the message (a dictionary) that calls method *name* of 
+            the other end with *args* and *kwargs*. Calls with *sync_type*
+            0, 1, 3 or 4 get a new id; notifications (2) don't. Stream 
+            calls (4) ask for a window if the reading thread is running 
+            (see *stream_window*).
+            
+            Map calls (3) take the list of arguments as their only argument.
+            
+            A *deadline* (in seconds) is sent as "timeout".
+        """
+        data = {}
+        data['method'] = name
+
+        if sync_type in [0, 1, 3, 4]: 
+            data['id'] = self.get_id()
+            
+        if deadline is not None:
+            data['timeout'] = deadline
+            
+        if sync_type == 4:
+            data['stream'] = True
+            if self.reader_thread is not None:
+                data['window'] = self.stream_window
+            
+        if sync_type == 3:
+            assert(len(args) == 1 and not kwargs)
+            data['mapparams'] = [ params for params in args[0] ]
+            return data
+            
+        if len(args) > 0: 
+            data['params'] = args
+            
+        if len(kwargs) > 0: 
+            if len(args) == 0: 
+                data['params'] = kwargs
+            else: 
+                data['kwparams'] = kwargs
+        return data
+
+    def close(self):
+        """
+            Close the connection and the socket. It can be called more than
+            once, also by several threads at the same time (like the reading
+            thread, when the other end closes): only the first call does it.
+        """
+        self._close_lock.acquire()
+        try:
+            if self._closing or self.connection_status == "closed": return
+            self._closing = True
+        finally:
+            self._close_lock.release()
+        if self._autobatch_thread is not None:
+            self._autobatch_cond.acquire()
+            try:
+                self._autobatch_flush()
+            finally:
+                self._autobatch_cond.release()
+        if self.write_thread is not None:
+            item = {
+                'abort' : True,
+                'event' : threading.Event()
+            }
+            self.write_thread_queue.append(item)
+            self.write_thread_semaphore.release() # notify new item.
+            item['event'].wait(1)
+            if not item['event'].isSet():
+                print "WARN: write thread doesn't process our abort command" 
+        elif self._server is not None:
+            self.flush() # best effort, the socket is non-blocking.
+        # Before the socket: a writing thread still running stops using it.
+        self.connection_status = "closed"
+        if self.write_thread is not None:
+            # Started by a late writer after the abort above, maybe.
+            self.write_thread_queue.append({'abort' : True})
+            self.write_thread_semaphore.release()
+        try:
+            self.handler._shutdown()
+        except Exception:
+            print "Error when shutting down the handler:"
+            print traceback.format_exc()
+        try:
             self._sck.shutdown(socket.SHUT_RDWR)
         except socket.error:
             pass
         self._sck.close()
-        self.connection_status = "closed"
+        self.write_lock.acquire()
+        try:
+            self._wdrained.notify_all() # streams stop waiting.
+        finally:
+            self.write_lock.release()
+        self._wroom.acquire()
+        self._wroom.notify_all() # writers stop waiting.
+        self._wroom.release()
+        self._upload_cond.acquire()
+        self._upload_cond.notify_all() # uploads stop waiting.
+        self._upload_cond.release()
+        for request in self._requests.values():
+            request.connection_closed()
+        if self._autobatch_thread is not None:
+            self._autobatch_cond.acquire()
+            self._autobatch_cond.notify() # let the batching thread finish.
+            self._autobatch_cond.release()
     
     def write_line(self, data):
         """
@@ -673,37 +2097,160 @@ class Connection(object): # TODO: Split this class in simple ones
             **data**
                 String containing the data to be sent.
         """
-        assert('\n' not in data)
         self.write_lock.acquire()
         try:
             if self._debug_socket: 
                 print "<:%d:" % len(data), data[:130]
             
-            self._wbuffer += list(str(data + '\n'))
-            sbytes = 0
-            while len(self._wbuffer) > 0:
+            self._queue_line(data)
+            return self._flush_wbuffer()
+        finally:
+            self.write_lock.release()
+
+    def _queue_line(self, data):
+        """
+            Internal function which appends a message to the send buffer 
+            without sending it, framed as negotiated: followed by a newline, 
+            or preceded by its length. The caller must hold *write_lock*.
+        """
+        data = str(data)
+        if self._wframing == 'line':
+            assert('\n' not in data)
+            self._wbuffer.append(data)
+            self._wbuffer.append('\n')
+            self._wpending += len(data) + 1
+            self._wsizes.append(len(data) + 1)
+        else:
+            flags = 0
+            if self._wcompress and len(data) >= self.compress_threshold:
+                packed = zlib.compress(data, self.compress_level)
+                if len(packed) < len(data):
+                    self._stats['messages_compressed'] += 1
+                    self._stats['bytes_uncompressed'] += len(data)
+                    self._stats['bytes_compressed'] += len(packed)
+                    data, flags = packed, _FLAG_ZLIB
+            self._wbuffer.append(_frame_header.pack(flags, len(data)))
+            self._wbuffer.append(data)
+            self._wpending += _frame_header.size + len(data)
+            self._wsizes.append(_frame_header.size + len(data))
+        self._stats['messages_sent'] += 1
+
+    def _set_write_framing(self, framing, compress = False):
+        """
+            Changes the framing of the messages we send, and whether the big
+            ones are compressed, after the ones already written.
+        """
+        if self.write_thread is not None:
+            self.write_thread_queue.append({'framing': framing, 
+                'compress': compress})
+            self.write_thread_semaphore.release() # notify new item.
+            return
+        self.write_lock.acquire()
+        try:
+            self._wframing = framing
+            self._wcompress = compress
+        finally:
+            self.write_lock.release()
+
+    def _flush_wbuffer(self):
+        """
+            Internal function which sends the send buffer until it is empty.
+            The caller must hold *write_lock*.
+
+            Returns the number of bytes left in the buffer, or '' on error.
+        """
+        while self._wbuffer:
+            try:
+                sbytes = self._send_wbuffer()
+            except IOError:
+                print "Read socket error: IOError (timeout: %s)" % (
+                    repr(self._sck_timeout)  )
+                print traceback.format_exc(0)
+                return ''
+            except socket.error:
+                print "Read socket error: socket.error (timeout: %s)" % (
+                    repr(self._sck_timeout)  )
+                print traceback.format_exc(0)
+                return ''
+            except:
+                raise
+            if sbytes == 0: 
+                break
+        if self._wpending:
+            print "warn: %d bytes left in write buffer" % self._wpending
+        self._update_paused()
+        return self._wpending
+
+    def flush(self):
+        """
+            Sends the buffered data without blocking (event-driven mode).
+            Used by the server loop when the socket is writable.
+            
+            Returns the number of bytes still waiting to be sent.
+        """
+        self.write_lock.acquire()
+        try:
+            while self._wbuffer:
                 try:
-                    sbytes = self._sck.send("".join(self._wbuffer))
-                except IOError:
-                    print "Read socket error: IOError (timeout: %s)" % (
-                        repr(self._sck.gettimeout())  )
-                    print traceback.format_exc(0)
-                    return ''
-                except socket.error:
-                    print "Read socket error: socket.error (timeout: %s)" % (
-                        repr(self._sck.gettimeout())  )
-                    print traceback.format_exc(0)
-                    return ''
-                except:
-                    raise
-                if sbytes == 0: 
+                    if not self._send_wbuffer():
+                        break
+                except socket.error, inst:
+                    if inst.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        print "Write socket error: socket.error", inst.args
                     break
-                self._wbuffer[0:sbytes] = []
-            if len(self._wbuffer):
-                print "warn: %d bytes left in write buffer" % len(self._wbuffer)
-            return len(self._wbuffer)
+            if self._wpending <= self.max_stream_pending:
+                self._wdrained.notify_all() # see _write_stream.
+            self._update_paused()
+            return self._wpending
         finally:
             self.write_lock.release()
+
+    def _send_wbuffer(self):
+        """
+            Internal function which does one send call with the data at the
+            head of the send buffer and drops what was sent from it.
+
+            Chunks are never copied to be sent: the first one is sent from
+            a *memoryview* offset and, where the socket has *sendmsg*, the
+            following ones go in the same call. Otherwise, small chunks are
+            joined first so that short lines don't cost a syscall each.
+
+            Returns the number of bytes sent.
+        """
+        wbuffer = self._wbuffer
+        sendmsg = getattr(self._sck, "sendmsg", None)
+        if sendmsg is not None:
+            iov = [memoryview(wbuffer[0])[self._woffset:]]
+            iov.extend(itertools.islice(wbuffer, 1, self._max_iovecs))
+            sbytes = sendmsg(iov)
+        else:
+            if (len(wbuffer) > 1 and not self._woffset 
+                    and len(wbuffer[0]) < self._coalesce_size):
+                parts = [wbuffer.popleft()]
+                size = len(parts[0])
+                while (wbuffer and 
+                        size + len(wbuffer[0]) <= self._coalesce_size):
+                    size += len(wbuffer[0])
+                    parts.append(wbuffer.popleft())
+                wbuffer.appendleft("".join(parts))
+            sbytes = self._sck.send(memoryview(wbuffer[0])[self._woffset:])
+
+        left = sbytes
+        while left:
+            chunk_left = len(wbuffer[0]) - self._woffset
+            if left < chunk_left:
+                self._woffset += left
+                break
+            left -= chunk_left
+            wbuffer.popleft()
+            self._woffset = 0
+        self._wpending -= sbytes
+        self._wsent += sbytes
+        while self._wsizes and self._wsent >= self._wsizes[0]:
+            self._wsent -= self._wsizes.popleft()
+        self._stats['send_calls'] += 1
+        self._stats['bytes_sent'] += sbytes
+        return sbytes
             
 
 
@@ -738,36 +2285,323 @@ class Connection(object): # TODO: Split this class in simple ones
             maxtimeout = None
             
         if maxtimeout is not None:
-            if timeout is None or timeout > maxtimeout: 
+            if timeout is None or timeout > maxtimeout:
                 timeout = maxtimeout
-            
+
+        if self._server is not None:
+            self._io_timeout = timeout # the socket stays non-blocking.
+        else:
+            self._setsocktimeout(timeout)
+
+    def _setsocktimeout(self, timeout):
+        """
+            Sets the timeout of the underlying socket, skipping the call
+            when the socket already has that value.
+        """
+        if timeout == self._sck_timeout:
+            return
         self._sck.settimeout(timeout)
+        self._sck_timeout = timeout
             
     
-    def write_thread(self):
+    def _start_write_thread(self):
+        """
+            Starts the writing thread if it is not running yet.
+        """
+        self.write_lock.acquire()
+        try:
+            if self.write_thread is None:
+                thread = threading.Thread(target=self._write_loop)
+                thread.daemon = True
+                thread.start()
+                self.write_thread = thread
+        finally:
+            self.write_lock.release()
+
+    def start_reader(self):
+        """
+            *New in bjsonrpc v0.2.2* 
+            
+            Starts a thread that reads and dispatches every message received.
+            Threads waiting for a response (see *request.Request.wait*) then 
+            sleep until it delivers theirs, instead of taking turns to read 
+            the socket, and calls from the other end run in the worker pool:
+            a slow one doesn't delay the responses for the other threads.
+            
+            When the other end closes the connection, the thread closes it 
+            too, and the calls still waiting raise *exceptions.EofError*.
+            
+            The chunks of streamed results are read as they arrive: streams
+            ask the other end to send no more than *stream_window* chunks 
+            ahead of the ones iterated, so they don't fill the memory if the
+            *request.Stream* is iterated slowly. The *request.Request* 
+            callbacks run in the worker pool instead of the thread, so they
+            don't delay the messages that follow (see *_deliver_later*).
+            
+            Only for client connections: the ones of a *server.Server* are 
+            read by its event loop. *bjsonrpc.connect* calls it when asked to.
+        """
+        if self._server is not None:
+            raise ValueError("Connections of a server are read by its loop")
+        self.write_lock.acquire()
+        try:
+            if self.reader_thread is None:
+                thread = threading.Thread(target=self._reader_loop)
+                thread.daemon = True
+                self.reader_thread = thread
+                thread.start()
+        finally:
+            self.write_lock.release()
+
+    def _deliver_later(self, function, *args):
+        """
+            Queues *function(\*args)*, the delivery of a response to a 
+            *request.Request* with callbacks, to the worker pool if the 
+            caller is the reading thread. Returns False if the caller has to
+            run it itself: other threads, or the queue of the pool is full.
+        """
+        if self.reader_thread is not threading.current_thread():
+            return False
+        pool = self.worker_pool or get_default_pool()
+        try:
+            pool.submit_nowait(function, *args)
+        except Full:
+            return False
+        return True
+
+    def _reader_running(self):
+        """
+            Returns True if the reading thread is running and the caller is
+            another thread, which has to wait for it instead of reading.
+        """
+        thread = self.reader_thread
+        return thread is not None and thread is not threading.current_thread()
+
+    def _reader_loop(self):
+        """
+            Body of the reading thread (see *start_reader*). It waits for data
+            without holding *read_lock*, and reads a message once it starts
+            to arrive.
+        """
+        try:
+            while self.connection_status == "open":
+                if (self._has_buffered_line() or 
+                        wait_fileno(self._sck.fileno(), EVENT_READ, 1)):
+                    self.read_and_dispatch()
+        except (EofError, IOError, ValueError):
+            pass # closed by the other end, or by close().
+        except Exception:
+            print "Error in the reading thread:"
+            print traceback.format_exc()
+        finally:
+            self.close()
+
+    def _write_loop(self):
+        """
+            Body of the writing thread. It takes everything queued by *write*
+            since its last pass and sends it with as few syscalls as possible.
+
+            If *write_cork* (microseconds) is not zero, the thread waits that
+            long after being woken up so more messages can be sent together.
+        """
         abort = False
         while not abort:
             self.write_thread_semaphore.acquire() 
+            if self.write_cork:
+                time.sleep(self.write_cork / 1000000.0)
+            items = []
+            while True:
+                try:
+                    items.append(self.write_thread_queue.popleft())
+                except IndexError: # pop from empty list?
+                    print "WARN: write queue was empty??"
+                # every item popped has its own semaphore release.
+                if not self.write_thread_semaphore.acquire(False):
+                    break
+
+            self.write_lock.acquire()
             try:
-                item = self.write_thread_queue.pop(0)
-            except IndexError: # pop from empty list?
-                print "WARN: write queue was empty??"
-                continue
-            abort = item.get("abort", False)
-            event = item.get("event")
-            write_data  = item.get("write_data")
-            if write_data: item["result"] = self.write_now(write_data)
-            if event: event.set()
+                queued = []
+                for item in items:
+                    if item.get("abort", False):
+                        abort = True
+                    if "framing" in item:
+                        self._wframing = item["framing"]
+                        self._wcompress = item["compress"]
+                    write_data = item.get("write_data")
+                    if write_data is not None:
+                        self._wroom.acquire()
+                        self._wqueued -= len(write_data)
+                        self._wroom.release()
+                    if self.connection_status == "closed":
+                        abort = True # the socket is closed, or about to be.
+                    if write_data and not abort:
+                        if self._debug_socket: 
+                            print "<:%d:" % len(write_data), write_data[:130]
+                        self._queue_line(write_data)
+                        queued.append(item)
+                if queued:
+                    try:
+                        self.settimeout("write", None)
+                        result = self._flush_wbuffer()
+                    except socket.error: # closed meanwhile.
+                        result = ''
+                    for item in queued:
+                        item["result"] = result
+            finally:
+                self.write_lock.release()
+            for item in items:
+                event = item.get("event")
+                if event: event.set()
         if self._debug_socket: print "Writing thread finished."
             
             
     def write(self, data, timeout = None):
-        item = {
+        """
+            Queues the line *data* to be sent to the other end and returns
+            without waiting, unless the queue is above the high watermark:
+            then the *write_policy* applies, and it may wait up to *timeout*
+            seconds for the queue to drain (forever if None), or raise 
+            *exceptions.QueueFullError*.
+            
+            Client connections send it from their writing thread. Connections
+            driven by a server event loop buffer it, and the loop sends it
+            when the socket is writable.
+        """
+        if self._wpaused or self._above_high_water():
+            self._wait_write_room(timeout)
+        self._write(data)
+
+    def _write(self, data):
+        """
+            Like *write*, but the *write_policy* doesn't apply: used for the
+            responses and the other messages that the connection writes by
+            itself, which must never wait for the queue or fail because of 
+            it.
+        """
+        if self._server is not None:
+            self.write_lock.acquire()
+            try:
+                if self._debug_socket: 
+                    print "<:%d:" % len(data), data[:130]
+                self._queue_line(data)
+            finally:
+                self.write_lock.release()
+            self._server._request_flush(self)
+            return
+
+        self._queue_write_item({
             'write_data' : data
-        }
+        })
+
+    def _queue_write_item(self, item):
+        """
+            Hands *item* to the writing thread, starting it if needed, and 
+            counts the bytes it holds in the write queue.
+        """
+        if self.write_thread is None:
+            self._start_write_thread()
+        self._wroom.acquire()
+        self._wqueued += len(item['write_data'])
+        self._wroom.release()
         self.write_thread_queue.append(item)
         self.write_thread_semaphore.release() # notify new item.
 
+    def _write_queue_size(self):
+        """
+            Returns the bytes and the number of messages written and not 
+            sent yet: the ones waiting for the writing thread, and the ones
+            in the send buffer.
+        """
+        return (self._wqueued + self._wpending, 
+            len(self.write_thread_queue) + len(self._wsizes))
+
+    def _above_high_water(self):
+        """
+            True if the write queue reached one of its high watermarks.
+        """
+        size, messages = self._write_queue_size()
+        return ((self.write_high_water is not None and 
+                    size >= self.write_high_water) or 
+                (self.write_high_messages is not None and 
+                    messages >= self.write_high_messages))
+
+    def _below_low_water(self):
+        """
+            True if the write queue is below both of its low watermarks.
+        """
+        size, messages = self._write_queue_size()
+        return ((self.write_low_water is None or 
+                    size <= self.write_low_water) and 
+                (self.write_low_messages is None or 
+                    messages <= self.write_low_messages))
+
+    def _update_paused(self):
+        """
+            Pauses the writers when the queue reaches a high watermark, and 
+            wakes them up when it is back below the low ones. Returns True 
+            while they are paused.
+        """
+        self._wroom.acquire()
+        try:
+            if not self._wpaused:
+                self._wpaused = self._above_high_water()
+            elif self._below_low_water():
+                self._wpaused = False
+                self._wroom.notify_all()
+            return self._wpaused
+        finally:
+            self._wroom.release()
+
+    def _wait_write_room(self, timeout = None):
+        """
+            Called by *write* when the write queue may be above the high 
+            watermark: applies the *write_policy* to the message about to be
+            written.
+            
+            Only the writers of client connections wait, for their writing 
+            thread. The threads that read the connection don't, because the 
+            other end may be waiting for them to read before it reads what 
+            we send. Neither do the writers of the connections of a server,
+            because its loop sends what they write and may be waiting for 
+            them (see *dispatch_item_threaded*): it stops reading from the 
+            connection instead, while the writers are paused.
+        """
+        paused = self._update_paused()
+        reading = getattr(self._local, 'reading', False)
+        if not paused or reading:
+            return
+        if self.write_policy == 'error':
+            raise QueueFullError("Write queue is full")
+        if self._server is not None:
+            return
+        if timeout is not None:
+            timeout += time.time()
+        self._wroom.acquire()
+        try:
+            while self._update_paused() and self.connection_status == "open":
+                wait = 1
+                if timeout is not None:
+                    wait = min(wait, timeout - time.time())
+                    if wait <= 0:
+                        raise QueueFullError("Write queue is full")
+                self._wroom.wait(wait)
+        finally:
+            self._wroom.release()
+
+    def _notification_room(self):
+        """
+            Returns False if a notification must be dropped, because the 
+            write queue is above the high watermark and the *write_policy*
+            is 'shed'.
+        """
+        if self.write_policy != 'shed':
+            return True
+        if not (self._wpaused or self._above_high_water()):
+            return True
+        self._stats['notifications_shed'] += 1
+        return False
+
     def write_now(self, data, timeout = None):
         """ 
             Standard function to write to the socket 
@@ -796,52 +2630,195 @@ class Connection(object): # TODO: Split this class in simple ones
             self.scklock.release()
         return ret
 
-    def _readn(self):
+    def _has_buffered_line(self):
         """
-            Internal function which reads from socket waiting for a newline
+            Returns True if the read buffer already holds a complete message.
         """
-        streambuffer = self._buffer
-        pos = streambuffer.find('\n')
-        #print "read..."
-        #retry = 0
-        while pos == -1:
-            data = ''
+        if self._rframing == 'line':
+            return self._rbuffer.find('\n', self._rscan, self._rend) != -1
+        pending = self._rend - self._rstart
+        if pending < _frame_header.size:
+            return False
+        length = _frame_header.unpack_from(self._rbuffer, self._rstart)[1]
+        return pending >= _frame_header.size + length
+
+    def _recv_into_buffer(self, need = 0):
+        """
+            Internal function which receives up to *_readsize* bytes (or 
+            *need*, if it is bigger) at the end of the read buffer. The unread
+            data is moved to the front of the buffer (or to a bigger one) 
+            first if there isn't enough room.
+
+            Returns the number of bytes received.
+        """
+        buf = self._rbuffer
+        want = max(self._readsize, need)
+        if len(buf) - self._rend < want:
+            pending = self._rend - self._rstart
+            if pending + want <= len(buf) // 2:
+                # Plenty of room in front: compact in place.
+                buf[:pending] = memoryview(buf)[self._rstart:self._rend]
+            else:
+                # Grow geometrically so a long line is copied O(1) times.
+                newsize = max(len(buf) * 2, pending + want)
+                newbuf = bytearray(newsize)
+                newbuf[:pending] = memoryview(buf)[self._rstart:self._rend]
+                self._rbuffer = buf = newbuf
+            self._rscan -= self._rstart
+            self._rstart = 0
+            self._rend = pending
+
+        view = memoryview(buf)[self._rend:]
+        try:
+            nbytes = self._sck.recv_into(view, want)
+        finally:
+            del view
+        self._rend += nbytes
+
+        # Adapt the read size to the traffic we are seeing.
+        if nbytes >= self._readsize and self._readsize < self._max_readsize:
+            self._readsize *= 2
+        elif nbytes < self._readsize // 4 and self._readsize > self._min_readsize:
+            self._readsize //= 2
+        return nbytes
+
+    def _wait_io(self, timeout):
+        """
+            Internal function for the event-driven mode. Waits until there is
+            data to read, sending the buffered data meanwhile. Returns False
+            if *timeout* seconds pass before.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            events = EVENT_READ
+            if self._wpending:
+                events |= EVENT_WRITE
+            if timeout is not None:
+                timeout = max(deadline - time.time(), 0)
+            ready = wait_fileno(self._sck.fileno(), events, timeout)
+            if not ready:
+                return False
+            if ready & EVENT_WRITE:
+                self.flush()
+            if ready & EVENT_READ:
+                return True
+
+    def _recv_more(self, need = 0):
+        """
+            Internal function which receives more data into the read buffer
+            (see *_recv_into_buffer*). Returns False if nothing could be read
+            (timeout or socket error).
+        """
+        while True:
             try:
-                data = self._sck.recv(2048)
+                nbytes = self._recv_into_buffer(need)
+            except socket.timeout:
+                return False # the caller gave a timeout.
             except IOError, inst:
+                if (self._server is not None and 
+                        inst.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)):
+                    # Event-driven mode: the socket is non-blocking.
+                    if (self._io_timeout == 0 or 
+                            not self._wait_io(self._io_timeout)):
+                        return False
+                    continue
+                if self.connection_status == "closed":
+                    return False # closed by another thread: not an error.
                 print "Read socket error: IOError (timeout: %s)" % (
-                    repr(self._sck.gettimeout())  )
+                    repr(self._sck_timeout)  )
                 print inst.args
                 val = inst.args[0]
                 if val == 11: # Res. Temp. not available.
-                    if self._sck.gettimeout() == 0: # if it was too fast
-                        self._sck.settimeout(5)
+                    if self._sck_timeout == 0: # if it was too fast
+                        self._setsocktimeout(5)
                         continue
-                        #time.sleep(0.5)
-                        #retry += 1
-                        #if retry < 10:
-                        #    print "Retry ", retry
-                        #    continue
-                #print traceback.format_exc(0)
-                return ''
+                return False
             except socket.error, inst:
                 print "Read socket error: socket.error (timeout: %s)" % (
-                    repr(self._sck.gettimeout())  )
+                    repr(self._sck_timeout)  )
                 print inst.args
-                #print traceback.format_exc(0)
-                return ''
+                return False
             except:
                 raise
-            if not data:
-                raise EofError(len(streambuffer))
-            #print "readbuf+:",repr(data)
-            streambuffer += data
-            pos = streambuffer.find('\n')
-
-        self._buffer = streambuffer[pos + 1:]
-        streambuffer = streambuffer[:pos]
-        #print "read:", repr(buffer)
-        return streambuffer
+            if not nbytes:
+                raise EofError(self._rend - self._rstart)
+            return True
+
+    def _consume(self, start, end, drop):
+        """
+            Returns the bytes of the read buffer from *start* to *end* and 
+            drops everything before *drop*.
+        """
+        data = memoryview(self._rbuffer)[start:end].tobytes()
+        self._rstart = self._rscan = drop
+        if self._rstart == self._rend:
+            self._rstart = self._rend = self._rscan = 0
+            if len(self._rbuffer) > 4 * self._max_readsize:
+                # Don't keep a huge buffer around after a huge message.
+                self._rbuffer = bytearray()
+        return data
+
+    def _readn(self):
+        """
+            Internal function which reads from socket waiting for a newline
+            (or for a whole frame, in length framing).
+        """
+        if self._rframing != 'line':
+            return self._read_frame()
+        pos = self._rbuffer.find('\n', self._rscan, self._rend)
+        while pos == -1:
+            # Whatever we had is already scanned, don't look at it again.
+            self._rscan = self._rend
+            if not self._recv_more():
+                return ''
+            pos = self._rbuffer.find('\n', self._rscan, self._rend)
+
+        return self._consume(self._rstart, pos, pos + 1)
+
+    def _read_frame(self):
+        """
+            Internal function which reads a length-prefixed message. Its size
+            is known from the header, so the buffer is grown at most once and
+            the data is never scanned.
+        """
+        hsize = _frame_header.size
+        while self._rend - self._rstart < hsize:
+            if not self._recv_more(hsize - (self._rend - self._rstart)):
+                return ''
+        flags, length = _frame_header.unpack_from(self._rbuffer, self._rstart)
+        if length > self.max_frame_size:
+            raise EofError("Received a frame of %d bytes, bigger than "
+                "max_frame_size" % length)
+        total = hsize + length
+        while self._rend - self._rstart < total:
+            if not self._recv_more(total - (self._rend - self._rstart)):
+                return ''
+        end = self._rstart + total
+        data = self._consume(self._rstart + hsize, end, end)
+        if flags & _FLAG_ZLIB:
+            data = self._decompress(data)
+            flags &= ~_FLAG_ZLIB
+        if flags:
+            print "Received a frame with unknown flags %d" % flags
+            return ''
+        return data
+
+    def _decompress(self, data):
+        """
+            Internal function which inflates a compressed frame. It never 
+            produces more than *max_frame_size* bytes, so a small frame can't
+            make us allocate an arbitrary amount of memory.
+        """
+        inflater = zlib.decompressobj()
+        try:
+            result = inflater.decompress(data, self.max_frame_size)
+        except zlib.error, exc:
+            raise EofError("Received a corrupt compressed frame: %s" % exc)
+        if inflater.unconsumed_tail:
+            raise EofError("Received a compressed frame bigger than "
+                "max_frame_size")
+        return result
         
     def serve(self):
         """
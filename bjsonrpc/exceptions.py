@@ -39,6 +39,16 @@ class ServerError(Exception):
     """
     pass
 
+class QueueFullError(Exception):
+    """
+        *New in bjsonrpc v0.2.2*
+        
+        Raised when a message is written to a connection whose write queue 
+        is above its high watermark, if its *write_policy* is 'error', or if
+        the writer waited too long for the queue to drain.
+    """
+    pass
+
 class EofError(Exception):
     """
         End-of-file error raised whenever the socket reaches the 
@@ -171,6 +171,30 @@ class BaseHandler(object):
         return self._methods[name]
         
 
+def process_method(function):
+    """
+        *New in bjsonrpc v0.2.2*
+        
+        Decorator for handler methods that do heavy computations. Marked 
+        methods run in a process pool (see *bjsonrpc.workers.get_process_pool*)
+        instead of in the thread which received the call, so they aren't
+        serialized by the GIL and the connection keeps serving other calls
+        meanwhile. The response is sent when the method finishes::
+        
+            class MyHandler(bjsonrpc.handlers.BaseHandler):
+                @bjsonrpc.handlers.process_method
+                def factorize(self, number):
+                    ...
+        
+        The method runs in another process, on a bare instance of the handler
+        class created without calling __init__ or _setup: it can't use the
+        state of the handler nor the connection (there is no *self._conn*),
+        only other methods and class attributes. Its arguments and result 
+        are pickled.
+    """
+    function._bjsonrpc_process = True
+    return function
+
 class NullHandler(BaseHandler):
     """
         Null version of BaseHandler which has nothing in it. Use this when you
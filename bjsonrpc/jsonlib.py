@@ -31,41 +31,117 @@
     POSSIBILITY OF SUCH DAMAGE.
 
 """
+import json as _json
 try:
-    import simplejson as j
+    import simplejson as _simplejson
 except ImportError:
-    import json as j
-except ImportError:
-    print "FATAL: No suitable json library found!"
-    raise
-from pprint import pprint
+    _simplejson = None
+
+_codecs = {}
+_active = None
+_dumps = None
+_loads = None
+
+def register_codec(name, dumps, loads, priority = 0):
+    """
+        Registers a JSON library to be used by *dumps* and *loads*.
+        
+        Parameters:
+        
+        **name**
+            Name of the codec, for *use_codec*.
+        
+        **dumps**
+            Function *dumps(obj, default)* that returns the JSON text of 
+            *obj* without newlines, calling *default(o)* for the objects it
+            can't serialize.
+        
+        **loads**
+            Function *loads(text, object_hook)* that decodes *text*, passing 
+            every decoded object (dictionary) through *object_hook*, if it 
+            is not None.
+        
+        **priority** = 0
+            The available codec with the highest priority is the one used 
+            by default.
+    """
+    _codecs[name] = (priority, dumps, loads)
+
+def available_codecs():
+    """
+        Returns the names of the registered codecs, fastest first.
+    """
+    return sorted(_codecs, key=lambda name: _codecs[name][0], reverse=True)
+
+def use_codec(name = None):
+    """
+        Selects the codec used by *dumps* and *loads*. With no *name*, the 
+        one with the highest priority is used (this is done on import).
+    """
+    global _active, _dumps, _loads
+    if name is None:
+        name = available_codecs()[0]
+    if name not in _codecs:
+        raise ValueError("Unknown JSON codec %s" % repr(name))
+    priority, _dumps, _loads = _codecs[name]
+    _active = name
+
+def active_codec():
+    """
+        Returns the name of the codec in use.
+    """
+    return _active
+
+def _register_module(name, module, priority):
+    """
+        Registers a module with the interface of the standard *json* module.
+    """
+    def dumps(obj, default):
+        return module.dumps(obj, separators = (',', ':'), default = default)
+    def loads(text, object_hook):
+        return module.loads(text, object_hook = object_hook)
+    register_codec(name, dumps, loads, priority)
+
+def _has_speedups(module):
+    """
+        True if the *json*-like *module* has its C accelerators available.
+    """
+    encoder = getattr(module, "encoder", None)
+    decoder = getattr(module, "decoder", None)
+    return (getattr(encoder, "c_make_encoder", None) is not None and 
+            getattr(decoder, "c_scanstring", None) is not None)
+
+_register_module("json", _json, _has_speedups(_json) and 20 or 0)
+if _simplejson is not None:
+    _register_module("simplejson", _simplejson, 
+        _has_speedups(_simplejson) and 30 or 10)
+use_codec()
 
 
 def dumps(argobj, conn):
     """
-        dumps json object using loaded json library and forwards unknown objects
-        to *Connection.dumpObject* function.
-    """
-    ret = None
-    try:
-        ret = j.dumps(argobj, separators = (',', ':'), default=conn.dump_object)
-    except TypeError:
-        pprint(argobj)
-        raise
-        #raise TypeError("The Python object is not serializable to JSON!")
-    return ret
+        dumps json object using the active codec and forwards unknown objects
+        to *Connection.dump_object* function.
+    """
+    return _dumps(argobj, conn.dump_object)
 
 def loads(argobj, conn):
     """
         loads json object using *Connection.load_object* to convert json hinted 
         objects to real objects. 
+        
+        Hinted objects always have a key starting with "__", so texts without
+        that (which are most of them) are decoded without calling 
+        *load_object* for every object.
     """
-    ret = None
-    try:
-        ret = j.loads(argobj, object_hook=conn.load_object)
-    except ValueError:
-        pprint(argobj)
-        raise
-        #raise ValueError("The String object is not a valid JSON data!")
-    
-    return ret
\ No newline at end of file
+    if '"__' not in argobj and '\\u005' not in argobj:
+        # No hints, unless the peer escaped the underscores (\u005f).
+        return _loads(argobj, None)
+    return _loads(argobj, conn.load_object)
+
+def join(items):
+    """
+        Given a list of encoded messages, returns the encoding of the list
+        of them (without decoding them).
+    """
+    return "[" + ",".join(items) + "]"
@@ -11,6 +11,7 @@
 
 import socket
 
+from bjsonrpc import bjsonrpc_options
 import bjsonrpc.server
 import bjsonrpc.connection
 import bjsonrpc.handlers
@@ -21,7 +22,7 @@ __all__ = [
 ]
 
 def createserver(host="127.0.0.1", port=10123, 
-    handler_factory=bjsonrpc.handlers.NullHandler):
+    handler_factory=bjsonrpc.handlers.NullHandler, workers=None):
     """
         Creates a *bjson.server.Server* object linked to a listening socket.
         
@@ -39,6 +40,12 @@ def createserver(host="127.0.0.1", port=10123,
         **handler_factory**
           Class to instantiate to publish remote functions.
         
+        **workers**
+          *New in bjsonrpc v0.2.2* Number of processes to serve with. If it
+          is given, a *bjson.server.PreforkServer* is returned instead, which
+          forks this number of processes with a *Server* loop each, to use 
+          several CPUs. Only available on Unix.
+        
         **(return value)**
           A *bjson.server.Server* instance or raises an exception.
         
@@ -51,16 +58,20 @@ def createserver(host="127.0.0.1", port=10123,
             
         Check :ref:`bjsonrpc.server` documentation
     """
+    if workers is not None:
+        return bjsonrpc.server.PreforkServer((host, port), 
+            handler_factory=handler_factory, workers=workers)
     sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sck.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
     sck.bind((host, port))
-    sck.listen(3) 
+    sck.listen(socket.SOMAXCONN)
     return bjsonrpc.server.Server(sck, handler_factory=handler_factory)
         
         
 def connect(host="127.0.0.1", port=10123, 
-    handler_factory=bjsonrpc.handlers.NullHandler):
+    handler_factory=bjsonrpc.handlers.NullHandler, framing=None, codec=None,
+    compression=None, reader_thread=None):
     """
         Creates a *bjson.connection.Connection* object linked to a connected
         socket.
@@ -78,6 +89,29 @@ def connect(host="127.0.0.1", port=10123,
           By default this is *NullHandler* which means that no functions are
           executable by the server.
         
+        **framing**
+          *New in bjsonrpc v0.2.2* Framing to ask the server for, as in 
+          *Connection.negotiate*: 'line' or 'length'. By default, the one in 
+          *bjsonrpc_options['framing']*. Servers that don't support it keep
+          using 'line'.
+        
+        **codec**
+          *New in bjsonrpc v0.2.2* Codec to ask the server for: 'json' or 
+          'msgpack'. By default, the one in *bjsonrpc_options['codec']*. 
+          Codecs other than 'json' need 'length' framing, which is asked for 
+          too.
+        
+        **compression**
+          *New in bjsonrpc v0.2.2* Compression to ask the server for: None or
+          'zlib' (see *Connection.negotiate*). By default, the one in 
+          *bjsonrpc_options['compression']*. It needs 'length' framing, which
+          is asked for too.
+        
+        **reader_thread**
+          *New in bjsonrpc v0.2.2* If True, a thread reads the messages of 
+          the connection (see *Connection.start_reader*). By default, the 
+          value of *bjsonrpc_options['reader_thread']*.
+        
         **(return value)**
           A *bjson.connection.Connection* instance or raises an exception.
         
@@ -90,8 +124,28 @@ def connect(host="127.0.0.1", port=10123,
     """
     sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sck.connect((host, port))
-    return bjsonrpc.connection.Connection(sck, 
+    conn = bjsonrpc.connection.Connection(sck, 
         handler_factory=handler_factory)
+    if framing is None:
+        framing = bjsonrpc_options['framing']
+    if codec is None:
+        codec = bjsonrpc_options['codec']
+    if compression is None:
+        compression = bjsonrpc_options['compression']
+    options = {}
+    if codec != 'json':
+        options['codec'] = [codec]
+    if compression is not None:
+        options['compression'] = [compression]
+    if options:
+        conn.negotiate(framing=['length'], **options)
+    elif framing != 'line':
+        conn.negotiate(framing=[framing])
+    if reader_thread is None:
+        reader_thread = bjsonrpc_options['reader_thread']
+    if reader_thread:
+        conn.start_reader()
+    return conn
         
 
 
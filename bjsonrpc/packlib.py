@@ -0,0 +1,267 @@
+"""
+    bjson/packlib.py
+    
+    Asynchronous Bidirectional JSON-RPC protocol implementation over TCP/IP
+    
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions
+    are met:
+    1. Redistributions of source code must retain the above copyright
+       notice, this list of conditions and the following disclaimer.
+    2. Redistributions in binary form must reproduce the above copyright
+       notice, this list of conditions and the following disclaimer in the
+       documentation and/or other materials provided with the distribution.
+    3. Neither the name of copyright holders nor the names of its
+       contributors may be used to endorse or promote products derived
+       from this software without specific prior written permission.
+
+    THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+    ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+    TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+    PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+    BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+    CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+"""
+import struct
+
+try:
+    import msgpack as _msgpack
+except ImportError:
+    _msgpack = None
+
+__all__ = [
+    "dumps",
+    "loads",
+    "join",
+    "backend",
+]
+
+backend = _msgpack is not None and "msgpack" or "python"
+"""
+Implementation in use: "msgpack" (the C-accelerated *msgpack* library, when
+it is installed) or "python" (the one in this module).
+"""
+
+def dumps(argobj, conn):
+    """
+        Encodes *argobj* in MessagePack format, forwarding unknown objects
+        to *Connection.dump_object* (so remote objects and function
+        references are sent as the same hinted dictionaries as in JSON).
+    """
+    if _msgpack is not None:
+        return _msgpack.packb(argobj, default=conn.dump_object,
+            use_bin_type=False)
+    out = []
+    _pack(argobj, out, conn.dump_object)
+    return "".join(out)
+
+def loads(argobj, conn):
+    """
+        Decodes a MessagePack message, using *Connection.load_object* to
+        convert hinted dictionaries to real objects. As in JSON, strings are
+        decoded as unicode.
+    """
+    hook = None
+    if '__' in argobj: # hinted objects have keys starting with "__".
+        hook = conn.load_object
+    if _msgpack is not None:
+        return _msgpack.unpackb(argobj, raw=False, object_hook=hook)
+    try:
+        obj, pos = _unpack(argobj, 0, hook)
+    except (IndexError, struct.error):
+        raise ValueError("Truncated MessagePack message")
+    if pos != len(argobj):
+        raise ValueError("Extra data after the MessagePack message")
+    return obj
+
+def join(items):
+    """
+        Given a list of encoded messages, returns the encoding of the list
+        of them (without decoding them).
+    """
+    out = []
+    _pack_header(len(items), 0x90, 0xdc, out)
+    out.extend(items)
+    return "".join(out)
+
+
+def _pack_header(length, fix, code16, out):
+    """ Appends the header of an array (or map) of *length* items """
+    if length < 16:
+        out.append(chr(fix | length))
+    elif length < 0x10000:
+        out.append(struct.pack(">BH", code16, length))
+    else:
+        out.append(struct.pack(">BI", code16 + 1, length))
+
+def _pack_str(data, out):
+    """ 
+        Appends a string of UTF-8 encoded bytes. Like msgpack without 
+        *use_bin_type*, it doesn't use str8, which older decoders don't know.
+    """
+    length = len(data)
+    if length < 32:
+        out.append(chr(0xa0 | length))
+    elif length < 0x10000:
+        out.append(struct.pack(">BH", 0xda, length))
+    else:
+        out.append(struct.pack(">BI", 0xdb, length))
+    out.append(data)
+
+def _pack_int(obj, out):
+    """ Appends an integer in its smallest format """
+    if 0 <= obj < 0x80:
+        out.append(chr(obj))
+    elif -32 <= obj < 0:
+        out.append(chr(obj & 0xff))
+    elif obj >= 0:
+        if obj < 0x100:
+            out.append(struct.pack(">BB", 0xcc, obj))
+        elif obj < 0x10000:
+            out.append(struct.pack(">BH", 0xcd, obj))
+        elif obj < 0x100000000:
+            out.append(struct.pack(">BI", 0xce, obj))
+        elif obj < 0x10000000000000000:
+            out.append(struct.pack(">BQ", 0xcf, obj))
+        else:
+            raise OverflowError("Integer too big for MessagePack")
+    else:
+        if obj >= -0x80:
+            out.append(struct.pack(">Bb", 0xd0, obj))
+        elif obj >= -0x8000:
+            out.append(struct.pack(">Bh", 0xd1, obj))
+        elif obj >= -0x80000000:
+            out.append(struct.pack(">Bi", 0xd2, obj))
+        elif obj >= -0x8000000000000000:
+            out.append(struct.pack(">Bq", 0xd3, obj))
+        else:
+            raise OverflowError("Integer too big for MessagePack")
+
+def _pack(obj, out, default):
+    """ Appends the encoding of *obj* to the list *out* """
+    objtype = type(obj)
+    if obj is None:
+        out.append('\xc0')
+    elif objtype is bool:
+        out.append(obj and '\xc3' or '\xc2')
+    elif objtype is int or objtype is long:
+        _pack_int(obj, out)
+    elif objtype is float:
+        out.append(struct.pack(">Bd", 0xcb, obj))
+    elif objtype is unicode:
+        _pack_str(obj.encode("utf-8"), out)
+    elif objtype is str:
+        _pack_str(obj, out)
+    elif objtype is list or objtype is tuple:
+        _pack_header(len(obj), 0x90, 0xdc, out)
+        for item in obj:
+            _pack(item, out, default)
+    elif objtype is dict:
+        _pack_header(len(obj), 0x80, 0xde, out)
+        for key, value in obj.iteritems():
+            _pack(key, out, default)
+            _pack(value, out, default)
+    elif isinstance(obj, bool):
+        _pack(bool(obj), out, default)
+    elif isinstance(obj, (int, long)):
+        _pack_int(int(obj), out)
+    elif isinstance(obj, float):
+        _pack(float(obj), out, default)
+    elif isinstance(obj, basestring):
+        _pack(unicode(obj), out, default)
+    elif isinstance(obj, (list, tuple)):
+        _pack(list(obj), out, default)
+    elif isinstance(obj, dict):
+        _pack(dict(obj), out, default)
+    else:
+        _pack(default(obj), out, default)
+
+
+_fixed = {
+    0xc0: None,
+    0xc2: False,
+    0xc3: True,
+}
+
+_numbers = {
+    0xca: struct.Struct(">f"),
+    0xcb: struct.Struct(">d"),
+    0xcc: struct.Struct(">B"),
+    0xcd: struct.Struct(">H"),
+    0xce: struct.Struct(">I"),
+    0xcf: struct.Struct(">Q"),
+    0xd0: struct.Struct(">b"),
+    0xd1: struct.Struct(">h"),
+    0xd2: struct.Struct(">i"),
+    0xd3: struct.Struct(">q"),
+}
+
+_lengths = {
+    # code: (length format, kind)
+    0xc4: (struct.Struct(">B"), "bin"),
+    0xc5: (struct.Struct(">H"), "bin"),
+    0xc6: (struct.Struct(">I"), "bin"),
+    0xd9: (struct.Struct(">B"), "str"),
+    0xda: (struct.Struct(">H"), "str"),
+    0xdb: (struct.Struct(">I"), "str"),
+    0xdc: (struct.Struct(">H"), "array"),
+    0xdd: (struct.Struct(">I"), "array"),
+    0xde: (struct.Struct(">H"), "map"),
+    0xdf: (struct.Struct(">I"), "map"),
+}
+
+def _unpack(data, pos, hook):
+    """ Decodes the object at *pos*. Returns it and the position after it """
+    code = ord(data[pos])
+    pos += 1
+    if code < 0x80:
+        return code, pos
+    if code >= 0xe0:
+        return code - 0x100, pos
+    if code >= 0xa0 and code < 0xc0:
+        kind, length = "str", code & 0x1f
+    elif code >= 0x90 and code < 0xa0:
+        kind, length = "array", code & 0x0f
+    elif code < 0x90:
+        kind, length = "map", code & 0x0f
+    elif code in _fixed:
+        return _fixed[code], pos
+    elif code in _numbers:
+        number = _numbers[code]
+        return number.unpack_from(data, pos)[0], pos + number.size
+    elif code in _lengths:
+        header, kind = _lengths[code]
+        length = header.unpack_from(data, pos)[0]
+        pos += header.size
+    else:
+        raise ValueError("Unsupported MessagePack type 0x%02x" % code)
+
+    if kind == "str" or kind == "bin":
+        end = pos + length
+        if end > len(data):
+            raise IndexError
+        if kind == "str":
+            return data[pos:end].decode("utf-8"), end
+        return data[pos:end], end
+    if kind == "array":
+        items = []
+        for i in xrange(length):
+            item, pos = _unpack(data, pos, hook)
+            items.append(item)
+        return items, pos
+    obj = {}
+    for i in xrange(length):
+        key, pos = _unpack(data, pos, hook)
+        obj[key], pos = _unpack(data, pos, hook)
+    if hook is not None:
+        obj = hook(obj)
+    return obj, pos
@@ -0,0 +1,206 @@
+"""
+    bjson/poller.py
+    
+    Asynchronous Bidirectional JSON-RPC protocol implementation over TCP/IP
+    
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions
+    are met:
+    1. Redistributions of source code must retain the above copyright
+       notice, this list of conditions and the following disclaimer.
+    2. Redistributions in binary form must reproduce the above copyright
+       notice, this list of conditions and the following disclaimer in the
+       documentation and/or other materials provided with the distribution.
+    3. Neither the name of copyright holders nor the names of its
+       contributors may be used to endorse or promote products derived
+       from this software without specific prior written permission.
+
+    THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+    ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+    TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+    PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+    BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+    CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+"""
+import select, errno
+
+__all__ = [
+    "Poller",
+    "wait_fileno",
+    "EVENT_READ",
+    "EVENT_WRITE",
+]
+
+EVENT_READ = 1
+"""Event mask bit for file descriptors ready to read"""
+
+EVENT_WRITE = 2
+"""Event mask bit for file descriptors ready to write"""
+
+
+class Poller(object):
+    """
+        Watches a set of file descriptors for readiness. It is a small
+        wrapper over the best mechanism available on the platform:
+        *select.epoll* (Linux), *select.poll* or *select.select*, in that
+        order. Unlike *select.select*, the first two are not limited to
+        file descriptors below FD_SETSIZE and don't rebuild the set on
+        every call.
+
+        Errors and hang-ups are reported as *EVENT_READ*, so the next read
+        on that file descriptor finds out what happened.
+
+        Parameters:
+
+        **backend** = None
+            Force a backend: "epoll", "poll" or "select". By default the
+            best available one is used.
+    """
+    def __init__(self, backend = None):
+        if backend is None:
+            for backend in ["epoll", "poll", "select"]:
+                if hasattr(select, backend):
+                    break
+        self.backend = backend
+        self._fds = {}
+        if backend == "epoll":
+            self._poll = select.epoll()
+            self._flags = {
+                EVENT_READ: select.EPOLLIN,
+                EVENT_WRITE: select.EPOLLOUT,
+            }
+            self._errors = select.EPOLLERR | select.EPOLLHUP
+        elif backend == "poll":
+            self._poll = select.poll()
+            self._flags = {
+                EVENT_READ: select.POLLIN,
+                EVENT_WRITE: select.POLLOUT,
+            }
+            self._errors = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        elif backend == "select":
+            self._poll = None
+        else:
+            raise ValueError("Unknown poller backend %s" % repr(backend))
+
+    def _tonative(self, events):
+        """ Converts an event mask to the flags used by the backend """
+        flags = 0
+        for event, flag in self._flags.iteritems():
+            if events & event:
+                flags |= flag
+        return flags
+
+    def register(self, fileno, events):
+        """
+            Starts watching *fileno* for *events* (a mask of EVENT_READ and
+            EVENT_WRITE).
+        """
+        if fileno in self._fds:
+            raise KeyError("File descriptor %d is already registered" % fileno)
+        self._fds[fileno] = events
+        if self._poll is not None:
+            self._poll.register(fileno, self._tonative(events))
+
+    def modify(self, fileno, events):
+        """
+            Changes the events watched for *fileno*.
+        """
+        if self._fds[fileno] == events:
+            return
+        self._fds[fileno] = events
+        if self._poll is not None:
+            self._poll.modify(fileno, self._tonative(events))
+
+    def unregister(self, fileno):
+        """
+            Stops watching *fileno*. Unknown file descriptors are ignored.
+        """
+        if fileno not in self._fds:
+            return
+        del self._fds[fileno]
+        if self._poll is not None:
+            try:
+                self._poll.unregister(fileno)
+            except (IOError, OSError, KeyError, ValueError):
+                pass # The file descriptor was already closed.
+
+    def close(self):
+        """
+            Releases the resources of the backend.
+        """
+        self._fds = {}
+        if self.backend == "epoll":
+            self._poll.close()
+
+    def poll(self, timeout = None):
+        """
+            Waits until some of the watched file descriptors are ready, or
+            *timeout* seconds pass (forever if it is None).
+
+            **(return value)**
+                List of (fileno, events) tuples.
+        """
+        try:
+            if self.backend == "epoll":
+                if timeout is None:
+                    timeout = -1
+                ready = self._poll.poll(timeout)
+            elif self.backend == "poll":
+                if timeout is not None:
+                    timeout = int(timeout * 1000)
+                ready = self._poll.poll(timeout)
+            else:
+                return self._select(timeout)
+        except (IOError, OSError, select.error), exc:
+            if exc.args[0] == errno.EINTR:
+                return []
+            raise
+        ret = []
+        for fileno, flags in ready:
+            events = 0
+            if flags & (self._flags[EVENT_READ] | self._errors):
+                events |= EVENT_READ
+            if flags & self._flags[EVENT_WRITE]:
+                events |= EVENT_WRITE
+            ret.append((fileno, events))
+        return ret
+
+    def _select(self, timeout):
+        """ poll() implementation for the *select.select* backend """
+        rlist = [ fd for fd, ev in self._fds.iteritems() if ev & EVENT_READ ]
+        wlist = [ fd for fd, ev in self._fds.iteritems() if ev & EVENT_WRITE ]
+        rready, wready = select.select(rlist, wlist, [], timeout)[:2]
+        ready = dict((fd, EVENT_READ) for fd in rready)
+        for fileno in wready:
+            ready[fileno] = ready.get(fileno, 0) | EVENT_WRITE
+        return ready.items()
+
+
+def wait_fileno(fileno, events, timeout = None):
+    """
+        Waits until a single file descriptor is ready for *events*, or
+        *timeout* seconds pass. Returns the events that are ready (0 on
+        timeout).
+
+        It uses *select.poll* where available, so it works for any
+        file descriptor number.
+    """
+    if hasattr(select, "poll"):
+        poller = Poller("poll")
+    else:
+        poller = Poller("select")
+    poller.register(fileno, events)
+    ready = poller.poll(timeout)
+    poller.close()
+    if not ready:
+        return 0
+    return ready[0][1]
@@ -22,16 +22,35 @@ class Proxy(object):
         
     **sync_type**
         synchronization type. 0-synchronous. 1-asynchronous. 2-notification.
+        3-map (synchronous). 4-stream (see *request.Stream*).
         
     **obj** = None
         optional. Object name to call their functions, (used to proxy 
         functions of *RemoteObject*)
         
+    **deadline** = None
+        optional. Seconds the calls have to finish (see *with_deadline*).
+        
     """
-    def __init__(self, conn, sync_type, obj = None):
+    def __init__(self, conn, sync_type, obj = None, deadline = None):
         self._conn = conn
         self._obj = obj
         self.sync_type = sync_type
+        self.deadline = deadline
+
+    def with_deadline(self, seconds):
+        """
+            Returns a copy of this proxy whose calls must finish within 
+            *seconds*::
+            
+                conn.call.with_deadline(0.2).lookup(key)
+            
+            The time is sent along with the call, and the other end doesn't
+            run it if it is still waiting to start when the time is over. 
+            Calls that don't get their response in time raise 
+            *request.TimeoutError*, and the late response is ignored.
+        """
+        return Proxy(self._conn, self.sync_type, self._obj, seconds)
 
     def __getattr__(self, name):
         if self._obj:
@@ -42,6 +61,9 @@ class Proxy(object):
                 Decorator-like function that forwards all calls to proxy 
                 method of connection.
             """
+            if self.deadline is not None:
+                return self._conn.proxy(self.sync_type, name, args, kwargs,
+                    deadline = self.deadline)
             return self._conn.proxy(self.sync_type, name, args, kwargs)
         #print name
         function.__name__ = str(name)
@@ -32,17 +32,146 @@
 
 """
 
-from threading import Event
+from threading import Event, Condition
+from collections import deque
 import traceback
+import time
 
-from bjsonrpc.exceptions import ServerError
-import bjsonrpc.jsonlib as json
+from bjsonrpc.exceptions import ServerError, EofError
+from bjsonrpc.proxies import Proxy
+from bjsonrpc.timers import get_default_wheel
 
-class Request(object):
+try:
+    from concurrent.futures import Future, CancelledError, TimeoutError
+except ImportError: # Python 2 without the "futures" backport.
+    Future = None
+
+if Future is None:
+    class CancelledError(Exception):
+        """ The request was cancelled (see *Request.cancel*) """
+        pass
+
+    class TimeoutError(Exception):
+        """ The result didn't arrive in the time given """
+        pass
+
+    class Future(object):
+        """
+            Minimal stand-in for *concurrent.futures.Future*, used when the
+            "futures" backport is not installed. It has the same methods,
+            but *concurrent.futures.wait* and *as_completed* need the real 
+            one.
+        """
+        def __init__(self):
+            self._condition = Condition()
+            self._state = 'PENDING'
+            self._result = None
+            self._exception = None
+            self._done_callbacks = []
+
+        def cancel(self):
+            self._condition.acquire()
+            try:
+                if self._state == 'FINISHED':
+                    return False
+                if self._state == 'CANCELLED':
+                    return True
+                self._state = 'CANCELLED'
+                self._condition.notify_all()
+            finally:
+                self._condition.release()
+            self._invoke_callbacks()
+            return True
+
+        def cancelled(self):
+            return self._state == 'CANCELLED'
+
+        def running(self):
+            return False
+
+        def done(self):
+            return self._state != 'PENDING'
+
+        def set_running_or_notify_cancel(self):
+            return not self.cancelled()
+
+        def add_done_callback(self, fn):
+            self._condition.acquire()
+            try:
+                if self._state == 'PENDING':
+                    self._done_callbacks.append(fn)
+                    return
+            finally:
+                self._condition.release()
+            fn(self)
+
+        def _invoke_callbacks(self):
+            for callback in self._done_callbacks:
+                try:
+                    callback(self)
+                except Exception:
+                    print "Error on done callback:"
+                    print traceback.format_exc()
+
+        def _wait_done(self, timeout):
+            self._condition.acquire()
+            try:
+                if self._state == 'PENDING':
+                    self._condition.wait(timeout)
+                if self._state == 'CANCELLED':
+                    raise CancelledError()
+                if self._state == 'PENDING':
+                    raise TimeoutError()
+            finally:
+                self._condition.release()
+
+        def result(self, timeout = None):
+            self._wait_done(timeout)
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+
+        def exception(self, timeout = None):
+            self._wait_done(timeout)
+            return self._exception
+
+        def _finish(self, result, exception):
+            self._condition.acquire()
+            try:
+                self._result = result
+                self._exception = exception
+                self._state = 'FINISHED'
+                self._condition.notify_all()
+            finally:
+                self._condition.release()
+            self._invoke_callbacks()
+
+        def set_result(self, result):
+            self._finish(result, None)
+
+        def set_exception(self, exception):
+            self._finish(None, exception)
+
+
+class Request(Future):
     """
         Represents a request to the other end which may be not be completed yet.
         This class is automatically created by *method* Proxy.
         
+        It is a *concurrent.futures.Future*: *result*, *exception*, *done*,
+        *add_done_callback* and *cancel* work as usual, and so do 
+        *concurrent.futures.wait* and *as_completed* (where the "futures" 
+        backport is installed, in Python 2)::
+        
+            reqs = [ conn.method.lookup(key) for key in keys ]
+            for req in concurrent.futures.as_completed(reqs, timeout=5):
+                print req.result()
+        
+        Those functions and *done* don't read the socket: use them with a 
+        reading thread (see *Connection.start_reader*), or while another 
+        thread reads it. *result* and *exception* read it themselves 
+        otherwise, as *wait* does.
+        
         Parameters:
         
         **conn**
@@ -53,6 +182,10 @@ class Request(object):
             Dictionary object to serialize as JSON to send to the other end.
             (internally stored as Request.data)
             
+        **send** = True
+            If False, the request is registered to wait for its response
+            but not written: the caller sends it (see *Batch*).
+            
             
         Attributes:
         
@@ -63,20 +196,30 @@ class Request(object):
         **event_response**
             A threading.Event object, which is set to true when a response has 
             been received. Useful to wake up threads or to wait exactly until
-            the response is received.
+            the response is received. It is also set if the connection is 
+            closed before the response arrives, or the request is cancelled.
             
         **callbacks**
             List array where the developer can append functions to call when
             the response is received. The function will get the Request object
-            as a first argument.
+            as a first argument. Like the ones of *add_done_callback*, they 
+            run in a thread of the worker pool if the response is delivered 
+            by the reading thread of the connection (see 
+            *Connection.start_reader*).
 
         **request_id**
             Number of ID that identifies the call. For notifications this is None.
             Be careful because it may be not an integer. Strings and other objects
             may be valid for other implementations.
+        
+        **deadline**
+            Time (as in *time.time*) at which the request fails with 
+            *TimeoutError* if it has no response, for calls made with 
+            *Proxy.with_deadline*. None for the others.
             
     """
-    def __init__(self, conn, request_data):
+    def __init__(self, conn, request_data, send = True):
+        Future.__init__(self)
         self.conn = conn
         self.data = request_data
         self.response = None
@@ -84,15 +227,20 @@ class Request(object):
         self.callbacks = []
         self.thread_wait = self.event_response.wait
         self.request_id = None
+        self.deadline = None
+        self._timer = None # see Connection.addrequest
+        self._on_response = None # run before anything else is read.
         if 'id' in self.data: 
             self.request_id = self.data['id']
+        if 'timeout' in self.data:
+            self.deadline = time.time() + self.data['timeout']
             
         if self.request_id:
             self.conn.addrequest(self)
             
-        data = json.dumps(self.data, self.conn)
-
-        self.conn.write(data)
+        if send:
+            data = self.conn.encode(self.data)
+            self.conn.write(data)
     
     def hasresponse(self):
         """
@@ -100,7 +248,8 @@ class Request(object):
             Returns True if there it is or False if it haven't arrived yet.
         """
         if self.response is not None: return True
-        self.conn.dispatch_until_empty()
+        if not self.conn._reader_running():
+            self.conn.dispatch_until_empty()
         return self.response is not None
         
     def setresponse(self, value):
@@ -113,6 +262,19 @@ class Request(object):
             **value**
                 Value (JSON decoded) received from socket.
         """
+        self._cancel_timer()
+        if self._on_response is not None:
+            self._on_response(value)
+        if self.callbacks or getattr(self, '_done_callbacks', None):
+            if self.conn._deliver_later(self._deliver, value):
+                return
+        self._deliver(value)
+
+    def _deliver(self, value):
+        """
+            Stores the response *value*, runs the callbacks and wakes up the
+            threads waiting for it (see *setresponse*).
+        """
         self.response = value
         for callback in self.callbacks: 
             try:
@@ -120,20 +282,136 @@ class Request(object):
             except Exception, exc:
                 print "Error on callback.", repr(exc)
                 print traceback.format_exc()
-                
+        
+        if not self.done(): # a cancelled request has no result.
+            if value.get('error', None) is not None:
+                self.set_exception(ServerError(value['error']))
+            else:
+                self.set_result(map_result(value))
         self.event_response.set() # helper for threads.
     
-    def wait(self):
+    def connection_closed(self):
+        """
+            Method used by Connection instance when it is closed before the 
+            response arrives. The request fails with *exceptions.EofError*.
         """
-            Block until there is a response. Will manage the socket and dispatch
-            messages until the response is found.
+        self._cancel_timer()
+        if not self.done():
+            self.set_exception(EofError("Connection closed"))
+        self.event_response.set()
+
+    def cancel(self):
         """
-        #if self.response is None:
-        #    self.conn.read_ensure_thread()
+            Stops waiting for the response: the request is forgotten, and 
+            *result* raises *CancelledError*. Returns False if the response
+            already arrived.
             
-        while self.response is None:
-            self.conn.read_and_dispatch(condition=lambda: self.response is None)
+            The other end is told to drop the call: it doesn't run it if it
+            hasn't started yet, and doesn't send its response (see 
+            *connection.Connection.is_cancelled*).
+        """
+        if not Future.cancel(self):
+            return False
+        self._cancel_timer()
+        try:
+            if self.conn._requests.pop(self.request_id, None) is not None:
+                self.conn._send_cancel(self.request_id)
+        finally:
+            self.set_running_or_notify_cancel() # wakes concurrent.futures.wait
+            self.event_response.set()
+        return True
+
+    def expire(self):
+        """
+            Method used when the *deadline* passes. If the response didn't 
+            arrive, the request is forgotten and fails with *TimeoutError*.
+        """
+        if self.conn._requests.pop(self.request_id, None) is None:
+            return # answered, cancelled or the connection was closed.
+        if not self.done():
+            self.set_exception(TimeoutError("Deadline exceeded"))
+        self.event_response.set()
+
+    def _cancel_timer(self):
+        """
+            Cancels the timer of the *deadline*, so the timer wheel doesn't
+            keep the request alive once it isn't needed.
+        """
+        timer, self._timer = self._timer, None
+        if timer is not None:
+            get_default_wheel().cancel(timer)
+
+    def _wait_reader(self, event, condition, timeout = None):
+        """
+            Waits while *condition* is True for the reading thread of the 
+            connection to set *event*, for *timeout* seconds at most. Raises
+            *exceptions.EofError* if the connection is closed meanwhile.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while condition():
+            if self.conn.connection_status != "open":
+                raise EofError("Connection closed before the response")
+            delay = 1
+            if timeout is not None:
+                delay = min(deadline - time.time(), delay)
+                if delay <= 0:
+                    return False
+            event.wait(delay)
+        return True
+
+    def wait(self, timeout = None):
+        """
+            Block until there is a response, or for *timeout* seconds at most
+            if it is given. Will manage the socket and dispatch messages until
+            the response is found.
+            
+            If the connection has a reading thread (see 
+            *Connection.start_reader*), it sleeps until that thread delivers 
+            the response instead.
+            
+            Returns True if the request is done (see *done*), and False if 
+            the time ran out.
+        """
+        pending = lambda: not self.done()
+        if self.conn._reader_running():
+            return self._wait_reader(self.event_response, pending, timeout)
+        
+        ends = [ end for end in (timeout, self.deadline) if end is not None ]
+        if timeout is not None:
+            ends[0] += time.time()
+        while pending():
+            read_timeout = None
+            if ends:
+                read_timeout = min(ends) - time.time()
+                if read_timeout <= 0:
+                    if self.deadline is None or time.time() < self.deadline:
+                        return False
+                    self.expire() # don't wait for the timer wheel.
+                    return not pending()
+            self.conn.read_and_dispatch(timeout=read_timeout, 
+                condition=pending)
+        return True
     
+    def result(self, timeout = None):
+        """
+            Returns the value of the call, waiting for it (see *wait*) for 
+            *timeout* seconds at most if it is given. Raises 
+            *exceptions.ServerError* if the other end sent an error, 
+            *TimeoutError* if the time runs out and *CancelledError* if the 
+            request was cancelled.
+        """
+        self.wait(timeout)
+        return Future.result(self, 0)
+
+    def exception(self, timeout = None):
+        """
+            Returns the exception that *result* would raise, or None. Waits 
+            as *result* does.
+        """
+        self.wait(timeout)
+        return Future.exception(self, 0)
+
     def __call__(self):
         return self.value
         
@@ -149,11 +427,183 @@ class Request(object):
                 req_stime = rpcconn.method.getServerTime()
                 print req_stime.value  
                 print req_stime()     # equivalent to the prior line.
-                
+            
+            It is the same as *result()*.
+        """
+        return self.result()
+
+
+def map_result(response):
+    """
+        Returns the list of results of the response to a map call, with
+        *exceptions.ServerError* instances in place of the results of the 
+        calls that failed.
+    """
+    errors = response.get('errors', None)
+    if errors is None:
+        return response['result']
+    results = []
+    for result, error in zip(response['result'], errors):
+        if error is not None:
+            result = ServerError(error)
+        results.append(result)
+    return results
+
+
+class Stream(Request):
+    """
+        *Request* for a call whose result is streamed, created by the 
+        *stream* Proxy. Iterate it to get the items of the result as they
+        arrive::
+        
+            for row in conn.stream.export_rows(2010):
+                process(row)
+        
+        When the method returns a generator, the other end sends its items
+        in chunks as they are produced, so neither end holds the whole 
+        result in memory. If the generator fails halfway, the iteration 
+        raises *exceptions.ServerError* after the items sent before the 
+        error. Other results (and the ones of peers that can't stream) 
+        come in a single response, and the iteration goes through them.
+        
+        The chunks are read from the connection as the iteration needs 
+        them. If the reading thread of the connection reads them instead,
+        the other end sends no more than *Connection.stream_window* chunks
+        ahead of the ones iterated.
+        
+        Attributes (besides the ones of *Request*):
+        
+        **chunks**
+            Chunks (lists of items) received and not yet iterated.
+        
+        **event_chunk**
+            A threading.Event object, set when a chunk or the response 
+            arrives.
+    """
+    def __init__(self, conn, request_data, send = True):
+        self.chunks = deque()
+        self.event_chunk = Event()
+        self._consumed = 0 # chunks iterated, acknowledged if windowed.
+        Request.__init__(self, conn, request_data, send)
+
+    def addchunk(self, items):
+        """
+            Method used by Connection instance to deliver a chunk of the 
+            result, before the response that ends it.
         """
-        self.wait()
+        self.chunks.append(items)
+        self.event_chunk.set()
+
+    def _deliver(self, value):
+        Request._deliver(self, value)
+        self.event_chunk.set()
+
+    def connection_closed(self):
+        Request.connection_closed(self)
+        self.event_chunk.set()
+
+    def __iter__(self):
+        condition = lambda: not self.chunks and not self.done()
+        while True:
+            # Chunks arrive before the response: once it's here, the ones
+            # in self.chunks are the last ones.
+            finished = self.done()
+            while self.chunks:
+                chunk = self.chunks.popleft()
+                self._consumed += 1
+                if 'window' in self.data and not finished:
+                    self.conn._ack_stream(self.request_id, self._consumed)
+                for item in chunk:
+                    yield item
+            if finished:
+                break
+            if self.conn._reader_running():
+                self.event_chunk.clear()
+                self._wait_reader(self.event_chunk, condition)
+            else:
+                self.conn.read_and_dispatch(condition=condition)
+        
+        Future.result(self, 0) # raises the error, if any.
+        if 'streamed' not in self.response:
+            for item in self.response['result'] or []:
+                yield item
+
+
+class Batch(object):
+    """
+        Collects calls to send them to the other end in a single message (a
+        JSON array), instead of one message per call. Created by 
+        *Connection.batch*, and used as a context manager::
+        
+            with conn.batch() as batch:
+                req1 = batch.method.add2(1, 2)
+                req2 = batch.method.getabc(a=1)
+                batch.notify.ping()
+            print req1.value, req2.value
+        
+        The message is sent when the *with* block ends. If the block raises
+        an exception, nothing is sent and the requests are forgotten.
+        
+        Attributes:
+        
+        **method**
+            Asynchronous Proxy. Adds the call to the batch and returns its 
+            *Request*, which gets the response as usual once the batch is sent.
+        
+        **notify**
+            Notification Proxy. Adds the notification to the batch and 
+            returns *None*.
         
-        if self.response.get('error', None) is not None:
-            raise ServerError(self.response['error'])
+        There is no synchronous *call* proxy: the value can't be known until
+        the batch is sent.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.items = []
+        self.requests = []
+        self.method = Proxy(self, sync_type=1)
+        self.notify = Proxy(self, sync_type=2)
+
+    def proxy(self, sync_type, name, args, kwargs, deadline = None):
+        """
+            Adds a call to the batch. Called by the proxies.
+        """
+        assert(sync_type in [1, 2])
+        data = self.conn._build_request(sync_type, name, args, kwargs, 
+            deadline)
+        self.items.append(data)
+        if sync_type == 2:
+            return None
+        req = Request(self.conn, data, send = False)
+        self.requests.append(req)
+        return req
+
+    def send(self):
+        """
+            Sends the calls added so far in one message, and empties the 
+            batch. Called when the *with* block ends.
+        """
+        items, self.items, self.requests = self.items, [], []
+        if items:
+            self.conn.write(self.conn.encode(items))
+
+    def discard(self):
+        """
+            Forgets the calls added so far without sending them. Their 
+            requests are cancelled (see *Request.cancel*).
+        """
+        for req in self.requests:
+            # Forgotten first, so the other end isn't told to cancel them.
+            self.conn._requests.pop(req.request_id, None)
+            req.cancel()
+        self.items, self.requests = [], []
+
+    def __enter__(self):
+        return self
 
-        return self.response['result']        
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.send()
+        else:
+            self.discard()
+        return False
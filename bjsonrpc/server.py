@@ -31,10 +31,19 @@
     POSSIBILITY OF SUCH DAMAGE.
 
 """
-import socket, select
+import socket, threading, os, sys, time, signal, traceback, errno
+from collections import deque
 
 from bjsonrpc.connection import Connection
 from bjsonrpc.exceptions import EofError
+from bjsonrpc.poller import Poller, EVENT_READ, EVENT_WRITE
+from bjsonrpc import workers, timers
+
+# accept() errors which only mean there is nothing to accept now.
+_ACCEPT_RETRY = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED, 
+    errno.ECONNRESET, errno.EPROTO, errno.EINTR)
+# accept() errors which last until other sockets are closed.
+_ACCEPT_EXHAUSTED = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
 
 class Server(object):
     """
@@ -56,12 +65,23 @@ class Server(object):
             connections. Should be an inherited class of *bjsonrpc.handlers.BaseHandler*
             
     """
+    accept_batch = 64
+    # Maximum number of sockets accepted on each loop iteration.
+    accept_backoff = 1.0
+    # Seconds the listening socket is not watched after running out of file
+    # descriptors, so the loop doesn't spin on connections it can't accept.
+
     def __init__(self, lstsck, handler_factory):
         self._lstsck = lstsck
         self._handler = handler_factory
         self._debug_socket = False
         self._debug_dispatch = False
         self._serve = True
+        self._wakeup_socks = None
+        self._loop_thread = None
+        self._flush_queue = deque()
+        self._accept_resume = None # when to watch the listening socket again
+        self._accept_exhausted = False
     
     def stop(self):
         """
@@ -69,7 +89,30 @@ class Server(object):
             Once stopped, call again to *serve()* to start the server loop again.
         """
         self._serve = False
-    
+        self._wakeup()
+
+    def _request_flush(self, conn):
+        """
+            Called by the connections of this server when they have buffered
+            data to send. The serving loop sends it (and keeps watching the 
+            socket for writability if it can't be sent at once).
+        """
+        self._flush_queue.append(conn)
+        if threading.current_thread() is not self._loop_thread:
+            self._wakeup()
+
+    def _wakeup(self):
+        """
+            Wakes up the serving loop if it is waiting for events.
+        """
+        wakeup_socks = self._wakeup_socks # the loop may be exiting.
+        if wakeup_socks is None:
+            return
+        try:
+            wakeup_socks[1].send("x")
+        except socket.error:
+            pass # The buffer is full, so the loop will wake up anyway.
+
     def debug_socket(self, value = None):
         """
             Sets or retrieves the internal debug_socket value.
@@ -108,71 +151,70 @@ class Server(object):
             Exception is raised inside, by unexpected error, KeyboardInterrput,
             etc.
             
-            It is coded using *select.select* function, and it is capable to 
-            serve to an unlimited amount of connections at same time 
-            without using threading.
+            It is coded using *bjsonrpc.poller.Poller* (epoll on Linux), and it
+            is capable to serve to a large amount of connections at same time 
+            without using threading. Each socket is registered once when it is
+            accepted and unregistered when its connection is closed.
+            
+            Connections don't have a writing thread: their outgoing data is
+            sent by this loop, so the number of threads doesn't grow with the
+            number of connections. While the write queue of a connection is
+            above its high watermark (see *Connection.write_policy*), the
+            loop stops reading from it.
         """
         self._serve = True
+        self._loop_thread = threading.current_thread()
+        self._accept_resume = None
+        self._lstsck.setblocking(0)
+        poller = Poller()
+        connidx = {}
+        lstfileno = self._lstsck.fileno()
+        poller.register(lstfileno, EVENT_READ)
+        if hasattr(socket, "socketpair"):
+            self._wakeup_socks = socket.socketpair()
+            for sck in self._wakeup_socks:
+                sck.setblocking(0)
+            wakefileno = self._wakeup_socks[0].fileno()
+            poller.register(wakefileno, EVENT_READ)
+            timeout = None
+        else:
+            wakefileno = None
+            timeout = 1
         try:
-            sockets = []
-            connections = []
-            connidx = {}
             while self._serve:
-                try:
-                    ready_to_read = select.select( 
-                        [self._lstsck]+sockets, # read
-                        [], [], # write, errors
-                        1 # timeout
-                        )[0]
-                except Exception:
-                    # Probably a socket is no longer valid.
-                    a = self._lstsck.fileno() # if this is not valid, raise Exception, exit.
-                    newsockets = []
-                    for sck in sockets:
-                        try:
-                            a = sck.fileno()
-                            h = sck.getpeername()
-                        except Exception:
-                            continue
-                        newsockets.append(sck)
-                    sockets[:] = newsockets
-                    continue
-                if not ready_to_read: 
-                    continue
-                    
-                if self._lstsck in ready_to_read:
-                    clientsck, clientaddr = self._lstsck.accept()
-                    sockets.append(clientsck)
-            
-                    conn = Connection(
-                            sck = clientsck, address = clientaddr, 
-                            handler_factory = self._handler
-                            )
-                    connidx[clientsck.fileno()] = conn
-                    conn._debug_socket = self._debug_socket
-                    conn._debug_dispatch = self._debug_socket
-                    # conn.internal_error_callback = self.
-                    
-                    connections.append(conn)
-                
-                for sck in ready_to_read:
-                    fileno = sck.fileno()
-                    if fileno not in connidx: 
-                        continue
-                        
-                    conn = connidx[fileno]
-                    try:
-                        conn.dispatch_until_empty()
-                    except EofError:
-                        conn.close()
-                        sockets.remove(conn.socket)
-                        connections.remove(conn)
-                        #print "Closing client conn."
-                    
+                wait = timeout
+                if self._accept_resume is not None:
+                    left = self._accept_resume - time.time()
+                    if left <= 0:
+                        self._accept_resume = None
+                        poller.register(lstfileno, EVENT_READ)
+                    elif wait is None or left < wait:
+                        wait = left
+                if self._flush_queue:
+                    wait = 0 # queued by the loop itself: nobody wakes it.
+                for fileno, events in poller.poll(wait):
+                    if fileno == lstfileno:
+                        self._accept(poller, connidx)
+                    elif fileno == wakefileno:
+                        self._drain_wakeup()
+                    elif fileno in connidx:
+                        conn = connidx[fileno]
+                        if events & EVENT_WRITE:
+                            self._flush_queue.append(conn)
+                        if events & EVENT_READ:
+                            self._dispatch(poller, connidx, fileno, conn)
+                self._flush_connections(poller, connidx)
 
         finally:
-            for conn in connections: 
+            self._loop_thread = None
+            for conn in connidx.values():
                 conn.close()
+            self._flush_queue.clear()
+            poller.close()
+            if self._wakeup_socks is not None:
+                wakeup_socks, self._wakeup_socks = self._wakeup_socks, None
+                for sck in wakeup_socks:
+                    sck.close()
             try:
                 self._lstsck.shutdown(socket.SHUT_RDWR)
             except Exception:
@@ -182,3 +224,250 @@ class Server(object):
             except Exception:
                 pass
 
+    def _accept(self, poller, connidx):
+        """
+            Accepts the pending client sockets (up to *accept_batch*) and 
+            registers their connections.
+            
+            When the process runs out of file descriptors, the listening 
+            socket stays readable: it is unregistered for *accept_backoff* 
+            seconds instead, and the condition is reported once until a 
+            socket is accepted again.
+        """
+        for i in range(self.accept_batch):
+            try:
+                clientsck, clientaddr = self._lstsck.accept()
+            except socket.error, exc:
+                if exc.args[0] in _ACCEPT_RETRY:
+                    return # No more pending, or the client went away.
+                if exc.args[0] not in _ACCEPT_EXHAUSTED:
+                    raise
+                if not self._accept_exhausted:
+                    self._accept_exhausted = True
+                    sys.stderr.write("Can't accept connections: %s. "
+                        "Retrying every %s seconds.\n" % (exc.args[-1], 
+                        self.accept_backoff))
+                poller.unregister(self._lstsck.fileno())
+                self._accept_resume = time.time() + self.accept_backoff
+                return
+            self._accept_exhausted = False
+            self._addconnection(poller, connidx, clientsck, clientaddr)
+
+    def _addconnection(self, poller, connidx, clientsck, clientaddr):
+        """
+            Creates the connection for an accepted socket and registers it.
+        """
+        fileno = clientsck.fileno()
+        if fileno in connidx:
+            # The old socket with this number was closed behind our back.
+            poller.unregister(fileno)
+            del connidx[fileno]
+
+        conn = Connection(
+                sck = clientsck, address = clientaddr, 
+                handler_factory = self._handler, server = self
+                )
+        conn._debug_socket = self._debug_socket
+        conn._debug_dispatch = self._debug_socket
+        # conn.internal_error_callback = self.
+        connidx[fileno] = conn
+        poller.register(fileno, EVENT_READ)
+
+    def _dispatch(self, poller, connidx, fileno, conn):
+        """
+            Dispatches the messages received by a connection, and forgets 
+            it if it was closed.
+        """
+        try:
+            conn.dispatch_until_empty()
+        except EofError:
+            conn.close()
+        if conn.connection_status == "closed":
+            poller.unregister(fileno)
+            del connidx[fileno]
+            #print "Closing client conn."
+
+    def _flush_connections(self, poller, connidx):
+        """
+            Sends the data buffered by the connections that asked for it,
+            and watches for writability the sockets that couldn't take all.
+        """
+        # Connections queued again while we flush are left for the next
+        # pass: they woke up the loop, so it won't wait for events.
+        conns = set()
+        while self._flush_queue:
+            conns.add(self._flush_queue.popleft())
+        for conn in conns:
+            if conn.connection_status == "closed":
+                continue
+            fileno = conn.socket.fileno()
+            if connidx.get(fileno) is not conn:
+                continue
+            events = EVENT_READ
+            if conn.flush():
+                events |= EVENT_WRITE
+                if conn._wpaused:
+                    # Its write queue is full: don't read more calls from
+                    # a peer that doesn't read the responses.
+                    events = EVENT_WRITE
+            poller.modify(fileno, events)
+            if not conn._wpaused and conn._has_buffered_line():
+                # It stopped while paused with messages already read: the
+                # socket won't tell us about them.
+                self._dispatch(poller, connidx, fileno, conn)
+
+    def _drain_wakeup(self):
+        """
+            Empties the wake-up socket after *_wakeup* was called.
+        """
+        try:
+            while self._wakeup_socks[0].recv(4096):
+                pass
+        except socket.error:
+            pass
+
+
+class PreforkServer(object):
+    """
+        Serves with several processes: it forks *workers* child processes, 
+        each one running its own *Server* loop on the same port, and restarts
+        the ones that die. Usually created by 
+        *bjsonrpc.createserver(..., workers=N)*.
+        
+        Where the platform supports *SO_REUSEPORT*, each worker listens on a 
+        socket of its own and the kernel spreads the incoming connections
+        among them. Otherwise the workers share the listening socket created
+        by the supervisor.
+        
+        Parameters:
+        
+        **address**
+            (host, port) tuple to listen to.
+            
+        **handler_factory**
+            Class (object type) to instantiate to publish methods for incoming
+            connections. Should be an inherited class of *bjsonrpc.handlers.BaseHandler*
+            
+        **workers**
+            Number of worker processes.
+        
+        Each connection lives in one worker process, so handlers can't share
+        state in memory through class attributes or globals. 
+        
+        Call *serve()* from the main thread, before starting other threads:
+        workers are created with *os.fork*. Only available on Unix.
+    """
+    check_interval = 0.5
+    # Seconds between checks for dead workers.
+    
+    restart_delay = 1
+    # Seconds to wait before restarting a worker that died right after
+    # starting, so a broken handler doesn't make the server fork in a loop.
+
+    def __init__(self, address, handler_factory, workers):
+        assert(workers > 0)
+        self.address = address
+        self.workers = workers
+        self.reuseport = hasattr(socket, "SO_REUSEPORT")
+        self._handler = handler_factory
+        self._serve = True
+        self._pids = {}
+        # The port is bound here so errors show up at once. With SO_REUSEPORT
+        # this socket doesn't listen: it only holds the port.
+        self._lstsck = self._socket(listen = not self.reuseport)
+    
+    def _socket(self, listen):
+        """
+            Creates a socket bound to *address*.
+        """
+        sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sck.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuseport:
+            sck.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sck.bind(self.address)
+        if listen:
+            sck.listen(socket.SOMAXCONN)
+        return sck
+
+    @property
+    def pids(self):
+        """ Process ids of the running workers """
+        return self._pids.keys()
+
+    def stop(self):
+        """
+            Tells the server that it should stop. The workers are terminated
+            and *serve()* returns once they are gone.
+        """
+        self._serve = False
+        self._kill(signal.SIGTERM)
+
+    def serve(self):
+        """
+            Starts the workers and supervises them until *stop()* is called:
+            workers that exit or get killed are replaced by new ones.
+        """
+        self._serve = True
+        try:
+            while self._serve:
+                while len(self._pids) < self.workers and self._serve:
+                    self._spawn()
+                time.sleep(self.check_interval)
+                self._reap()
+        finally:
+            self._kill(signal.SIGTERM)
+            while self._pids:
+                self._reap(block = True)
+            self._lstsck.close()
+
+    def _spawn(self):
+        """
+            Forks a new worker.
+        """
+        pid = os.fork()
+        if pid:
+            self._pids[pid] = time.time()
+            return
+        status = 1
+        try:
+            try:
+                workers._after_fork()
+                timers._after_fork()
+                if self.reuseport:
+                    self._lstsck.close()
+                    self._lstsck = self._socket(listen = True)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                Server(self._lstsck, handler_factory=self._handler).serve()
+                status = 0
+            except Exception:
+                sys.stderr.write("Worker %d failed:\n%s" % (os.getpid(), 
+                    traceback.format_exc()))
+        finally:
+            os._exit(status)
+
+    def _reap(self, block = False):
+        """
+            Forgets the workers that have finished.
+        """
+        for pid, started in self._pids.items():
+            try:
+                wpid = os.waitpid(pid, 0 if block else os.WNOHANG)[0]
+            except OSError, exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                wpid = pid # Reaped by someone else.
+            if wpid != pid:
+                continue
+            del self._pids[pid]
+            if self._serve and time.time() - started < self.restart_delay:
+                time.sleep(self.restart_delay)
+
+    def _kill(self, signum):
+        """
+            Sends *signum* to every worker.
+        """
+        for pid in self._pids.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
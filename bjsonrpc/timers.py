@@ -0,0 +1,205 @@
+"""
+    bjson/timers.py
+    
+    Asynchronous Bidirectional JSON-RPC protocol implementation over TCP/IP
+    
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions
+    are met:
+    1. Redistributions of source code must retain the above copyright
+       notice, this list of conditions and the following disclaimer.
+    2. Redistributions in binary form must reproduce the above copyright
+       notice, this list of conditions and the following disclaimer in the
+       documentation and/or other materials provided with the distribution.
+    3. Neither the name of copyright holders nor the names of its
+       contributors may be used to endorse or promote products derived
+       from this software without specific prior written permission.
+
+    THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+    ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+    TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+    PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+    BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+    CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+"""
+import threading, traceback, time, atexit
+
+__all__ = [
+    "TimerWheel",
+    "get_default_wheel",
+]
+
+class TimerWheel(object):
+    """
+        Hashed timer wheel: runs functions at a given time from a single
+        thread, with a precision of *tick* seconds. Adding a timer costs the
+        same whatever the number of timers pending, so every request can
+        have one (see *request.Request.deadline*).
+
+        *add* returns a handle to *cancel* the timer: the wheel forgets its
+        function at once, so what it references can be freed before the time
+        comes.
+
+        Parameters:
+
+        **tick** = 0.01
+            Seconds between passes of the thread. Timers run at most this
+            late.
+
+        **slots** = 512
+            Number of slots of the wheel. Timers further away than one turn
+            (*tick* \* *slots* seconds) are looked at once on each turn.
+    """
+    def __init__(self, tick = 0.01, slots = 512):
+        assert(tick > 0 and slots > 0)
+        self.tick = tick
+        self._slots = [ [] for i in range(slots) ]
+        self._count = 0
+        self._position = int(time.time() / tick) # next tick to look at
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self._stopped = False
+
+    def add(self, when, function, *args):
+        """
+            Runs *function(\*args)* from the thread of the wheel once the
+            time (as in *time.time*) is *when*. Returns the handle of the 
+            timer (see *cancel*).
+        """
+        timer = [when, function, args]
+        self._cond.acquire()
+        try:
+            ticknum = max(int(when / self.tick) + 1, self._position)
+            self._slots[ticknum % len(self._slots)].append(timer)
+            self._count += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name="bjsonrpc-timers")
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._count == 1:
+                self._cond.notify()
+        finally:
+            self._cond.release()
+        return timer
+
+    def cancel(self, timer):
+        """
+            Cancels the *timer* returned by *add*, if it didn't run yet. 
+            Its entry stays in its slot until the time comes, without the 
+            function and its arguments.
+        """
+        self._cond.acquire()
+        try:
+            if timer[1] is not None:
+                timer[1] = None
+                timer[2] = ()
+                self._count -= 1
+        finally:
+            self._cond.release()
+
+    def stop(self):
+        """
+            Stops the thread of the wheel. The timers pending don't run.
+        """
+        self._cond.acquire()
+        try:
+            self._stopped = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def __len__(self):
+        """ Number of timers pending """
+        return self._count
+
+    def _expired(self, now):
+        """
+            Takes the timers due at *now* out of the slots passed since the
+            last call, and returns the (function, args) of the ones not 
+            cancelled. Must be called with *_cond* held.
+        """
+        current = int(now / self.tick)
+        # After a whole turn every slot has been looked at.
+        steps = min(current - self._position + 1, len(self._slots))
+        due = []
+        for ticknum in range(self._position, self._position + steps):
+            index = ticknum % len(self._slots)
+            slot = self._slots[index]
+            if not slot:
+                continue
+            keep = [ timer for timer in slot if timer[0] > now ]
+            if len(keep) != len(slot):
+                for timer in slot:
+                    if timer[0] <= now and timer[1] is not None:
+                        due.append((timer[1], timer[2]))
+                        timer[1] = None # too late to cancel it.
+                self._slots[index] = keep
+        self._position = max(current + 1, self._position)
+        self._count -= len(due)
+        return due
+
+    def _run(self):
+        """ Body of the thread of the wheel """
+        self._cond.acquire()
+        try:
+            while not self._stopped:
+                if not self._count:
+                    self._cond.wait()
+                    continue
+                due = self._expired(time.time())
+                if due:
+                    self._cond.release()
+                    try:
+                        for function, args in due:
+                            try:
+                                function(*args)
+                            except Exception:
+                                print "Unhandled error in timer:"
+                                print traceback.format_exc()
+                    finally:
+                        self._cond.acquire()
+                delay = self._position * self.tick - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+        finally:
+            self._cond.release()
+
+
+_default_wheel = None
+_default_wheel_lock = threading.Lock()
+
+def get_default_wheel():
+    """
+        Returns the timer wheel shared by all the connections, which expires
+        the requests with a deadline. It is created on first use.
+    """
+    global _default_wheel
+    _default_wheel_lock.acquire()
+    try:
+        if _default_wheel is None:
+            _default_wheel = TimerWheel()
+            # Don't leave the thread waiting while the interpreter exits.
+            atexit.register(_default_wheel.stop)
+        return _default_wheel
+    finally:
+        _default_wheel_lock.release()
+
+def _after_fork():
+    """
+        Called in a child process right after *os.fork*: the thread of the
+        wheel of the parent doesn't exist in the child, so it forgets the
+        wheel and creates its own on first use.
+    """
+    global _default_wheel, _default_wheel_lock
+    _default_wheel = None
+    _default_wheel_lock = threading.Lock()
@@ -0,0 +1,341 @@
+"""
+    bjson/workers.py
+    
+    Asynchronous Bidirectional JSON-RPC protocol implementation over TCP/IP
+    
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions
+    are met:
+    1. Redistributions of source code must retain the above copyright
+       notice, this list of conditions and the following disclaimer.
+    2. Redistributions in binary form must reproduce the above copyright
+       notice, this list of conditions and the following disclaimer in the
+       documentation and/or other materials provided with the distribution.
+    3. Neither the name of copyright holders nor the names of its
+       contributors may be used to endorse or promote products derived
+       from this software without specific prior written permission.
+
+    THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+    ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+    TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+    PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+    BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+    CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+"""
+import threading, traceback, sys, time
+import cPickle as pickle
+from Queue import Queue, Full
+
+from bjsonrpc import bjsonrpc_options
+from bjsonrpc.timers import get_default_wheel
+
+__all__ = [
+    "WorkerPool",
+    "get_default_pool",
+    "get_process_pool",
+    "run_in_process",
+]
+
+class WorkerPool(object):
+    """
+        Fixed-size pool of threads which run the items dispatched by
+        connections in threaded mode. Threads are started as they are needed,
+        up to *size*; items that don't find a free thread wait in a queue.
+
+        Parameters:
+
+        **size** = 16
+            Maximum number of threads, i.e. of items running at the same time.
+
+        **queue_size** = 1000
+            Maximum number of items waiting for a thread. When the queue is
+            full, *submit* blocks and *submit_nowait* raises *Queue.Full*:
+            the threads that read connections use the latter, and answer 
+            the calls that don't fit with an error (see 
+            *Connection._submit*). 0 means unlimited.
+    """
+    def __init__(self, size = 16, queue_size = 1000):
+        assert(size > 0)
+        self.size = size
+        self.queue_size = queue_size
+        self._queue = Queue(queue_size)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._idle = 0    # threads waiting for an item nobody took yet.
+        self._backlog = 0 # items waiting for a thread to finish.
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'max_queued': 0,
+        }
+
+    def submit(self, function, *args):
+        """
+            Queues *function(\*args)* to be run by a thread of the pool.
+            Blocks while the queue is full.
+        """
+        self._put((function, args), True)
+
+    def submit_nowait(self, function, *args):
+        """
+            Like *submit*, but raises *Queue.Full* instead of blocking when
+            the queue is full.
+        """
+        self._put((function, args), False)
+
+    def _put(self, task, block):
+        """ Queues *task*, and starts a thread for it if needed. """
+        self._queue.put(task, block)
+        self._lock.acquire()
+        try:
+            if self._idle:
+                self._idle -= 1
+            elif len(self._threads) < self.size:
+                self._start_thread()
+            else:
+                self._backlog += 1
+            self._stats['submitted'] += 1
+            queued = self._queue.qsize()
+            if queued > self._stats['max_queued']:
+                self._stats['max_queued'] = queued
+        finally:
+            self._lock.release()
+
+    def qsize(self):
+        """
+            Number of items waiting for a thread.
+        """
+        return self._queue.qsize()
+
+    def getstats(self):
+        """
+            Returns a dictionary with the counters of the pool:
+
+            **threads**
+                Threads started.
+
+            **busy**
+                Threads running an item now.
+
+            **queued**
+                Items waiting for a thread (see *qsize*).
+
+            **max_queued**
+                Highest number of items seen waiting.
+
+            **submitted**, **completed**
+                Items submitted to and finished by the pool.
+        """
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['threads'] = len(self._threads)
+            stats['busy'] = len(self._threads) - self._idle
+        finally:
+            self._lock.release()
+        stats['queued'] = self._queue.qsize()
+        return stats
+
+    def shutdown(self, wait = True):
+        """
+            Stops the threads of the pool once the queued items are done.
+        """
+        self._lock.acquire()
+        try:
+            threads, self._threads = self._threads, []
+            self._idle = self._backlog = 0
+        finally:
+            self._lock.release()
+        for thread in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _start_thread(self):
+        """ Starts one more thread. Must be called with *_lock* held. """
+        thread = threading.Thread(target=self._worker,
+            name="bjsonrpc-worker-%d" % len(self._threads))
+        thread.daemon = True
+        self._threads.append(thread)
+        thread.start()
+
+    def _worker(self):
+        """ 
+            Body of the threads of the pool. Each thread is started for an 
+            item, and takes another one from the backlog when it finishes, 
+            or waits as idle for the next one submitted.
+        """
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            function, args = task
+            try:
+                function(*args)
+            except Exception:
+                print "Unhandled error in worker thread:"
+                print traceback.format_exc()
+            self._lock.acquire()
+            self._stats['completed'] += 1
+            if self._backlog:
+                self._backlog -= 1
+            else:
+                self._idle += 1
+            self._lock.release()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def get_default_pool():
+    """
+        Returns the pool shared by all the connections which don't have one
+        of their own. It is created on first use, with the size given by
+        *bjsonrpc_options['worker_threads']* and
+        *bjsonrpc_options['worker_queue_size']*.
+    """
+    global _default_pool
+    _default_pool_lock.acquire()
+    try:
+        if _default_pool is None:
+            _default_pool = WorkerPool(bjsonrpc_options['worker_threads'],
+                bjsonrpc_options['worker_queue_size'])
+        return _default_pool
+    finally:
+        _default_pool_lock.release()
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def get_process_pool():
+    """
+        Returns the *multiprocessing.Pool* which runs the handler methods
+        marked with *bjsonrpc.handlers.process_method*. It is created on first
+        use with *bjsonrpc_options['process_pool_size']* processes (None 
+        means one per CPU).
+    """
+    global _process_pool
+    _process_pool_lock.acquire()
+    try:
+        if _process_pool is None:
+            import multiprocessing
+            _process_pool = multiprocessing.Pool(
+                bjsonrpc_options['process_pool_size'])
+        return _process_pool
+    finally:
+        _process_pool_lock.release()
+
+def _after_fork():
+    """
+        Called in a child process right after *os.fork* (see 
+        *server.PreforkServer*): the threads of the pools of the parent 
+        don't exist in the child, so it forgets them and creates its own on
+        first use.
+    """
+    global _default_pool, _default_pool_lock, _process_pool, _process_pool_lock
+    _default_pool = None
+    _default_pool_lock = threading.Lock()
+    _process_pool = None
+    _process_pool_lock = threading.Lock()
+
+def run_in_process(cls, name, args, kwargs, callback, timeout = None):
+    """
+        Runs method *name* of handler class *cls* in the process pool, and
+        calls *callback(ok, value)* from another thread when it finishes: 
+        *value* is the result if *ok* is True, or the error message.
+        
+        The pool doesn't tell when one of its processes dies, killed by the
+        system for example: the calls it was running never finish. If 
+        *timeout* (in seconds) is not None, *callback* gets an error once it
+        passes without a result, and a result that comes later is ignored.
+        
+        Arguments and results are pickled: they can't be remote objects or
+        references to functions.
+    """
+    try:
+        payload = pickle.dumps((args, kwargs), pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        etype, evalue = sys.exc_info()[:2]
+        callback(False, "%s: %s" % (etype.__name__, evalue))
+        return
+    lock = threading.Lock()
+    pending = [True]
+    watchdog = [None] # handle of the timer of expire()
+    def finish(ok, value):
+        lock.acquire()
+        try:
+            first, pending[0] = pending[0], False
+            timer, watchdog[0] = watchdog[0], None
+        finally:
+            lock.release()
+        if timer is not None:
+            get_default_wheel().cancel(timer)
+        if first:
+            callback(ok, value)
+    def done(outcome):
+        # Runs in the result thread of the pool: it must not raise.
+        ok, value = outcome
+        if ok:
+            try:
+                value = pickle.loads(value)
+            except Exception:
+                etype, evalue = sys.exc_info()[:2]
+                ok, value = False, "%s: %s" % (etype.__name__, evalue)
+        finish(ok, value)
+    result = get_process_pool().apply_async(_process_method,
+        (cls.__module__, cls.__name__, name, payload), callback=done)
+    if timeout is not None:
+        def expire():
+            if not result.ready():
+                finish(False, "ProcessTimeout: no result after %s seconds" 
+                    % timeout)
+        lock.acquire()
+        try:
+            if pending[0]:
+                watchdog[0] = get_default_wheel().add(time.time() + timeout,
+                    expire)
+        finally:
+            lock.release()
+
+def _process_method(modulename, classname, name, payload):
+    """
+        Runs in the pool processes. The method is called on a bare instance
+        of the handler class (created without calling __init__), because the
+        handler of the connection can't be sent to another process.
+        
+        It always returns a picklable (ok, value) tuple: the result comes
+        pickled, so an error pickling it is reported like any other error.
+        Methods that fail looking up attributes of that instance are told 
+        why they are missing.
+    """
+    from bjsonrpc.exceptions import ServerError
+    try:
+        args, kwargs = pickle.loads(payload)
+        module = sys.modules.get(modulename) or __import__(modulename, 
+            fromlist=[classname])
+        cls = getattr(module, classname)
+        function = getattr(cls.__new__(cls), name)
+        result = function(*args, **kwargs)
+        return (True, pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+    except ServerError, exc:
+        return (False, '%s' % (exc))
+    except Exception:
+        etype, evalue = sys.exc_info()[:2]
+        print "In process pool method %s.%s:" % (classname, name)
+        print traceback.format_exc()
+        error = "%s: %s" % (etype.__name__, evalue)
+        if etype is AttributeError and ("'%s' object" % classname) in error:
+            error += (" (process_method methods run on a bare instance of "
+                "the handler, without __init__ or a connection)")
+        return (False, error)
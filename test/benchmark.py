@@ -0,0 +1,244 @@
+"""
+    Micro-benchmarks for bjsonrpc internals.
+
+    They are not unit-tests: run them by hand to compare the cost of some
+    operation across changes or payload sizes::
+
+        python benchmark.py             # runs all the benchmarks
+        python benchmark.py writeline   # runs only the named ones
+"""
+import sys
+sys.path.insert(0, "../")
+import multiprocessing
+import socket
+import threading
+import time
+
+import bjsonrpc
+import bjsonrpc.jsonlib
+import bjsonrpc.packlib
+from bjsonrpc.connection import Connection
+from bjsonrpc.handlers import BaseHandler, NullHandler
+
+BENCHMARKS = []
+
+def benchmark(function):
+    """ Registers *function* as a benchmark """
+    BENCHMARKS.append(function)
+    return function
+
+def drain(sck):
+    """ Reads and discards everything from *sck* until it's closed """
+    while sck.recv(1 << 20):
+        pass
+
+@benchmark
+def writeline():
+    """
+        Time of Connection.write_line for growing payloads. The time per MB
+        should stay (roughly) constant.
+    """
+    for size_mb in [1, 2, 4, 8, 16]:
+        sck1, sck2 = socket.socketpair()
+        reader = threading.Thread(target=drain, args=(sck2,))
+        reader.start()
+        conn = Connection(sck1)
+        data = "x" * (size_mb * 1024 * 1024)
+        start = time.time()
+        conn.write_line(data)
+        elapsed = time.time() - start
+        sck1.close()
+        reader.join()
+        sck2.close()
+        print "  %3d MB: %8.2f ms  (%.2f ms/MB)" % (
+            size_mb, elapsed * 1000, elapsed * 1000 / size_mb)
+
+@benchmark
+def notifyburst():
+    """
+        Bursts of notifications with different write_cork values. Shows the
+        number of messages sent on each syscall.
+    """
+    for cork in [0, 100, 1000]:
+        sck1, sck2 = socket.socketpair()
+        reader = threading.Thread(target=drain, args=(sck2,))
+        reader.start()
+        conn = Connection(sck1, handler_factory=NullHandler)
+        conn.write_cork = cork
+        start = time.time()
+        for i in range(20000):
+            conn.notify.ping(i)
+        conn.close()
+        elapsed = time.time() - start
+        reader.join()
+        sck2.close()
+        stats = conn.getstats()
+        print "  cork %4d us: %8.2f ms  %6d syscalls  (%.1f msgs/syscall)" % (
+            cork, elapsed * 1000, stats['send_calls'], 
+            stats['messages_per_send'])
+
+def suitemessages():
+    """
+        Runs the tests of TestJSONBasics (test_main.py) and returns the
+        messages that both ends send meanwhile, decoded as plain data.
+    """
+    import json, os, unittest
+    import test_main
+    messages = []
+    dumps = bjsonrpc.jsonlib.dumps
+    def recording(argobj, conn):
+        text = dumps(argobj, conn)
+        messages.append(json.loads(text))
+        return text
+    stdout = sys.stdout
+    bjsonrpc.jsonlib.dumps = recording
+    sys.stdout = open(os.devnull, "w") # the tests print their errors.
+    try:
+        suite = unittest.TestLoader().loadTestsFromTestCase(
+            test_main.TestJSONBasics)
+        unittest.TextTestRunner(stream=sys.stdout).run(suite)
+    finally:
+        sys.stdout = stdout
+        bjsonrpc.jsonlib.dumps = dumps
+    return messages
+
+def timecodec(name, module, conn, messages, shape):
+    """ Prints the time to dump and load *messages* with *module* """
+    if not messages:
+        return
+    texts = [ module.dumps(message, conn) for message in messages ]
+    size = sum(len(text) for text in texts)
+    count = max(3, 20000000 / size)
+    start = time.time()
+    for i in xrange(count):
+        for message in messages:
+            module.dumps(message, conn)
+    dump_time = (time.time() - start) / count / len(messages)
+    start = time.time()
+    for i in xrange(count):
+        for text in texts:
+            module.loads(text, conn)
+    load_time = (time.time() - start) / count / len(messages)
+    print "  %-16s %-6s %9d bytes: dumps %8.1f us, loads %8.1f us" % (
+        name, shape, size, dump_time * 1e6, load_time * 1e6)
+
+@benchmark
+def codecs():
+    """
+        Time to dump and load the messages sent by the tests of 
+        TestJSONBasics, with each available JSON codec (see 
+        bjsonrpc.jsonlib.register_codec) and with MessagePack 
+        (bjsonrpc.packlib), with and without the msgpack library.
+    """
+    messages = suitemessages()
+    sck1, sck2 = socket.socketpair()
+    conn = Connection(sck1, handler_factory=NullHandler)
+    # The few big messages of test_largemessage would hide the others.
+    small, large = [], []
+    for message in messages:
+        if len(bjsonrpc.jsonlib.dumps(message, conn)) < 4096:
+            small.append(message)
+        else:
+            large.append(message)
+    print "  %d messages (times per message)" % len(messages)
+    def timeshapes(name, module):
+        timecodec(name, module, conn, small, "small")
+        timecodec(name, module, conn, large, "large")
+    active = bjsonrpc.jsonlib.active_codec()
+    msgpack = bjsonrpc.packlib._msgpack
+    try:
+        for name in bjsonrpc.jsonlib.available_codecs():
+            bjsonrpc.jsonlib.use_codec(name)
+            timeshapes(name, bjsonrpc.jsonlib)
+        if msgpack is not None:
+            timeshapes("msgpack", bjsonrpc.packlib)
+        bjsonrpc.packlib._msgpack = None
+        timeshapes("msgpack (python)", bjsonrpc.packlib)
+    finally:
+        bjsonrpc.jsonlib.use_codec(active)
+        bjsonrpc.packlib._msgpack = msgpack
+        sck1.close()
+        sck2.close()
+
+class PingHandler(BaseHandler):
+    def ping(self):
+        return "pong"
+
+def serveping(port, ready):
+    """ Serves PingHandler on *port* until terminated """
+    server = bjsonrpc.createserver(port=port, handler_factory=PingHandler)
+    ready.set()
+    server.serve()
+
+def startserver(port):
+    """ 
+        Starts a server in a child process, so it gets its own limit of 
+        open files. Returns the process. 
+    """
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=serveping, args=(port, ready))
+    process.daemon = True
+    process.start()
+    ready.wait()
+    return process
+
+def processstatus(pid):
+    """ Thread count and memory of process *pid* (Linux only) """
+    try:
+        lines = open("/proc/%d/status" % pid).readlines()
+    except IOError:
+        return "n/a"
+    values = dict(line.split(":", 1) for line in lines)
+    return "%s threads, %s RSS" % (
+        values["Threads"].strip(), values["VmRSS"].strip())
+
+@benchmark
+def idleconnections():
+    """
+        Throughput of a few active clients while the server holds thousands
+        of idle connections. Needs a high limit of open files (ulimit -n).
+    """
+    port = 10200
+    active, calls = 4, 1000
+    for nidle in [1000, 5000, 10000]:
+        port += 1
+        server = startserver(port)
+        idle = []
+        start = time.time()
+        for i in range(nidle):
+            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sck.connect(("127.0.0.1", port))
+            idle.append(sck)
+        connect_time = time.time() - start
+        conns = [ bjsonrpc.connect(port=port) for i in range(active) ]
+
+        def client(conn):
+            for i in range(calls):
+                conn.call.ping()
+        threads = [ threading.Thread(target=client, args=(conn,)) 
+                    for conn in conns ]
+        start = time.time()
+        for cthread in threads:
+            cthread.start()
+        for cthread in threads:
+            cthread.join()
+        elapsed = time.time() - start
+        for conn in conns:
+            conn.close()
+        for sck in idle:
+            sck.close()
+        status = processstatus(server.pid)
+        server.terminate()
+        server.join()
+        print "  %5d idle: %8.0f calls/s  (connect %.2f s, server: %s)" % (
+            nidle, active * calls / elapsed, connect_time, status)
+
+def main(names):
+    for function in BENCHMARKS:
+        if names and function.__name__ not in names:
+            continue
+        print "%s:" % function.__name__
+        function()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
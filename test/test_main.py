@@ -2,10 +2,38 @@ import unittest
 import sys
 sys.path.insert(0, "../")
 import bjsonrpc
-from bjsonrpc.exceptions import ServerError
+from bjsonrpc.exceptions import ServerError, EofError
+from bjsonrpc.request import CancelledError, TimeoutError
+from bjsonrpc.handlers import BaseHandler
+from bjsonrpc.workers import WorkerPool, get_default_pool
+from bjsonrpc.timers import TimerWheel, get_default_wheel
 
 import testserver1
+try:
+    import trollius
+    from trollius import From, Return
+    import bjsonrpc.aio
+except ImportError:
+    trollius = None
+try:
+    import concurrent.futures as futures
+except ImportError:
+    futures = None
+import gc
+import errno
+import itertools
+import json
 import math
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+import traceback
+import weakref
+import zlib
 from types import ListType
 
 class TestJSONBasics(unittest.TestCase):
@@ -145,14 +173,1447 @@ class TestJSONBasics(unittest.TestCase):
         
         remote_total = sum([ m.value for m in lmethods ])
         self.assertEqual(total,  remote_total, "Server FAILED to sum N params remotely handling paralell queries")
+
+    def test_largemessage(self):
+        """
+            Messages much bigger than a single recv must arrive intact
+        """
+        rcall = self.conn.call
+        for size in [10, 5000, 70000, 3 * 1024 * 1024]:
+            data = ("0123456789" * (size // 10 + 1))[:size]
+            self.assertEqual(rcall.echo(data), data)
+
+    def test_writecoalescing(self):
+        """
+            Messages queued together must be sent with fewer syscalls
+        """
+        self.conn.write_cork = 20000
+        for i in range(100):
+            self.conn.notify.ping()
+        self.assertEqual(self.conn.call.ping(), "pong")
+        stats = self.conn.getstats()
+        self.assertEqual(stats['messages_sent'], 101)
+        self.assertTrue(stats['send_calls'] < stats['messages_sent'])
+        self.assertTrue(stats['messages_per_send'] > 1)
+
+    def test_callback(self):
+        """
+            The server can call the client while handling a call
+        """
+        class ClientHandler(BaseHandler):
+            def getname(self):
+                return "client"
+
+            def add2(self, num1, num2):
+                return num1 + num2
+
+        conn = bjsonrpc.connect(handler_factory=ClientHandler)
+        for i in range(10):
+            self.assertEqual(conn.call.callback("getname"), "client")
+            self.assertEqual(conn.call.callback("add2", i, 3), i + 3)
+        conn.close()
+
+    def test_batch(self):
+        """
+            Calls made in a batch go in a single message
+        """
+        with self.conn.batch() as batch:
+            req1 = batch.method.add2(1, 2)
+            req2 = batch.method.getabc(b=5)
+            batch.notify.ping()
+            req3 = batch.method.add2(1)
+            reqs = [ batch.method.echo(i) for i in range(200) ]
+        self.assertEqual(req1.value, 3)
+        self.assertEqual(req2.value, [None, 5, None])
+        self.assertRaises(ServerError, req3)
+        self.assertEqual([ req.value for req in reqs ], range(200))
+        self.assertEqual(self.conn.getstats()['messages_sent'], 1)
+
+    def test_batch_discarded(self):
+        """
+            Nothing is sent if the batch block raises an exception
+        """
+        try:
+            with self.conn.batch() as batch:
+                req = batch.method.with_deadline(60).add2(1, 2)
+                self.assertTrue(req._timer is not None)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.conn._requests, {})
+        self.assertTrue(req.cancelled())
+        self.assertTrue(req.event_response.is_set())
+        self.assertTrue(req._timer is None)
+        self.assertEqual(self.conn.call.ping(), "pong")
+        self.assertEqual(self.conn.getstats()['messages_sent'], 1)
+
+    def test_autobatch(self):
+        """
+            Calls made within the auto-batching window go in one message
+        """
+        # The window is much longer than the test: the synchronous call
+        # at the end sends the batch.
+        self.conn.autobatch_window = 10 ** 7
+        results = []
+        def caller(i):
+            results.append(self.conn.method.add2(i, 1))
+        threads = [ threading.Thread(target=caller, args=(i,)) 
+                    for i in range(5) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.conn.getstats()['messages_sent'], 0)
+        self.assertEqual(self.conn.call.ping(), "pong")
+        self.assertEqual(sorted(req.value for req in results), range(1, 6))
+        self.assertEqual(self.conn.getstats()['messages_sent'], 1)
+
+    def test_autobatch_flush(self):
+        """
+            Full batches and synchronous calls don't wait for the window
+        """
+        self.conn.autobatch_window = 10 ** 7
+        self.conn.autobatch_size = 5
+        reqs = [ self.conn.method.echo(i) for i in range(7) ]
+        start = time.time()
+        self.assertEqual(reqs[0].value, 0)
+        self.assertEqual(self.conn.call.ping(), "pong")
+        self.assertEqual([ req.value for req in reqs ], range(7))
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(self.conn.getstats()['messages_sent'], 2)
+
+    def test_map(self):
+        """
+            conn.map calls a method for each item of a list in one message
+        """
+        self.assertEqual(self.conn.map.add2([(1, 2), [3, 4], 
+            {'num1': 5, 'num2': 6}]), [3, 7, 11])
+        self.assertEqual(self.conn.map.addN([range(i) for i in range(5)]),
+            [0, 0, 1, 3, 6])
+        results = self.conn.map.add2([(1, 2), (1,), (0, 0)])
+        self.assertEqual(results[0], 3)
+        self.assertTrue(isinstance(results[1], ServerError))
+        self.assertEqual(results[2], 0)
+        self.assertEqual(self.conn.map.add2([]), [])
+        self.assertRaises(ServerError, self.conn.map.nosuchmethod, [(1,)])
+        self.assertEqual(self.conn.getstats()['messages_sent'], 5)
+
+    def test_stream(self):
+        """
+            Generators are streamed to conn.stream, and sent as lists to
+            the other proxies
+        """
+        self.assertEqual(list(self.conn.stream.countto(1050)), range(1050))
+        self.assertEqual(list(self.conn.stream.countto(0)), [])
+        self.assertEqual(self.conn.call.countto(10), range(10))
+        self.assertEqual(list(self.conn.stream.echo([1, 2])), [1, 2])
+        received = []
+        def consume():
+            for item in self.conn.stream.countto(500, fail_at=250):
+                received.append(item)
+        self.assertRaises(ServerError, consume)
+        self.assertEqual(received, range(200))
+
+    def test_stream_chunk_ignored(self):
+        """
+            Chunks for calls that aren't streams are ignored
+        """
+        sck1, sck2 = socket.socketpair()
+        conn = bjsonrpc.connection.Connection(sck1, 
+            handler_factory=bjsonrpc.handlers.NullHandler)
+        req = conn.method.ping()
+        sck2.sendall(json.dumps({'id': req.request_id, 'chunk': [1]}) + "\n")
+        sck2.sendall(json.dumps({'id': req.request_id, 'result': "pong",
+            'error': None}) + "\n")
+        self.assertTrue(conn.read_and_dispatch())
+        self.assertEqual(req.value, "pong")
+        conn.close()
+        sck2.close()
+
+    def test_upload_refused(self):
+        """
+            Uploads are only opened for the calls dispatched, up to 
+            max_uploads, and the other end is told to stop the rest
+        """
+        sck1, sck2 = socket.socketpair()
+        conn = bjsonrpc.connection.Connection(sck1, 
+            handler_factory=bjsonrpc.handlers.NullHandler)
+        conn.max_uploads = 2
+        peer = sck2.makefile()
+        def send(message):
+            sck2.sendall(json.dumps(message) + "\n")
+            self.assertTrue(conn.read_and_dispatch())
+        def received():
+            return json.loads(peer.readline())
+        ref = lambda name: {'__streamreference__': name}
+        send({'result': [ref(1)], 'error': None, 'id': 100})
+        self.assertEqual(received(), {'upload': 1, 'stop': True})
+        send({'method': 'nosuchmethod', 'params': [ref(2)]})
+        self.assertEqual(received(), {'upload': 2, 'stop': True})
+        send({'method': 'echo', 'params': [ref(3), ref(4), ref(5)], 'id': 1})
+        self.assertEqual([ received() for i in range(3) ], 
+            [ {'upload': name, 'stop': True} for name in (3, 4, 5) ])
+        response = received()
+        self.assertEqual(response['id'], 1)
+        self.assertTrue(response['error'].startswith("TooManyUploads"))
+        self.assertEqual(conn._uploads, {})
+        conn.close()
+        sck2.close()
+
+    def test_failed_calls_forgotten(self):
+        """
+            Calls which fail to dispatch aren't kept as pending
+        """
+        sck1, sck2 = socket.socketpair()
+        conn = bjsonrpc.connection.Connection(sck1, 
+            handler_factory=bjsonrpc.handlers.NullHandler)
+        bad = {'method': 'echo', 'params': [], 'kwparams': [1], 'id': 1}
+        for message in (bad, [dict(bad, id=2), 'junk']):
+            sck2.sendall(json.dumps(message) + "\n")
+            conn.read_and_dispatch()
+            for i in range(100): # threaded mode fails in the pool.
+                if not conn._calls: break
+                time.sleep(0.01)
+            self.assertEqual(conn._calls, {})
+        conn.close()
+        sck2.close()
+
+    def test_stream_bounded(self):
+        """
+            The server doesn't produce a stream faster than it is read
+        """
+        items = iter(self.conn.stream.countto(100000, size=10000))
+        self.assertEqual(int(items.next()), 0)
+        time.sleep(0.5)
+        self.assertTrue(testserver1.produced < 5000, testserver1.produced)
+        for i in range(1, 6000):
+            self.assertEqual(int(items.next()), i)
+
+    def test_upload(self):
+        """
+            Generators passed as arguments are streamed to the method
+        """
+        self.assertEqual(self.conn.call.sumstream(x for x in range(1000)), 
+            sum(range(1000)))
+        self.assertEqual(self.conn.call.sumstream(x for x in []), 0)
+        req = self.conn.method.sumstream(numbers=(x * 2 for x in xrange(5000)))
+        self.assertEqual(req.value, 2 * sum(range(5000)))
+        def failing():
+            yield 1
+            raise ValueError("broken upload")
+        self.assertRaises(ServerError, self.conn.call.sumstream, failing())
+        produced = []
+        def numbers():
+            for i in xrange(1000000):
+                produced.append(i)
+                yield i
+        self.assertEqual(self.conn.call.firstn(numbers(), 10), range(10))
+        time.sleep(0.2)
+        # Only the chunks of the window were sent, not the whole generator.
+        self.assertTrue(len(produced) < 2000, len(produced))
+
+    def test_upload_stopped(self):
+        """
+            Uploads stop once their call is done, even if nobody waits for
+            its response
+        """
+        closed = []
+        def endless():
+            try:
+                for i in itertools.count():
+                    yield i
+            finally:
+                closed.append(True)
+        self.conn.notify.firstn(endless(), 10)
+        req = self.conn.method.sumstream(endless())
+        time.sleep(0.2)
+        req.cancel()
+        # Reads the stop of the notification, if there's no reader thread.
+        self.assertEqual(self.conn.call.firstn(endless(), 3), [0, 1, 2])
+        for i in range(50):
+            if len(closed) == 3:
+                break
+            time.sleep(0.1)
+        self.assertEqual(closed, [True, True, True])
+        self.assertEqual(self.conn._upload_acks, {})
+
+    def rawbatch(self, calls):
+        """ Sends a batch on a plain socket and returns the response """
+        sck = socket.create_connection(("127.0.0.1", 10123))
+        sck.sendall(json.dumps(calls) + "\n")
+        data = ""
+        while not data.endswith("\n"):
+            chunk = sck.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        sck.close()
+        return json.loads(data)
+
+    def test_batch_response(self):
+        """
+            A batch is answered with one message, in order
+        """
+        responses = self.rawbatch([
+            {"method": "add2", "params": [1, 2], "id": 1},
+            {"method": "ping"},
+            {"method": "nosuchmethod", "id": 2},
+            "garbage",
+            {"method": "echo", "params": ["x"], "id": 3},
+        ])
+        self.assertEqual(type(responses), ListType)
+        self.assertEqual([ r['id'] for r in responses ], [1, 2, None, 3])
+        self.assertEqual(responses[0]['result'], 3)
+        self.assertNotEqual(responses[1]['error'], None)
+        self.assertNotEqual(responses[2]['error'], None)
+        self.assertEqual(responses[3]['result'], "x")
+
+    def test_batch_parallel(self):
+        """
+            With parallel_batches, the calls of a batch run at the same time
+        """
+        bjsonrpc.bjsonrpc_options['parallel_batches'] = True
+        try:
+            calls = [ {"method": "sleepecho", "params": [i, 0.3], "id": i}
+                      for i in range(1, 5) ]
+            start = time.time()
+            responses = self.rawbatch(calls)
+            elapsed = time.time() - start
+        finally:
+            bjsonrpc.bjsonrpc_options['parallel_batches'] = False
+        self.assertEqual([ r['result'] for r in responses ], [1, 2, 3, 4])
+        self.assertTrue(elapsed < 0.9)
+
+    def test_future(self):
+        """
+            Requests have the interface of concurrent.futures.Future
+        """
+        req = self.conn.method.add2(1, 2)
+        done = []
+        req.add_done_callback(done.append)
+        self.assertEqual(req.result(5), 3)
+        self.assertTrue(req.done())
+        self.assertEqual(done, [req])
+        self.assertFalse(req.cancel())
+        failed = self.conn.method.add2(1)
+        self.assertTrue(isinstance(failed.exception(), ServerError))
+        self.assertRaises(ServerError, failed.result)
+        slow = self.conn.method.sleepecho(1, 0.3)
+        self.assertRaises(TimeoutError, slow.result, 0.05)
+        self.assertTrue(slow.cancel())
+        self.assertTrue(slow.cancelled())
+        self.assertRaises(CancelledError, slow.result)
+        # the response to the cancelled request is ignored.
+        self.assertEqual(self.conn.call.ping(), "pong")
+
+    def test_deadline(self):
+        """
+            Calls made with a deadline fail if they don't finish in time
+        """
+        self.assertEqual(self.conn.call.with_deadline(5).add2(1, 2), 3)
+        # the timer wheel doesn't keep answered requests alive.
+        req = self.conn.method.with_deadline(60).add2(1, 2)
+        self.assertEqual(req.value, 3)
+        ref = weakref.ref(req)
+        del req
+        gc.collect()
+        self.assertTrue(ref() is None)
+        slow = self.conn.method.with_deadline(0.1).sleepecho(1, 0.4)
+        start = time.time()
+        self.assertRaises(TimeoutError, slow.result)
+        self.assertTrue(time.time() - start < 0.3)
+        self.assertFalse(slow.request_id in self.conn._requests)
+        # the late response is ignored.
+        self.assertEqual(self.conn.call.ping(), "pong")
+
+    def test_deadline_dropped(self):
+        """
+            Calls whose deadline passed before they start are not run
+        """
+        responses = self.rawbatch([
+            {"method": "sleepecho", "params": [1, 0.3], "id": 1},
+            {"method": "echo", "params": ["x"], "id": 2, "timeout": 0.1},
+            {"method": "echo", "params": ["y"], "id": 3, "timeout": 5},
+        ])
+        self.assertEqual([ r['id'] for r in responses ], [1, 3])
+        self.assertEqual(responses[1]['result'], "y")
+
+    def test_cancel(self):
+        """
+            Cancelled calls don't run if they haven't started yet
+        """
+        responses = self.rawbatch([
+            {"method": "sleepecho", "params": [1, 0.1], "id": 1},
+            {"method": "__cancel__", "params": [2], "id": None},
+            {"method": "echo", "params": ["x"], "id": 2},
+            {"method": "echo", "params": ["y"], "id": 3},
+        ])
+        self.assertEqual([ r['id'] for r in responses ], [1, 3])
+        slow = self.conn.method.untilcancelled(0.1)
+        self.assertTrue(slow.cancel())
+        self.assertRaises(CancelledError, slow.result)
+        self.assertEqual(self.conn.call.ping(), "pong")
+
+    def test_write_backpressure(self):
+        """
+            The server stops reading from peers that don't read its responses
+        """
+        bjsonrpc.bjsonrpc_options['write_high_water'] = 1 << 16
+        try:
+            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sck.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            sck.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            sck.connect(("127.0.0.1", 10123))
+            sck.settimeout(0.5)
+            line = json.dumps({"method": "echo", "params": ["x" * 10000], 
+                "id": 1}) + "\n"
+            sent = 0
+            try:
+                while sent < 1 << 25:
+                    sck.sendall(line)
+                    sent += len(line)
+            except socket.timeout:
+                pass
+            sck.close()
+        finally:
+            bjsonrpc.bjsonrpc_options['write_high_water'] = 1 << 24
+        self.assertTrue(sent < 1 << 24)
+        self.assertEqual(self.conn.call.ping(), "pong")
+
+    def test_write_backpressure_burst(self):
+        """
+            Calls read before the server stopped reading are answered too
+        """
+        bjsonrpc.bjsonrpc_options['write_high_water'] = 1 << 16
+        bjsonrpc.bjsonrpc_options['write_low_water'] = 1 << 14
+        try:
+            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sck.connect(("127.0.0.1", 10123))
+            sck.settimeout(5)
+            lines = "".join([ json.dumps({"method": "echo",
+                "params": ["x" * 10000], "id": i}) + "\n"
+                for i in range(200) ])
+            sender = threading.Thread(target=sck.sendall, args=(lines,))
+            sender.daemon = True
+            sender.start()
+            data = ""
+            try:
+                while data.count("\n") < 200:
+                    received = sck.recv(65536)
+                    if not received:
+                        break
+                    data += received
+            except socket.timeout:
+                pass
+            sck.close()
+        finally:
+            bjsonrpc.bjsonrpc_options['write_high_water'] = 1 << 24
+            bjsonrpc.bjsonrpc_options['write_low_water'] = 1 << 22
+        self.assertEqual(data.count("\n"), 200)
+
+    def test_processmethod(self):
+        """
+            Methods marked with process_method run in another process, and
+            don't stop the connection from serving other calls
+        """
+        pid, total = self.conn.call.slowsum(range(10))
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(total, 45)
+        slow = self.conn.method.slowsum([1, 2], 1)
+        start = time.time()
+        self.assertEqual(self.conn.call.ping(), "pong")
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(slow.value[1], 3)
+        self.assertRaises(ServerError, self.conn.call.divide, 1, 0)
+        self.assertEqual(self.conn.call.divide(6, 3), 2)
+        try:
+            self.conn.call.peername()
+            self.fail("process method used the connection")
+        except ServerError, exc:
+            self.assertTrue("without __init__" in str(exc), str(exc))
+
+    def test_processmethod_killed(self):
+        """
+            Calls whose process dies are answered with an error once 
+            process_timeout passes
+        """
+        bjsonrpc.bjsonrpc_options['process_timeout'] = 1
+        try:
+            conn = bjsonrpc.connect()
+            slow = conn.method.slowsum([1, 2], 30)
+            time.sleep(0.3)
+            for process in multiprocessing.active_children():
+                os.kill(process.pid, signal.SIGKILL)
+            start = time.time()
+            self.assertRaises(ServerError, slow.result, 5)
+            self.assertTrue(time.time() - start < 2)
+            self.assertEqual(conn.call.divide(6, 3), 2)
+            conn.close()
+        finally:
+            bjsonrpc.bjsonrpc_options['process_timeout'] = 300
+
+
+class TestThreaded(TestJSONBasics):
+    """
+        Same tests, handling every incoming item in its own thread.
+    """
+    def setUp(self):
+        bjsonrpc.bjsonrpc_options['threaded'] = True
+        TestJSONBasics.setUp(self)
+
+    def tearDown(self):
+        TestJSONBasics.tearDown(self)
+        bjsonrpc.bjsonrpc_options['threaded'] = False
+
+    def test_cancel(self):
+        """
+            Cancelled calls are told to stop while they run
+        """
+        testserver1.cancelled = None
+        slow = self.conn.method.untilcancelled(5)
+        time.sleep(0.1)
+        self.assertTrue(slow.cancel())
+        self.assertRaises(CancelledError, slow.result)
+        start = time.time()
+        while testserver1.cancelled is None and time.time() - start < 2:
+            time.sleep(0.01)
+        self.assertTrue(testserver1.cancelled)
+        # its response isn't sent: the next one is ours.
+        self.assertEqual(self.conn.call.ping(), "pong")
+
+
+class TestReaderThread(TestJSONBasics):
+    """
+        Same tests, with a thread reading the messages of the client.
+    """
+    def setUp(self):
+        bjsonrpc.bjsonrpc_options['reader_thread'] = True
+        TestJSONBasics.setUp(self)
+
+    def tearDown(self):
+        TestJSONBasics.tearDown(self)
+        bjsonrpc.bjsonrpc_options['reader_thread'] = False
+
+    def test_waiters(self):
+        """
+            Threads waiting for a response don't read the socket
+        """
+        self.assertTrue(self.conn.reader_thread.is_alive())
+        results = {}
+        def caller(i):
+            results[i] = [ self.conn.call.echo([i, n]) for n in range(20) ]
+        threads = [ threading.Thread(target=caller, args=(i,)) 
+                    for i in range(16) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        for i in range(16):
+            self.assertEqual(results[i], [ [i, n] for n in range(20) ])
+        self.assertFalse(self.conn.method.ping().hasresponse())
+
+    @unittest.skipIf(futures is None, "concurrent.futures is not installed")
+    def test_as_completed(self):
+        """
+            concurrent.futures.wait and as_completed work with requests
+        """
+        reqs = [ self.conn.method.echo(i) for i in range(1000) ]
+        results = [ req.result() 
+                    for req in futures.as_completed(reqs, timeout=10) ]
+        self.assertEqual(sorted(results), range(1000))
+        slow = self.conn.method.sleepecho(1, 0.3)
+        done, pending = futures.wait(reqs + [slow], timeout=0.05)
+        self.assertEqual((len(done), pending), (1000, set([slow])))
+        slow.cancel()
+        done, pending = futures.wait([slow], timeout=5)
+        self.assertEqual(done, set([slow]))
+
+    def test_closed(self):
+        """
+            Calls waiting when the other end closes raise EofError
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        conn = bjsonrpc.connect(port=listener.getsockname()[1])
+        peer = listener.accept()[0]
+        req = conn.method.ping()
+        threading.Timer(0.2, peer.close).start()
+        self.assertRaises(EofError, req.result)
+        self.assertEqual(conn.connection_status, "closed")
+        listener.close()
+
+    def test_close_race(self):
+        """
+            Closing from several threads at once shuts down the handler once
+            and doesn't kill the writing thread
+        """
+        shutdowns = []
+        class Handler(BaseHandler):
+            def _shutdown(self):
+                shutdowns.append(True)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        for i in range(10):
+            sck = socket.create_connection(listener.getsockname())
+            peer = listener.accept()[0]
+            conn = bjsonrpc.connection.Connection(sck, handler_factory=Handler)
+            errors = []
+            def write_loop(loop=conn._write_loop):
+                try:
+                    loop()
+                except Exception:
+                    errors.append(traceback.format_exc())
+            conn._write_loop = write_loop
+            conn.start_reader()
+            # The other end goes away: the reading thread closes the 
+            # connection as we do, and a late writer starts the writing 
+            # thread meanwhile.
+            peer.close()
+            time.sleep(0.001 * i)
+            conn.close()
+            conn.write(json.dumps({'method': 'ping', 'id': None}))
+            conn.reader_thread.join(5)
+            conn.write_thread.join(5)
+            self.assertEqual(errors, [])
+            self.assertFalse(conn.write_thread.is_alive())
+            self.assertEqual(len(shutdowns), i + 1)
+        listener.close()
+
+def test_callbacks(self):
+        """
+            Callbacks don't run in the reading thread, nor delay the other
+            responses
+        """
+        threads = []
+        start = time.time()
+        req = self.conn.method.sleepecho(1, 0.2)
+        req.callbacks.append(lambda req: time.sleep(2))
+        req.add_done_callback(
+            lambda req: threads.append(threading.current_thread()))
+        self.assertEqual(self.conn.call.echo(2), 2)
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertEqual(req.wait(5), True)
+        for i in range(50):
+            if threads:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0] is not self.conn.reader_thread)
+
+
+class TestJsonlib(unittest.TestCase):
+    def test_codecs(self):
+        """
+            Codecs can be registered and selected
+        """
+        jsonlib = bjsonrpc.jsonlib
+        self.assertTrue("json" in jsonlib.available_codecs())
+        self.assertEqual(jsonlib.active_codec(), 
+            jsonlib.available_codecs()[0])
+        self.assertRaises(ValueError, jsonlib.use_codec, "nosuchcodec")
+        used = []
+        def dumps(obj, default):
+            used.append(obj)
+            return json.dumps(obj, default=default)
+        def loads(text, object_hook):
+            used.append(text)
+            return json.loads(text, object_hook=object_hook)
+        jsonlib.register_codec("test", dumps, loads, priority=-1)
+        jsonlib.use_codec("test")
+        try:
+            testserver1.start()
+            conn = bjsonrpc.connect()
+            self.assertEqual(conn.call.add2(1, 2), 3)
+            testserver1.stop(conn)
+        finally:
+            jsonlib.use_codec()
+            del jsonlib._codecs["test"]
+        self.assertNotEqual(jsonlib.active_codec(), "test")
+        self.assertTrue(len(used) >= 4)
+
+
+    def test_hints_only(self):
+        """
+            load_object is only called for texts that may have hints
+        """
+        class Hook(object):
+            def __init__(self):
+                self.calls = 0
+            def load_object(self, obj):
+                self.calls += 1
+                if '__test__' in obj:
+                    return "hinted"
+                return obj
+        hook = Hook()
+        data = bjsonrpc.jsonlib.loads('{"a": [{"b": 1}, {"c": "_x"}]}', hook)
+        self.assertEqual(data, {"a": [{"b": 1}, {"c": "_x"}]})
+        self.assertEqual(hook.calls, 0)
+        data = bjsonrpc.jsonlib.loads('{"a": [{"__test__": 1}]}', hook)
+        self.assertEqual(data, {"a": ["hinted"]})
+        data = bjsonrpc.jsonlib.loads('[{"\\u005f_test__": 1}]', hook)
+        self.assertEqual(data, ["hinted"])
+        self.assertEqual(hook.calls, 3)
+
+
+class TestFraming(unittest.TestCase):
+    def setUp(self):
+        testserver1.start()
+        self.conn = bjsonrpc.connect(framing='length',
+            handler_factory=testserver1.ServerHandler)
+
+    def tearDown(self):
+        testserver1.stop(self.conn)
+
+    def test_negotiated(self):
+        """
+            Both ends switch to length framing
+        """
+        self.assertEqual(self.conn._rframing, 'length')
+        self.assertEqual(self.conn.call.add2(1, 2), 3)
+        self.assertEqual(self.conn._wframing, 'length')
+        self.assertEqual(self.conn.call.echo("a\nb"), "a\nb")
+
+    def test_messages(self):
+        """
+            Big messages, batches and callbacks work in length framing
+        """
+        data = "x" * (3 * 1024 * 1024)
+        self.assertEqual(self.conn.call.echo(data), data)
+        with self.conn.batch() as batch:
+            reqs = [ batch.method.add2(i, i) for i in range(100) ]
+        self.assertEqual([ req.value for req in reqs ], range(0, 200, 2))
+        self.assertEqual(self.conn.call.callback("ping"), "pong")
+
+    def test_old_peer(self):
+        """
+            Peers that can't negotiate keep newline framing
+        """
+        sck1, sck2 = socket.socketpair()
+        conn = bjsonrpc.connection.Connection(sck1, 
+            handler_factory=BaseHandler)
+        def oldpeer():
+            request = json.loads(sck2.makefile().readline())
+            sck2.sendall(json.dumps({"result": None, "id": request["id"],
+                "error": "ServerError: Unknown method '__negotiate__'"}) + "\n")
+        thread = threading.Thread(target=oldpeer)
+        thread.start()
+        self.assertEqual(conn.negotiate(framing=['length']), {})
+        thread.join()
+        self.assertEqual(conn._rframing, 'line')
+        self.assertEqual(conn._wframing, 'line')
+        conn.close()
+        sck2.close()
+
+    def test_compression(self):
+        """
+            Only messages above compress_threshold are compressed
+        """
+        conn = bjsonrpc.connect(compression='zlib',
+            handler_factory=testserver1.ServerHandler)
+        conn.compress_threshold = 1000
+        self.assertEqual(conn.call.echo("x" * 900), "x" * 900)
+        self.assertTrue(conn._wcompress)
+        self.assertEqual(conn.getstats()['messages_compressed'], 0)
+        # short messages get bigger: they are sent as they are.
+        conn.compress_threshold = 0
+        self.assertEqual(conn.call.ping(), "pong")
+        self.assertEqual(conn.getstats()['messages_compressed'], 0)
+        conn.compress_threshold = 1000
+        data = "abcd" * (1024 * 1024)
+        self.assertEqual(conn.call.echo(data), data)
+        stats = conn.getstats()
+        self.assertEqual(stats['messages_compressed'], 1)
+        self.assertTrue(stats['bytes_uncompressed'] > len(data))
+        self.assertTrue(stats['bytes_compressed'] < len(data) / 100)
+        self.assertTrue(stats['bytes_sent'] < len(data) / 100)
+        conn.close()
+
+    def test_decompression_limit(self):
+        """
+            Compressed frames can't inflate above max_frame_size
+        """
+        sck1, sck2 = socket.socketpair()
+        conn = bjsonrpc.connection.Connection(sck1, 
+            handler_factory=BaseHandler)
+        conn._rframing = 'length'
+        conn.max_frame_size = 10000
+        payload = zlib.compress("[" + "0," * 100000 + "0]")
+        sck2.sendall(struct.pack("!BI", 1, len(payload)) + payload)
+        self.assertRaises(bjsonrpc.exceptions.EofError, conn._readn)
+        conn.close()
+        sck2.close()
+
+
+class TestPacklib(unittest.TestCase):
+    values = [None, True, False, 0, 1, -1, 127, 128, -32, -33, 255, 256, 
+        -129, 65536, -32769, 2 ** 32, -2 ** 31 - 1, 2 ** 64 - 1, -2 ** 63,
+        0.5, -1e300, u"", u"a" * 31, u"\xe9" * 40, u"x" * 300, u"y" * 70000,
+        [], range(20), range(70000), {}, dict((u"k%d" % i, i) for i in range(20)),
+        {u"a": [{u"b": None}], u"c": [1.5, u"d"]}]
+
+    def dump_object(self, obj):
+        raise TypeError("Not serializable")
+
+    def load_object(self, obj):
+        return obj
+
+    def roundtrip(self):
+        """ Encodes and decodes every test value """
+        for value in self.values:
+            data = bjsonrpc.packlib.dumps(value, self)
+            self.assertEqual(bjsonrpc.packlib.loads(data, self), value)
+        data = bjsonrpc.packlib.join([ bjsonrpc.packlib.dumps(value, self)
+            for value in self.values ])
+        self.assertEqual(bjsonrpc.packlib.loads(data, self), self.values)
+        self.assertEqual(bjsonrpc.packlib.loads(
+            bjsonrpc.packlib.dumps((1, "a"), self), self), [1, u"a"])
+
+    def test_python(self):
+        """
+            The implementation in pure Python decodes what it encodes
+        """
+        msgpack = bjsonrpc.packlib._msgpack
+        bjsonrpc.packlib._msgpack = None
+        try:
+            self.roundtrip()
+            self.assertRaises(ValueError, bjsonrpc.packlib.loads, "\x92\x01", self)
+            self.assertRaises(ValueError, bjsonrpc.packlib.loads, "\x01\x01", self)
+        finally:
+            bjsonrpc.packlib._msgpack = msgpack
+
+    @unittest.skipIf(bjsonrpc.packlib._msgpack is None, 
+        "msgpack is not installed")
+    def test_msgpack(self):
+        """
+            The msgpack library and the pure Python implementation agree
+        """
+        self.roundtrip()
+        msgpack = bjsonrpc.packlib._msgpack
+        for value in self.values:
+            if type(value) is dict and len(value) > 1:
+                continue # The order of the keys may differ.
+            data = bjsonrpc.packlib.dumps(value, self)
+            bjsonrpc.packlib._msgpack = None
+            try:
+                self.assertEqual(bjsonrpc.packlib.dumps(value, self), data)
+            finally:
+                bjsonrpc.packlib._msgpack = msgpack
+
+    def test_connection(self):
+        """
+            Connections can negotiate MessagePack
+        """
+        class ClientHandler(BaseHandler):
+            def getname(self):
+                return u"client"
+        connection = bjsonrpc.connection.Connection
+        codecs = connection.codecs
+        connection.codecs = ['msgpack', 'json'] # even without the library.
+        testserver1.start()
+        try:
+            conn = bjsonrpc.connect(codec='msgpack', 
+                handler_factory=ClientHandler)
+        finally:
+            connection.codecs = codecs
+        try:
+            self.assertTrue(conn._wcodec is bjsonrpc.packlib)
+            self.assertEqual(conn.call.add2(1.5, 2), 3.5)
+            self.assertEqual(conn.call.echo(self.values), self.values)
+            self.assertEqual(conn.call.callback("getname"), "client")
+            self.assertEqual(conn.map.add2([(1, 2), (3, 4)]), [3, 7])
+            with conn.batch() as batch:
+                reqs = [ batch.method.echo(i) for i in range(20) ]
+            self.assertEqual([ req.value for req in reqs ], range(20))
+        finally:
+            testserver1.stop(conn)
+
+    def test_default_codecs(self):
+        """
+            MessagePack is only accepted by default with the msgpack library
+        """
+        codecs = bjsonrpc.connection.Connection.codecs
+        self.assertEqual('msgpack' in codecs, 
+            bjsonrpc.packlib.backend == "msgpack")
+        testserver1.start()
+        conn = bjsonrpc.connect(codec='msgpack')
+        try:
+            self.assertEqual(conn._wcodec is bjsonrpc.packlib, 
+                bjsonrpc.packlib.backend == "msgpack")
+            self.assertEqual(conn.call.echo([1.5, u"a"]), [1.5, u"a"])
+        finally:
+            testserver1.stop(conn)
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_bounded(self):
+        """
+            The pool never runs more items than threads it has
+        """
+        pool = WorkerPool(size=4, queue_size=0)
+        release = threading.Event()
+        running = []
+        def task(i):
+            running.append(i)
+            release.wait(5)
+        for i in range(20):
+            pool.submit(task, i)
+        time.sleep(0.2)
+        stats = pool.getstats()
+        self.assertEqual(len(running), 4)
+        self.assertEqual(stats['threads'], 4)
+        self.assertEqual(stats['busy'], 4)
+        self.assertEqual(pool.qsize(), 16)
+        release.set()
+        pool.shutdown()
+        self.assertEqual(sorted(running), range(20))
+        self.assertEqual(pool.getstats()['completed'], 20)
+
+    def test_queue_full_blocks(self):
+        """
+            submit() waits while the queue is full
+        """
+        pool = WorkerPool(size=1, queue_size=2)
+        release = threading.Event()
+        for i in range(3):
+            pool.submit(release.wait, 5)
+        time.sleep(0.1)
+        submitter = threading.Thread(target=pool.submit, args=(release.wait, 5))
+        submitter.start()
+        submitter.join(0.2)
+        self.assertTrue(submitter.is_alive())
+        release.set()
+        submitter.join(5)
+        self.assertFalse(submitter.is_alive())
+        pool.shutdown()
+
+    def test_queue_full_rejects(self):
+        """
+            The thread reading a connection doesn't wait for a full pool: it
+            answers the calls that don't fit with an error
+        """
+        sck1, sck2 = socket.socketpair()
+        conn = bjsonrpc.connection.Connection(sck1, 
+            handler_factory=testserver1.ServerHandler)
+        conn.threaded = True
+        conn.worker_pool = pool = WorkerPool(size=1, queue_size=1)
+        def call(i):
+            sck2.sendall(json.dumps({"method": "sleepecho", 
+                "params": [i, 0.2], "id": i}) + "\n")
+            self.assertTrue(conn.read_and_dispatch(timeout=5))
+        call(0)
+        start = time.time()
+        while pool.qsize() and time.time() - start < 5:
+            time.sleep(0.01)
+        start = time.time()
+        for i in range(1, 4):
+            call(i)
+        self.assertTrue(time.time() - start < 0.2)
+        reader = sck2.makefile()
+        responses = [ json.loads(reader.readline()) for i in range(4) ]
+        errors = sorted(r["id"] for r in responses if r["error"] is not None)
+        self.assertEqual(errors, [2, 3])
+        self.assertEqual(conn.getstats()['calls_rejected'], 2)
+        conn.close()
+        sck2.close()
+        pool.shutdown()
+
+    def test_queue_full_rejects_batch(self):
+        """
+            The calls of a batch that don't fit in the pool get an error in
+            the response
+        """
+        sck1, sck2 = socket.socketpair()
+        conn = bjsonrpc.connection.Connection(sck1, 
+            handler_factory=testserver1.ServerHandler)
+        conn.threaded = True
+        conn.parallel_batches = True
+        conn.worker_pool = pool = WorkerPool(size=1, queue_size=1)
+        sck2.sendall(json.dumps({"method": "sleepecho", 
+            "params": [0, 0.2], "id": 0}) + "\n")
+        self.assertTrue(conn.read_and_dispatch(timeout=5))
+        start = time.time()
+        while pool.qsize() and time.time() - start < 5:
+            time.sleep(0.01)
+        sck2.sendall(json.dumps([ {"method": "echo", "params": [i], "id": i}
+            for i in range(1, 4) ]) + "\n")
+        self.assertTrue(conn.read_and_dispatch(timeout=5))
+        reader = sck2.makefile()
+        self.assertEqual(json.loads(reader.readline())["result"], 0)
+        responses = json.loads(reader.readline())
+        self.assertEqual([ r["id"] for r in responses ], [1, 2, 3])
+        self.assertEqual(responses[0]["result"], 1)
+        self.assertTrue(responses[1]["error"].startswith("ServerBusy"))
+        self.assertTrue(responses[2]["error"].startswith("ServerBusy"))
+        conn.close()
+        sck2.close()
+        pool.shutdown()
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_timers(self):
+        """
+            Timers run once their time comes, and not before
+        """
+        wheel = TimerWheel(tick=0.01, slots=8)
+        fired = []
+        start = time.time()
+        for i in range(200):
+            wheel.add(start + (i % 10) * 0.02, fired.append, i)
+        wheel.add(start + 0.3, fired.append, "late")
+        wheel.add(start - 1, fired.append, "past")
+        time.sleep(0.25)
+        self.assertEqual(sorted(fired, key=str), sorted(range(200) + ["past"], 
+            key=str))
+        self.assertEqual(len(wheel), 1)
+        time.sleep(0.1)
+        self.assertEqual(fired[-1], "late")
+        self.assertEqual(len(wheel), 0)
+
+    def test_order(self):
+        """
+            Timers run in time order, at most a tick late
+        """
+        wheel = TimerWheel(tick=0.01)
+        fired = []
+        start = time.time()
+        for delay in [0.15, 0.05, 0.1]:
+            wheel.add(start + delay, lambda: fired.append(time.time() - start))
+        time.sleep(0.3)
+        self.assertEqual(len(fired), 3)
+        self.assertEqual(fired, sorted(fired))
+        for delay, elapsed in zip([0.05, 0.1, 0.15], fired):
+            self.assertTrue(delay <= elapsed < delay + 0.05, (delay, elapsed))
+
+    def test_cancel(self):
+        """
+            Cancelled timers don't run, and their functions are forgotten
+        """
+        wheel = TimerWheel(tick=0.01)
+        fired = []
+        class Target(object):
+            def fire(self):
+                fired.append("cancelled")
+        target = Target()
+        ref = weakref.ref(target)
+        timer = wheel.add(time.time() + 0.05, target.fire)
+        wheel.add(time.time() + 0.05, fired.append, "kept")
+        self.assertEqual(len(wheel), 2)
+        wheel.cancel(timer)
+        del target
+        self.assertTrue(ref() is None)
+        self.assertEqual(len(wheel), 1)
+        time.sleep(0.15)
+        self.assertEqual(fired, ["kept"])
+        self.assertEqual(len(wheel), 0)
+        wheel.cancel(timer)
+        self.assertEqual(len(wheel), 0)
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.server = bjsonrpc.createserver(port=10124, 
+            handler_factory=testserver1.ServerHandler)
+        self.server_thread = threading.Thread(target=self.server.serve)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.server_thread.join(5)
+
+    def test_stop_wakes_up(self):
+        """
+            Server.stop must not wait for the next event to exit the loop
+        """
+        time.sleep(0.1)
+        start = time.time()
+        self.server.stop()
+        self.server_thread.join(5)
+        self.assertFalse(self.server_thread.is_alive())
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_accept_exhausted(self):
+        """
+            Running out of file descriptors pauses accepting instead of 
+            spinning on the listening socket
+        """
+        class Listener(object):
+            def __init__(self, sck):
+                self.sck, self.attempts, self.exhausted = sck, 0, True
+            def accept(self):
+                self.attempts += 1
+                if self.exhausted:
+                    raise socket.error(errno.EMFILE, "Too many open files")
+                return self.sck.accept()
+            def __getattr__(self, name):
+                return getattr(self.sck, name)
+        self.server.accept_backoff = 0.2
+        listener = Listener(self.server._lstsck)
+        self.server._lstsck = listener
+        conn = bjsonrpc.connect(port=10124)
+        time.sleep(0.5)
+        self.assertTrue(1 <= listener.attempts <= 4, listener.attempts)
+        listener.exhausted = False
+        self.assertEqual(conn.call.ping(), "pong")
+        conn.close()
+
+    def test_idle_connections(self):
+        """
+            Idle connections must not disturb the active ones
+        """
+        idle = []
+        for i in range(200):
+            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sck.connect(("127.0.0.1", 10124))
+            idle.append(sck)
+        conn = bjsonrpc.connect(port=10124)
+        for i in range(20):
+            self.assertEqual(conn.call.add2(i, 1), i + 1)
+        for sck in idle[::2]:
+            sck.close()
+        self.assertEqual(conn.call.ping(), "pong")
+        conn.close()
+        for sck in idle[1::2]:
+            sck.close()
+
+    def test_no_thread_per_connection(self):
+        """
+            Connections served by a Server must not have their own threads
+        """
+        nthreads = threading.active_count()
+        conns = [ bjsonrpc.connect(port=10124) for i in range(50) ]
+        for conn in conns:
+            self.assertEqual(conn.call.ping(), "pong")
+        for conn in conns:
+            conn.notify.ping()
+        # only the writing threads of the 50 client connections.
+        self.assertEqual(threading.active_count(), nthreads + 50)
+        for conn in conns:
+            conn.close()
+
+
+class TestWriteQueue(unittest.TestCase):
+    def setUp(self):
+        """
+            Connect to a peer that doesn't read, with a small write queue.
+        """
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.conn = bjsonrpc.connect(port=self.listener.getsockname()[1])
+        self.conn.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.peer = self.listener.accept()[0]
+        self.conn.write_high_water = 1 << 16
+        self.conn.write_low_water = 1 << 14
+
+    def tearDown(self):
+        self.peer.close()
+        self.conn.close()
+        self.listener.close()
+
+    def drain(self):
+        """ Starts reading everything the connection sends """
+        def read():
+            try:
+                while self.peer.recv(65536):
+                    pass
+            except socket.error:
+                pass
+        thread = threading.Thread(target=read)
+        thread.daemon = True
+        thread.start()
+
+    def test_block(self):
+        """
+            Writers wait while the queue is above the high watermark
+        """
+        def write():
+            for i in range(100):
+                self.conn.notify.echo("x" * 10000)
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        writer.start()
+        writer.join(0.5)
+        self.assertTrue(writer.is_alive())
+        # getstats would wait for the writing thread, blocked in send.
+        queued, messages = self.conn._write_queue_size()
+        self.assertTrue(queued < (1 << 16) + 20000)
+        self.assertRaises(bjsonrpc.exceptions.QueueFullError, 
+            self.conn.write, "{}", 0.1)
+        self.drain()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+
+    def test_error(self):
+        """
+            With the 'error' policy, writers fail above the high watermark
+        """
+        self.conn.write_policy = 'error'
+        self.conn.write_high_water = None
+        self.conn.write_high_messages = 10
+        self.conn.write_low_messages = 0
+        req = self.conn.method.echo("x")
+        def write():
+            for i in range(1000):
+                self.conn.notify.echo("x" * 1000)
+        self.assertRaises(bjsonrpc.exceptions.QueueFullError, write)
+        self.assertTrue(self.conn._write_queue_size()[1] <= 11)
+        # the messages the connection sends by itself are always queued.
+        self.assertTrue(req.cancel())
+        self.assertRaises(CancelledError, req.result, 0)
+        self.drain()
+        start = time.time()
+        while self.conn._write_queue_size()[1] and time.time() - start < 5:
+            time.sleep(0.01)
+        self.conn.notify.echo("x")
+
+    def test_shed(self):
+        """
+            With the 'shed' policy, notifications are dropped above the high
+            watermark
+        """
+        self.conn.write_policy = 'shed'
+        start = time.time()
+        for i in range(100):
+            self.conn.notify.echo("x" * 10000)
+        self.assertTrue(time.time() - start < 1)
+        queued, messages = self.conn._write_queue_size()
+        self.assertTrue(queued < (1 << 16) + 20000)
+        self.drain()
+        self.assertTrue(self.conn.getstats()['notifications_shed'] > 0)
+
+
+@unittest.skipIf(not hasattr(os, "fork"), "os.fork is not available")
+class TestPreforkServer(unittest.TestCase):
+    def setUp(self):
+        self.server = bjsonrpc.createserver(port=10126, workers=2,
+            handler_factory=testserver1.ServerHandler)
+        self.server.check_interval = 0.05
+        self.server_thread = threading.Thread(target=self.server.serve)
+        self.server_thread.start()
         
-        
-        
-        
-        
-        
-        
+    def tearDown(self):
+        self.server.stop()
+        self.server_thread.join(5)
+        self.assertFalse(self.server_thread.is_alive())
+        self.assertEqual(self.server.pids, [])
+
+    def connect(self):
+        """ Connects to the server, waiting for the workers to start """
+        for i in range(100):
+            try:
+                return bjsonrpc.connect(port=10126)
+            except socket.error:
+                time.sleep(0.05)
+        self.fail("Can't connect to the server")
+
+    def servedby(self):
+        """ Pids of the workers that served a few connections """
+        pids = set()
+        for i in range(20):
+            conn = self.connect()
+            pids.add(conn.call.getpid())
+            conn.close()
+        return pids
+
+    def test_workers(self):
+        """
+            Connections are served by the worker processes
+        """
+        conn = self.connect()
+        self.assertEqual(conn.call.add2(2, 3), 5)
+        conn.close()
+        pids = self.servedby()
+        self.assertFalse(os.getpid() in pids)
+        self.assertTrue(pids <= set(self.server.pids))
+        self.assertEqual(len(self.server.pids), 2)
+
+    def test_restart(self):
+        """
+            Workers that die are replaced
+        """
+        self.connect().close()
+        dead = self.server.pids[0]
+        os.kill(dead, signal.SIGKILL)
+        for i in range(100):
+            pids = self.server.pids
+            if dead not in pids and len(pids) == 2:
+                break
+            time.sleep(0.05)
+        self.assertFalse(dead in self.server.pids)
+        self.assertEqual(len(self.server.pids), 2)
+        self.assertFalse(dead in self.servedby())
+
+    def test_after_fork(self):
+        """
+            Workers don't keep the worker pool and timers of the parent
+        """
+        release = threading.Event()
+        get_default_pool().submit(release.wait, 5)
+        get_default_wheel().add(time.time() + 60, release.set)
+        self.connect().close()
+        old = set(self.server.pids)
+        for pid in old:
+            os.kill(pid, signal.SIGKILL)
+        for i in range(100):
+            pids = set(self.server.pids)
+            if not pids & old and len(pids) == 2:
+                break
+            time.sleep(0.05)
+        conn = self.connect()
+        self.assertEqual(conn.call.poolstats(), [0, 0])
+        conn.close()
+        release.set()
+
+
+
+if trollius is not None:
+    class AsyncHandler(testserver1.ServerHandler):
+        @trollius.coroutine
+        def slowadd(self, num1, num2, delay):
+            yield From(trollius.sleep(delay))
+            raise Return(num1 + num2)
+
+        @trollius.coroutine
+        def failing(self):
+            yield From(trollius.sleep(0))
+            raise ValueError("failed")
+
+
+@unittest.skipIf(trollius is None, "trollius is not installed")
+class TestAsyncio(unittest.TestCase):
+    def setUp(self):
+        self.loop = trollius.new_event_loop()
+        trollius.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(bjsonrpc.aio.createserver(
+            port=10125, handler_factory=AsyncHandler, loop=self.loop))
+        self.conn = self.loop.run_until_complete(
+            bjsonrpc.aio.connect(port=10125, loop=self.loop))
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        trollius.set_event_loop(None)
+
+    def test_call(self):
+        """
+            Calls and notifications from coroutines
+        """
+        @trollius.coroutine
+        def calls():
+            for i in range(10):
+                pong = yield From(self.conn.call.ping())
+                self.assertEqual(pong, "pong")
+            self.conn.notify.ping()
+            added = yield From(self.conn.call.add2(3, 4))
+            self.assertEqual(added, 7)
+            result = yield From(self.conn.call.getabc(c=3, a=1))
+            self.assertEqual(result, [1, None, 3])
+        self.loop.run_until_complete(calls())
 
+    def test_coroutine_handler(self):
+        """
+            Coroutine handler methods don't block other calls
+        """
+        @trollius.coroutine
+        def calls():
+            slow = self.conn.method.slowadd(1, 2, 0.2)
+            fast = self.conn.method.slowadd(3, 4, 0)
+            added = yield From(fast)
+            self.assertEqual(added, 7)
+            self.assertFalse(slow.done())
+            added = yield From(slow)
+            self.assertEqual(added, 3)
+        self.loop.run_until_complete(calls())
+
+    def test_errors(self):
+        """
+            Errors are raised by the futures as ServerError
+        """
+        @trollius.coroutine
+        def calls():
+            for name, args in [("myfun", ()), ("add2", (1,)), ("failing", ())]:
+                try:
+                    yield From(getattr(self.conn.call, name)(*args))
+                except ServerError:
+                    pass
+                else:
+                    self.fail("ServerError not raised")
+        self.loop.run_until_complete(calls())
+        # Responses and errors go through the transport too.
+        for conn in [self.conn] + list(self.server.connections):
+            self.assertEqual(conn.write_thread, None)
+
+    def test_threaded_server(self):
+        """
+            AsyncConnection talks to the threaded server too
+        """
+        testserver1.start()
+        @trollius.coroutine
+        def calls():
+            conn = yield From(bjsonrpc.aio.connect(loop=self.loop))
+            results = yield From(trollius.gather(
+                *[conn.call.add2(i, i) for i in range(20)], loop=self.loop))
+            self.assertEqual(results, [i * 2 for i in range(20)])
+            conn.close()
+        self.loop.run_until_complete(calls())
+        testserver1.stop(bjsonrpc.connect())
+
+    def test_stream(self):
+        """
+            Streamed results are read in chunks, no faster than they are 
+            consumed
+        """
+        testserver1.start()
+        @trollius.coroutine
+        def calls():
+            conn = yield From(bjsonrpc.aio.connect(loop=self.loop))
+            stream = conn.stream.countto(1000)
+            items = []
+            while True:
+                chunk = yield From(stream.read())
+                if not chunk:
+                    break
+                items.extend(chunk)
+            self.assertEqual(items, range(1000))
+            self.assertTrue(stream.done())
+            chunk = yield From(conn.stream.echo([1, 2, 3]).read())
+            self.assertEqual(chunk, [1, 2, 3])
+            stream = conn.stream.countto(100000, size=10000)
+            chunk = yield From(stream.read())
+            self.assertEqual(int(chunk[0]), 0)
+            yield From(trollius.sleep(0.5, loop=self.loop))
+            self.assertTrue(testserver1.produced < 5000, testserver1.produced)
+            stream.cancel()
+            conn.close()
+        self.loop.run_until_complete(calls())
+        testserver1.stop(bjsonrpc.connect())
+
+    def test_read_and_dispatch(self):
+        """
+            read_and_dispatch waits on the loop for the next message
+        """
+        @trollius.coroutine
+        def calls():
+            self.assertEqual(self.conn.dispatch_until_empty(), 0)
+            req = self.conn.method.slowadd(1, 2, 0.1)
+            dispatched = yield From(self.conn.read_and_dispatch(timeout=5))
+            self.assertEqual(dispatched, True)
+            self.assertEqual(req.result(), 3)
+            dispatched = yield From(self.conn.read_and_dispatch(timeout=0.1))
+            self.assertEqual(dispatched, False)
+            dispatched = yield From(self.conn.read_and_dispatch(
+                condition=lambda: False))
+            self.assertEqual(dispatched, False)
+            self.loop.call_later(0.1, self.conn.close)
+            dispatched = yield From(self.conn.read_and_dispatch())
+            self.assertEqual(dispatched, False)
+        self.loop.run_until_complete(calls())
 
 
 if __name__ == '__main__':
@@ -1,6 +1,11 @@
-from bjsonrpc.handlers import BaseHandler
+from bjsonrpc.handlers import BaseHandler, process_method
 from bjsonrpc import createserver
+from bjsonrpc.workers import get_default_pool
+from bjsonrpc.timers import get_default_wheel
+import itertools
+import os
 import threading
+import time
 
 class ServerHandler(BaseHandler):
     def ping(self):
@@ -21,8 +26,72 @@ class ServerHandler(BaseHandler):
     
     def getabc(self, a=None, b=None, c=None):
         return (a, b, c)
+
+    def echo(self, data):
+        return data
+
+    def callback(self, name, *args):
+        """ Calls back the client and returns the value it gave """
+        return getattr(self._conn.call, name)(*args)
+
+    def sleepecho(self, data, delay):
+        time.sleep(delay)
+        return data
+
+    def untilcancelled(self, timeout):
+        """ Waits until the call is cancelled, and records if it was """
+        global cancelled
+        end = time.time() + timeout
+        while not self._conn.is_cancelled() and time.time() < end:
+            time.sleep(0.01)
+        cancelled = self._conn.is_cancelled()
+        return cancelled
+
+    def getpid(self):
+        return os.getpid()
+
+    def poolstats(self):
+        """ Items submitted to the pools of this process, and timers """
+        return (get_default_pool().getstats()['submitted'], 
+            len(get_default_wheel()))
+
+    @process_method
+    def slowsum(self, nlist, delay=0):
+        """ Runs in the process pool: returns its pid and the sum """
+        time.sleep(delay)
+        return (os.getpid(), sum(nlist))
+
+    @process_method
+    def divide(self, num1, num2):
+        return num1 / num2
+
+    @process_method
+    def peername(self):
+        """ Fails: process methods have no connection """
+        return self._conn.getpeername()
+
+    def countto(self, count, fail_at=None, size=0):
+        """ Generator of the numbers below count, as strings if size """
+        global produced
+        for i in xrange(count):
+            if i == fail_at:
+                raise ValueError("failed at %d" % i)
+            produced = i
+            yield size and "%*d" % (size, i) or i
         
 
+    def sumstream(self, numbers):
+        """ Sums an iterator uploaded by the client """
+        return sum(numbers)
+
+    def firstn(self, items, count):
+        """ Returns the first items of an upload, ignoring the rest """
+        return list(itertools.islice(items, count))
+        
+
+produced = 0 # last number generated by countto
+cancelled = None # what the last untilcancelled call saw
+
 server = None
 def start():
     global server,  server_thread